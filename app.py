@@ -1,57 +1,66 @@
-import streamlit as st
 import json
 import time
-import requests
+
+import streamlit as st
+
 from factsearch import Factool
+from factsearch.knowledge_qa.searxng_wrapper import searxng_health_monitor
 
 # page configuration
 st.set_page_config(
     page_title="FactSearch Demo - LLM Output Factuality Checking",
     layout="wide",
-    initial_sidebar_state="expanded"
+    initial_sidebar_state="expanded",
 )
 
-# test connection to SearXNG
-def check_searxng_connection(base_url="http://localhost:8888"):
-    """check if the local SearXNG instance is working"""
-    try:
-        response = requests.get(base_url, timeout=2)
-        return response.status_code == 200
-    except requests.RequestException:
-        return False
+# connection to SearXNG, probed in the background so reruns do not wait on the network
+@st.cache_resource
+def searxng_monitor():
+    """health monitor of the SearXNG instances, shared by every session and rerun"""
+    return searxng_health_monitor().start()
 
-searxng_available = check_searxng_connection()
+
+searxng_health = searxng_monitor().healthy
+# unknown until the first probe finishes; let the user try rather than block
+searxng_available = searxng_health is not False
 if not searxng_available:
-    st.warning("Cannot connect to local SearXNG instance. Fact-checking is disabled until connection is restored.")
+    st.warning(
+        "Cannot connect to local SearXNG instance. Fact-checking is disabled until connection is restored."
+    )
+    searxng_monitor().refresh()
 
 # initialise session state
-if 'factool_instance' not in st.session_state:
+if "factool_instance" not in st.session_state:
     st.session_state.factool_instance = None
-if 'results_history' not in st.session_state:
+if "results_history" not in st.session_state:
     st.session_state.results_history = []
 
-def initialize_factool(model_name):
+
+def initialize_factool(model_name, cascade_model=None):
     """Initialise FactSearch instance with selected model"""
     try:
         with st.spinner(f"Initialising FactSearch with {model_name}..."):
-            factool_instance = Factool(model_name)
+            factool_instance = Factool(model_name, cascade_model=cascade_model)
         st.success(f"FactSearch initialised with {model_name}")
         return factool_instance
     except Exception as e:
         st.error(f"Error initialising FactSearch: {str(e)}")
         return None
 
+
 # format results and gui display
 def format_results(results):
 
-    if not results or 'detailed_information' not in results:
+    if not results or "detailed_information" not in results:
         return None
-    detailed_info = results['detailed_information'][0]
+    detailed_info = results["detailed_information"][0]
 
     # pair up claim_level_factuality with queries and evidences
-    claims_raw = detailed_info.get('claim_level_factuality', [])
-    queries_raw = detailed_info.get('queries', [])
-    evidences_raw = detailed_info.get('evidences', [])  # list of {evidence: [...], source: [...]}
+    claims_raw = detailed_info.get("claim_level_factuality", [])
+    queries_raw = detailed_info.get("queries", [])
+    evidences_raw = detailed_info.get(
+        "evidences", []
+    )  # list of {evidence: [...], source: [...]}
 
     enriched_claims = []
     for i, claim in enumerate(claims_raw):
@@ -62,28 +71,34 @@ def format_results(results):
         # attach query used for this claim
         if i < len(queries_raw):
             q = queries_raw[i]
-            enriched['query'] = q[0] if isinstance(q, list) and q else str(q)
+            enriched["query"] = q[0] if isinstance(q, list) and q else str(q)
         # attach evidence snippets and sources
         if i < len(evidences_raw):
             ev = evidences_raw[i]
             if isinstance(ev, dict):
-                snippets = ev.get('evidence', [])
-                sources = ev.get('source', [])
-                enriched['evidence_snippets'] = snippets if isinstance(snippets, list) else [snippets]
-                enriched['evidence_sources'] = sources if isinstance(sources, list) else [sources]
+                snippets = ev.get("evidence", [])
+                sources = ev.get("source", [])
+                enriched["evidence_snippets"] = (
+                    snippets if isinstance(snippets, list) else [snippets]
+                )
+                enriched["evidence_sources"] = (
+                    sources if isinstance(sources, list) else [sources]
+                )
             else:
-                enriched['evidence_snippets'] = []
-                enriched['evidence_sources'] = []
+                enriched["evidence_snippets"] = []
+                enriched["evidence_sources"] = []
         enriched_claims.append(enriched)
 
     return {
-        'prompt': detailed_info.get('prompt', ''),
-        'response': detailed_info.get('response', ''),
-        'response_level_factuality': detailed_info.get('response_level_factuality', False),
-        'claim_level_factuality': enriched_claims,
-        'reasoning': detailed_info.get('reasoning', ''),
-        'avg_claim_factuality': results.get('average_claim_level_factuality', 0),
-        'avg_response_factuality': results.get('average_response_level_factuality', 0)
+        "prompt": detailed_info.get("prompt", ""),
+        "response": detailed_info.get("response", ""),
+        "response_level_factuality": detailed_info.get(
+            "response_level_factuality", False
+        ),
+        "claim_level_factuality": enriched_claims,
+        "reasoning": detailed_info.get("reasoning", ""),
+        "avg_claim_factuality": results.get("average_claim_level_factuality", 0),
+        "avg_response_factuality": results.get("average_response_level_factuality", 0),
     }
 
 
@@ -92,13 +107,15 @@ def display_claim_evidence(claim, index):
     if claim is None:
         return
 
-    is_factual = claim.get('factuality', False)
-    claim_text = claim.get('claim', f'Claim {index + 1}')
+    is_factual = claim.get("factuality", False)
+    claim_text = claim.get("claim", f"Claim {index + 1}")
     verdict_label = "Factual" if is_factual else "Not Factual"
     bg_color = "#26a24b" if is_factual else "#c13939"
     border_color = "#bbf7d0" if is_factual else "#fecaca"
 
-    with st.expander(f"Claim {index + 1}: {claim_text[:80]}{'...' if len(claim_text) > 80 else ''}"):
+    with st.expander(
+        f"Claim {index + 1}: {claim_text[:80]}{'...' if len(claim_text) > 80 else ''}"
+    ):
 
         # verdict badge
         st.markdown(
@@ -107,30 +124,38 @@ def display_claim_evidence(claim, index):
                 ; font-weight:600; font-size:0.85rem; margin-bottom:10px;">
                 {verdict_label}
             </div>""",
-            unsafe_allow_html=True
+            unsafe_allow_html=True,
         )
 
         # claim text
         st.markdown(f"**Claim:** {claim_text}")
 
         # reasoning
-        if claim.get('reasoning'):
+        if claim.get("reasoning"):
             st.markdown(f"**Reasoning:** {claim['reasoning']}")
 
+        # which model decided the claim in cascade mode
+        if claim.get("tier") == "cascade":
+            st.caption(
+                f"Decided by the cascade model (confidence {claim['confidence']:.2f})"
+            )
+        elif claim.get("tier") == "foundation":
+            st.caption("Escalated to the foundation model")
+
         # search query used
-        if claim.get('query'):
+        if claim.get("query"):
             st.markdown(
                 f"""<div style="background:#f8fafc; border-left:3px solid #94a3b8;
                     padding:8px 12px; border-radius:4px; margin:10px 0;
                     font-size:0.85rem; color:#475569;">
                     🔎 <strong>Search query:</strong> {claim['query']}
                 </div>""",
-                unsafe_allow_html=True
+                unsafe_allow_html=True,
             )
 
         # evidence sources
-        snippets = claim.get('evidence_snippets', [])
-        sources = claim.get('evidence_sources', [])
+        snippets = claim.get("evidence_snippets", [])
+        sources = claim.get("evidence_sources", [])
 
         if snippets or sources:
             st.markdown("**Evidence retrieved:**")
@@ -156,56 +181,55 @@ def display_claim_evidence(claim, index):
                         {source_html}
                         {snippet_html}
                     </div>""",
-                    unsafe_allow_html=True
+                    unsafe_allow_html=True,
                 )
         else:
             st.caption("No evidence retrieved for this claim.")
 
-        if claim.get('error'):
+        if claim.get("error"):
             st.error(f"Error: {claim['error']}")
 
 
 def display_results(results):
     if not results:
         return
-    
+
     st.subheader("Query & Response")
     col1, col2 = st.columns(2)
     with col1:
         st.markdown("**Original Question:**")
-        st.info(results['prompt'])
+        st.info(results["prompt"])
     with col2:
         st.markdown("**Response Being Checked:**")
-        st.info(results['response'])
+        st.info(results["response"])
 
     st.subheader("Overall Results")
     col1, col2 = st.columns(2)
     with col1:
-        factuality_color = "green" if results['response_level_factuality'] else "red"
+        factuality_color = "green" if results["response_level_factuality"] else "red"
         st.markdown(
             f"**Response Factuality**: <span style='color:{factuality_color}'>"
             f"{'Factual' if results['response_level_factuality'] else 'Not Factual'}</span>",
-            unsafe_allow_html=True
+            unsafe_allow_html=True,
         )
     with col2:
         st.metric("Average Claim Factuality", f"{results['avg_claim_factuality']:.2%}")
 
     st.subheader("Detailed Analysis")
-    if results['reasoning']:
+    if results["reasoning"]:
         st.markdown("**Reasoning:**")
-        st.write(results['reasoning'])
+        st.write(results["reasoning"])
 
-    if results['claim_level_factuality']:
-        claims = [c for c in results['claim_level_factuality'] if c is not None]
-        n_factual = sum(1 for c in claims if c.get('factuality', False))
+    if results["claim_level_factuality"]:
+        claims = [c for c in results["claim_level_factuality"] if c is not None]
+        n_factual = sum(1 for c in claims if c.get("factuality", False))
         n_total = len(claims)
 
         st.markdown(
-            f"**Claim-by-Claim Analysis** — "
-            f"{n_factual}/{n_total} claims factual"
+            f"**Claim-by-Claim Analysis** — " f"{n_factual}/{n_total} claims factual"
         )
 
-        for i, claim in enumerate(results['claim_level_factuality']):
+        for i, claim in enumerate(results["claim_level_factuality"]):
             display_claim_evidence(claim, i)
 
 
@@ -220,29 +244,48 @@ api_key = st.sidebar.text_input(
     "OpenAI API Key:",
     type="password",
     help="Enter your OpenAI API key. You can find it at https://platform.openai.com/account/api-keys",
-    placeholder="sk-..."
+    placeholder="sk-...",
 )
 if api_key:
     import os
-    os.environ['OPENAI_API_KEY'] = api_key
+
+    os.environ["OPENAI_API_KEY"] = api_key
 
 model_options = ["gpt-5", "gpt-5-mini", "gpt-5.2", "qwen3:1.7b"]
-selected_model = st.sidebar.selectbox("Select Foundation Model:", model_options, index=0)
+selected_model = st.sidebar.selectbox(
+    "Select Foundation Model:", model_options, index=0
+)
+cascade_options = ["None", "qwen3:1.7b"]
+selected_cascade = st.sidebar.selectbox(
+    "Cascade Verification Model:",
+    cascade_options,
+    index=0,
+    help="A small model verifies each claim first; only claims it is unsure about go to the foundation model",
+)
+cascade_model = (
+    None
+    if selected_cascade == "None" or selected_cascade == selected_model
+    else selected_cascade
+)
 
 is_local_model = selected_model.startswith("qwen")
 can_initialize = bool(api_key) or is_local_model
 
-if st.sidebar.button("Initialize FactSearch", type="primary", disabled=not can_initialize):
+if st.sidebar.button(
+    "Initialize FactSearch", type="primary", disabled=not can_initialize
+):
     if api_key:
-        os.environ['OPENAI_API_KEY'] = api_key
-    st.session_state.factool_instance = initialize_factool(selected_model)
+        os.environ["OPENAI_API_KEY"] = api_key
+    st.session_state.factool_instance = initialize_factool(
+        selected_model, cascade_model
+    )
 
 if st.session_state.factool_instance:
     st.sidebar.success("FactSearch Ready")
 elif api_key or is_local_model:
     st.sidebar.info("Click 'Initialise FactSearch' to get started")
 else:
-    st.sidebar.warning('Please enter an OpenAI key or select a local model')
+    st.sidebar.warning("Please enter an OpenAI key or select a local model")
 
 # main window
 if st.session_state.factool_instance:
@@ -251,20 +294,40 @@ if st.session_state.factool_instance:
     with tab1:
         col1, col2 = st.columns(2)
         with col1:
-            prompt = st.text_area("Question/Prompt:", placeholder="Enter the question or prompt here...", height=100)
+            prompt = st.text_area(
+                "Question/Prompt:",
+                placeholder="Enter the question or prompt here...",
+                height=100,
+            )
         with col2:
-            response = st.text_area("Response to Check:", placeholder="Enter the response that needs fact-checking...", height=100)
+            response = st.text_area(
+                "Response to Check:",
+                placeholder="Enter the response that needs fact-checking...",
+                height=100,
+            )
     with tab2:
         st.markdown("**Quick Examples:**")
         examples = [
-            {"name": "Music Facts", "prompt": "Who wrote Purple Haze?", "response": "The song \"Purple Haze\" was written by Jimi Hendrix. It was released in 1967 and is one of his most famous tracks."},
-            {"name": "Historical Facts", "prompt": "When did World War II end?", "response": "World War II ended on September 2, 1945, when Japan formally surrendered aboard the USS Missouri in Tokyo Bay."},
-            {"name": "Science Facts", "prompt": "What is the speed of light?", "response": "The speed of light in a vacuum is approximately 300,000 kilometers per second, which is exactly 299,792,458 meters per second."}
+            {
+                "name": "Music Facts",
+                "prompt": "Who wrote Purple Haze?",
+                "response": 'The song "Purple Haze" was written by Jimi Hendrix. It was released in 1967 and is one of his most famous tracks.',
+            },
+            {
+                "name": "Historical Facts",
+                "prompt": "When did World War II end?",
+                "response": "World War II ended on September 2, 1945, when Japan formally surrendered aboard the USS Missouri in Tokyo Bay.",
+            },
+            {
+                "name": "Science Facts",
+                "prompt": "What is the speed of light?",
+                "response": "The speed of light in a vacuum is approximately 300,000 kilometers per second, which is exactly 299,792,458 meters per second.",
+            },
         ]
         for example in examples:
             if st.button(f"Load: {example['name']}"):
-                prompt = example['prompt']
-                response = example['response']
+                prompt = example["prompt"]
+                response = example["response"]
                 st.rerun()
 
     # run fact checking
@@ -278,10 +341,12 @@ if st.session_state.factool_instance:
                 end_time = time.time()
                 formatted_results = format_results(results)
                 if formatted_results:
-                    formatted_results['processing_time'] = end_time - start_time
+                    formatted_results["processing_time"] = end_time - start_time
                     st.session_state.results_history.insert(0, formatted_results)
                     if len(st.session_state.results_history) > 10:
-                        st.session_state.results_history = st.session_state.results_history[:10]
+                        st.session_state.results_history = (
+                            st.session_state.results_history[:10]
+                        )
             except Exception as e:
                 st.error(f"Error during fact-checking: {str(e)}")
     elif not searxng_available:
@@ -299,15 +364,19 @@ if st.session_state.factool_instance:
                     display_results(result)
         st.subheader("Export Results")
         if st.button("Download Results as TXT"):
-            txt_data = "\n\n".join([str(item) for item in st.session_state.results_history])
+            txt_data = "\n\n".join(
+                [str(item) for item in st.session_state.results_history]
+            )
             st.download_button(
                 label="Download TXT File",
                 data=txt_data,
                 file_name=f"factsearch_results_{time.strftime('%Y%m%d_%H%M%S')}.txt",
-                mime="text/plain"
+                mime="text/plain",
             )
 else:
-    st.markdown("""
+    st.markdown(
+        """
     This demo showcases a fact-checking system powered by SearXNG. 
-    """)
-    st.info("Please initialize FactSearch using the sidebar to get started.")
\ No newline at end of file
+    """
+    )
+    st.info("Please initialize FactSearch using the sidebar to get started.")
@@ -2,145 +2,293 @@ import asyncio
 import copy
 import pdb
 
-from .knowledge_qa.pipeline import knowledge_qa_pipeline
 from factsearch.scientific.pipeline import scientific_pipeline
+from factsearch.utils import metrics
+from factsearch.utils.http_pool import close_sessions
+
+from .knowledge_qa.pipeline import knowledge_qa_pipeline
+
+
+class FactualityTally:
+    """Running counts behind the average claim/response level factuality."""
+
+    def __init__(self):
+        self.num_responses = 0
+        self.total_response_factuality = 0
+        self.num_claims = 0
+        self.total_claim_factuality = 0
+
+    def add(self, output):
+        self.num_responses += 1
+        self.total_response_factuality += output["response_level_factuality"] == True
+
+        self.num_claims += len(output["claim_level_factuality"])
+        if output["category"] == "kbqa":
+            if output["claim_level_factuality"] != []:
+                self.total_claim_factuality += sum(
+                    claim["factuality"] == True if claim != None else 0
+                    for claim in output["claim_level_factuality"]
+                )
+        elif output["category"] == "code":
+            self.total_claim_factuality += output["claim_level_factuality"] == True
+        elif output["category"] == "math":
+            self.total_claim_factuality += sum(
+                claim_factuality == True
+                for claim_factuality in output["claim_level_factuality"]
+            )
+        elif output["category"] == "scientific":
+            self.total_claim_factuality += sum(
+                claim["factuality"] == True
+                for claim in output["claim_level_factuality"]
+            )
+
+    def merge(self, other):
+        """Add the counts of another tally, e.g. from a different shard."""
+        self.num_responses += other.num_responses
+        self.total_response_factuality += other.total_response_factuality
+        self.num_claims += other.num_claims
+        self.total_claim_factuality += other.total_claim_factuality
+
+    def summary(self):
+        avg_claim_level_factuality = (
+            self.total_claim_factuality / self.num_claims if self.num_claims else 0.0
+        )
+        avg_response_level_factuality = (
+            self.total_response_factuality / self.num_responses
+            if self.num_responses
+            else 0.0
+        )
+        return {
+            "average_claim_level_factuality": avg_claim_level_factuality,
+            "average_response_level_factuality": avg_response_level_factuality,
+        }
+
 
-class Factool():
-    def __init__(self, foundation_model):
+class Factool:
+    def __init__(self, foundation_model, max_concurrency=4, cascade_model=None):
         self.foundation_model = foundation_model
+        # small model that verifies kbqa claims first, see knowledge_qa_pipeline
+        self.cascade_model = cascade_model
+        # number of batches allowed to run at the same time on the event loop
+        self.max_concurrency = max_concurrency
         self.pipelines = {
-                            "kbqa_online": knowledge_qa_pipeline(
-                                foundation_model, 10, "online"
-                            ),
-                            #"scientific": scientific_pipeline(
-                            #    foundation_model
-                            #)
-                        }
-
-    def run(self, inputs):
-        outputs = copy.deepcopy(inputs)
+            "kbqa_online": knowledge_qa_pipeline(
+                foundation_model, 10, "online", cascade_model=cascade_model
+            ),
+            # "scientific": scientific_pipeline(
+            #    foundation_model
+            # )
+        }
+
+    def _split_batches(self, inputs):
+        """Group consecutive inputs that can share a pipeline call.
+
+        Returns a list of (start_index, batch) tuples so results can be written
+        back in input order no matter in which order the batches finish.
+        """
         batches = []
-        current_category = inputs[0]['category']
-        current_search_type = inputs[0].get('search_type', None)
-        current_data_link = inputs[0].get('data_link', None)
-        current_embedding_link = inputs[0].get('embedding_link', None)
+        current_category = inputs[0]["category"]
+        current_search_type = inputs[0].get("search_type", None)
+        current_data_link = inputs[0].get("data_link", None)
+        current_embedding_link = inputs[0].get("embedding_link", None)
+        current_start = 0
         current_batch = []
 
-        for input in inputs:
-            if (input['category'] == current_category != 'kbqa') \
-                or (input['category'] == current_category == 'kbqa' and input.get('search_type', None) == current_search_type == "online") \
-                    or (input['category'] == current_category == 'kbqa' and input.get('search_type', None) == current_search_type == "local"\
-                        and input.get('data_link', None)==current_data_link and input.get('embedding_link', None)==current_embedding_link):
+        for index, input in enumerate(inputs):
+            if (
+                (input["category"] == current_category != "kbqa")
+                or (
+                    input["category"] == current_category == "kbqa"
+                    and input.get("search_type", None)
+                    == current_search_type
+                    in (None, "online")
+                )
+                or (
+                    input["category"] == current_category == "kbqa"
+                    and input.get("search_type", None) == current_search_type == "local"
+                    and input.get("data_link", None) == current_data_link
+                    and input.get("embedding_link", None) == current_embedding_link
+                )
+            ):
                 current_batch.append(input)
             else:
-                batches.append(current_batch)
+                batches.append((current_start, current_batch))
+                current_start = index
                 current_batch = [input]
-                current_category = input['category']
-                current_search_type = input.get('search_type', None)
-                current_data_link = input.get('data_link', None)
-                current_embedding_link = input.get('embedding_link', None)
-                    
-        batches.append(current_batch)  # append the last batch
-
-        index = 0
-        for batch in batches:
-            if not batch: continue
-            category = batch[0]['category']
-            search_type = batch[0].get('search_type', None)
-            if category == 'code':
-                batch_results = asyncio.run(
-                    self.pipelines[category].run_with_tool_api_call(
-                        [sample['prompt'] for sample in batch],
-                        [sample['response'] for sample in batch],
-                        [sample['entry_point'] for sample in batch]
-                    )
-                )
-            elif category == 'kbqa':
-                if search_type is None or search_type == "online":
-                    batch_results = asyncio.run(
-                        self.pipelines[category+"_online"].run_with_tool_api_call(
-                            [sample['prompt'] for sample in batch],
-                            [sample['response'] for sample in batch],
-                        )
-                    )
-                else:
-                    batch_results = asyncio.run(
-                        knowledge_qa_pipeline(
-                            self.foundation_model,2,"local",batch[0].get("data_link"),batch[0].get("embedding_link")
-                        ).run_with_tool_api_call(
-                            [sample['prompt'] for sample in batch],
-                            [sample['response'] for sample in batch],
-                        )
-                    )
-            else:
-                batch_results = asyncio.run(
-                    self.pipelines[category].run_with_tool_api_call(
-                        [sample['prompt'] for sample in batch],
-                        [sample['response'] for sample in batch]
-                    )
+                current_category = input["category"]
+                current_search_type = input.get("search_type", None)
+                current_data_link = input.get("data_link", None)
+                current_embedding_link = input.get("embedding_link", None)
+
+        batches.append((current_start, current_batch))  # append the last batch
+        return [(start, batch) for start, batch in batches if batch]
+
+    def _pipeline_for(self, batch):
+        category = batch[0]["category"]
+        search_type = batch[0].get("search_type", None)
+        if category == "kbqa":
+            if search_type is None or search_type == "online":
+                return self.pipelines[category + "_online"]
+            # local pipelines are kept per corpus; the corpus itself comes from the shared registry
+            key = (
+                "kbqa_local",
+                batch[0].get("data_link"),
+                batch[0].get("embedding_link"),
+            )
+            if key not in self.pipelines:
+                self.pipelines[key] = knowledge_qa_pipeline(
+                    self.foundation_model,
+                    2,
+                    "local",
+                    batch[0].get("data_link"),
+                    batch[0].get("embedding_link"),
+                    cascade_model=self.cascade_model,
                 )
-            for result in batch_results:
-                outputs[index].update(result)
-                index += 1
-        
-        # calculate average response_level_factuality
-        total_response_factuality = sum(output['response_level_factuality'] == True for output in outputs)
-        avg_response_level_factuality = total_response_factuality / len(outputs)
-
-        # calculate average claim_level_factuality
-        num_claims = 0
-        total_claim_factuality = 0
-        for output in outputs:
-            num_claims += len(output['claim_level_factuality'])
-            if output['category'] == 'kbqa':
-                if output['claim_level_factuality'] != []:
-                    total_claim_factuality += sum(claim['factuality'] == True if claim != None else 0 for claim in output['claim_level_factuality'])
-                else:
-                    total_claim_factuality += 0
-            elif output['category'] == 'code':
-                total_claim_factuality += (output['claim_level_factuality'] == True)
-            elif output['category'] == 'math':
-                total_claim_factuality += sum(claim_factuality == True for claim_factuality in output['claim_level_factuality'])
-            elif output['category'] == 'scientific':
-                total_claim_factuality += sum(claim['factuality'] == True for claim in output['claim_level_factuality'])
-
-        avg_claim_level_factuality = total_claim_factuality / num_claims
-
-        return {"average_claim_level_factuality": avg_claim_level_factuality, "average_response_level_factuality": avg_response_level_factuality, "detailed_information": outputs}
-
-    async def run_for_plugin(self, inputs):
+            return self.pipelines[key]
+        return self.pipelines[category]
+
+    def _batch_args(self, batch):
+        args = [
+            [sample["prompt"] for sample in batch],
+            [sample["response"] for sample in batch],
+        ]
+        if batch[0]["category"] == "code":
+            args.append([sample["entry_point"] for sample in batch])
+        return args
+
+    async def _run_batch(self, batch):
+        return await self._pipeline_for(batch).run_with_tool_api_call(
+            *self._batch_args(batch)
+        )
+
+    async def _stream_batch(self, batch):
+        """Yield (offset, result) pairs for a batch, per sample when the pipeline supports it."""
+        pipeline = self._pipeline_for(batch)
+        if (
+            hasattr(pipeline, "stream_with_tool_api_call")
+            and batch[0]["category"] != "code"
+        ):
+            async for offset, result in pipeline.stream_with_tool_api_call(
+                *self._batch_args(batch)
+            ):
+                yield offset, result
+        else:
+            batch_results = await pipeline.run_with_tool_api_call(
+                *self._batch_args(batch)
+            )
+            for offset, result in enumerate(batch_results):
+                yield offset, result
+
+    async def _run_batches(self, inputs, max_concurrency=None):
+        """Schedule every batch as a task on the running loop and merge the results in input order."""
         outputs = copy.deepcopy(inputs)
+        semaphore = asyncio.Semaphore(max_concurrency or self.max_concurrency)
 
-        batches = []
-        current_category = inputs[0]['category']
-        current_batch = []
+        async def _bounded(start, batch):
+            async with semaphore:
+                return start, await self._run_batch(batch)
 
-        for input in inputs:
-            if input['category'] == current_category:
-                current_batch.append(input)
-            else:
-                batches.append(current_batch)
-                current_batch = [input]
-                current_category = input['category']
-                    
-        batches.append(current_batch)  # append the last batch
-
-        index = 0
-        for batch in batches:
-            category = batch[0]['category']
-            if category == 'code':
-                batch_results = await self.pipelines[category].run_with_tool_api_call(
-                    [sample['prompt'] for sample in batch],
-                    [sample['response'] for sample in batch],
-                    [sample['entry_point'] for sample in batch],
-                )
-            else:
-                batch_results = await self.pipelines[category].run_with_tool_api_call(
-                    [sample['prompt'] for sample in batch],
-                    [sample['response'] for sample in batch],
-                )
-            for result in batch_results:
-                outputs[index].update(result)
-                index += 1
-        
-        return outputs
\ No newline at end of file
+        tasks = [_bounded(start, batch) for start, batch in self._split_batches(inputs)]
+        for start, batch_results in await asyncio.gather(*tasks):
+            for offset, result in enumerate(batch_results):
+                outputs[start + offset].update(result)
+
+        return outputs
+
+    def _summarize(self, outputs):
+        tally = FactualityTally()
+        for output in outputs:
+            tally.add(output)
+        return tally.summary()
+
+    async def run_async(self, inputs, max_concurrency=None):
+        with metrics.recording(metrics.UsageRecorder()) as usage:
+            outputs = await self._run_batches(inputs, max_concurrency)
+        results = self._summarize(outputs)
+        results["detailed_information"] = outputs
+        # time, tokens and cost per stage for the whole run; each sample carries its own under 'usage'
+        results["usage"] = usage.summary()
+        return results
+
+    async def _run_and_close(self, inputs, max_concurrency=None):
+        # pooled HTTP sessions belong to this loop, close them before asyncio.run tears it down
+        try:
+            return await self.run_async(inputs, max_concurrency)
+        finally:
+            await close_sessions()
+
+    def run(self, inputs, max_concurrency=None):
+        """Run all batches concurrently on a single event loop.
+
+        Args:
+            inputs: List of samples, each with 'prompt', 'response' and 'category'.
+            max_concurrency: Number of batches that may run at once, defaults to
+                self.max_concurrency. Pass 1 to process batches one after another.
+        """
+        return asyncio.run(self._run_and_close(inputs, max_concurrency))
+
+    async def run_for_plugin(self, inputs, max_concurrency=None):
+        return await self._run_batches(inputs, max_concurrency)
+
+    async def stream(self, inputs, max_concurrency=None):
+        """Yield each sample as soon as it has been verified.
+
+        Every batch is consumed concurrently and results are handed over through a
+        queue, so nothing waits for the slowest batch and finished samples are not
+        kept around. Each item is a dict with the input 'index', the merged
+        'result' and a rolling 'summary' of the factuality averages so far.
+        """
+        batches = self._split_batches(inputs)
+        semaphore = asyncio.Semaphore(max_concurrency or self.max_concurrency)
+        queue = asyncio.Queue(
+            maxsize=max(1, max_concurrency or self.max_concurrency) * 2
+        )
+        done = object()
+
+        async def _produce(start, batch):
+            try:
+                async with semaphore:
+                    async for offset, result in self._stream_batch(batch):
+                        await queue.put((start + offset, result))
+            except Exception as e:
+                await queue.put(e)
+            finally:
+                await queue.put(done)
+
+        producers = [
+            asyncio.ensure_future(_produce(start, batch)) for start, batch in batches
+        ]
+        tally = FactualityTally()
+        remaining = len(producers)
+        try:
+            while remaining:
+                item = await queue.get()
+                if item is done:
+                    remaining -= 1
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                index, result = item
+                output = copy.deepcopy(inputs[index])
+                output.update(result)
+                tally.add(output)
+                yield {"index": index, "result": output, "summary": tally.summary()}
+        finally:
+            for producer in producers:
+                producer.cancel()
+
+    def iter_stream(self, inputs, max_concurrency=None):
+        """Synchronous wrapper around stream() for callers without an event loop."""
+        loop = asyncio.new_event_loop()
+        agen = self.stream(inputs, max_concurrency)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(agen.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(agen.aclose())
+            loop.run_until_complete(close_sessions())
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
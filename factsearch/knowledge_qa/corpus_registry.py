@@ -0,0 +1,163 @@
+"""Process-wide registry of loaded local search corpora.
+
+Building a local_search used to reload the corpus and, without an embedding
+file, re-embed all of it through OpenAIEmbed. The registry keeps loaded corpora
+in memory keyed by their files, so later jobs against the same corpus reuse it.
+"""
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+
+import jsonlines
+import numpy as np
+
+
+def embedding_path_for(data_link):
+    """Where calculated embeddings for data_link are saved, e.g. corpus.jsonl -> corpus_embed.jsonl"""
+    base_name, extension = os.path.splitext(data_link)
+    return base_name + "_embed" + extension
+
+
+def _file_signature(path):
+    if path is None:
+        return None
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def _load_texts(data_link):
+    with jsonlines.open(data_link) as reader:
+        return [obj["text"] for obj in reader]
+
+
+def _load_embedding(embedding_link):
+    with jsonlines.open(embedding_link) as reader:
+        return np.asarray([obj for obj in reader], dtype=np.float32)
+
+
+def _save_embedding(embedding_link, embedding):
+    with jsonlines.open(embedding_link, mode="w") as writer:
+        writer.write_all(embedding.tolist())
+
+
+class LocalCorpus:
+    def __init__(self, data, embedding):
+        self.data = data
+        self.embedding = embedding
+
+    @property
+    def nbytes(self):
+        return self.embedding.nbytes + sum(len(text) for text in self.data)
+
+
+class CorpusRegistry:
+    """LRU cache of LocalCorpus objects bounded by their memory footprint.
+
+    Keys are (data_link, embedding_link) together with the size and mtime of
+    both files, so editing a corpus on disk loads it afresh. Concurrent requests
+    for a corpus that is still loading wait for the same load.
+    """
+
+    def __init__(self, max_bytes=2 * 1024**3):
+        self.max_bytes = max_bytes
+        self._corpora = OrderedDict()
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, data_link, embedding_link):
+        return (_file_signature(data_link), _file_signature(embedding_link))
+
+    async def get(self, data_link, embedding_link, embed):
+        """Return the corpus for data_link, loading or embedding it on first use.
+
+        Args:
+            data_link: jsonlines file with a 'text' field per document.
+            embedding_link: jsonlines file of embeddings, or None to use the
+                saved embeddings next to data_link or calculate them with embed.
+            embed: OpenAIEmbed used when embeddings have to be calculated.
+        """
+        if embedding_link is None:
+            saved_link = embedding_path_for(data_link)
+            if os.path.exists(saved_link) and os.path.getmtime(
+                saved_link
+            ) >= os.path.getmtime(data_link):
+                embedding_link = saved_link
+
+        key = self._key(data_link, embedding_link)
+        if key in self._corpora:
+            self.hits += 1
+            self._corpora.move_to_end(key)
+            return self._corpora[key]
+
+        loading = self._loading.get(key)
+        if loading is not None and not loading.get_loop().is_closed():
+            return await asyncio.shield(loading)
+
+        self.misses += 1
+        loading = asyncio.get_running_loop().create_future()
+        self._loading[key] = loading
+        try:
+            corpus = await self._load(data_link, embedding_link, embed)
+        except asyncio.CancelledError:
+            loading.cancel()
+            raise
+        except Exception as e:
+            loading.set_exception(e)
+            loading.exception()  # waiters re-raise it, do not warn when there are none
+            raise
+        finally:
+            del self._loading[key]
+        loading.set_result(corpus)
+        if embedding_link is None:
+            # the embeddings were just saved next to the data, file them under that key
+            key = self._key(data_link, embedding_path_for(data_link))
+        self._store(key, corpus)
+        return corpus
+
+    async def _load(self, data_link, embedding_link, embed):
+        loop = asyncio.get_running_loop()
+        logging.info(f"loading local search corpus {data_link}")
+        data = await loop.run_in_executor(None, _load_texts, data_link)
+        if embedding_link is not None:
+            embedding = await loop.run_in_executor(
+                None, _load_embedding, embedding_link
+            )
+        else:
+            # raises if any document cannot be embedded, rather than saving a partial corpus
+            result = await embed.process_batch(data)
+            embedding = np.asarray(
+                [emb["data"][0]["embedding"] for emb in result], dtype=np.float32
+            )
+            await loop.run_in_executor(
+                None, _save_embedding, embedding_path_for(data_link), embedding
+            )
+        logging.info(f"loaded {len(data)} documents and their embeddings")
+        return LocalCorpus(data, embedding)
+
+    def _store(self, key, corpus):
+        self._corpora[key] = corpus
+        self._corpora.move_to_end(key)
+        while len(self._corpora) > 1 and self.nbytes > self.max_bytes:
+            self._corpora.popitem(last=False)
+
+    @property
+    def nbytes(self):
+        return sum(corpus.nbytes for corpus in self._corpora.values())
+
+    def clear(self):
+        self._corpora.clear()
+
+    def stats(self):
+        return {
+            "corpora": len(self._corpora),
+            "nbytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+corpus_registry = CorpusRegistry(
+    max_bytes=int(os.environ.get("FACTSEARCH_CORPUS_CACHE_MB", 2048)) * 1024**2
+)
@@ -0,0 +1,201 @@
+"""Near-duplicate detection for search snippets.
+
+Different queries for a claim often find the same pages, and SearXNG returns the
+same article from several engines with slightly different snippet text. Snippets
+count as duplicates when the Jaccard similarity of their word shingles, estimated
+with MinHash, reaches a threshold. Snippets from the same page (matching
+normalised URLs) are always compared, but still only count as duplicates if
+their text is identical or similar enough: one page yields different passages.
+Signatures for a whole batch of claims are computed in one vectorised numpy pass
+and candidate pairs are found with LSH banding, so the cost stays close to
+linear in the number of snippets.
+"""
+import re
+import zlib
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# query parameters that only track where a click came from
+_TRACKING_PARAMS = re.compile(r"^(utm_.*|fbclid|gclid|msclkid|ref|ref_src|igshid)$")
+
+_NUM_PERM = 64
+_BANDS = 16
+_ROWS = _NUM_PERM // _BANDS
+_rng = np.random.default_rng(1)
+# odd multipliers and offsets of the multiply-shift hashes, one per permutation
+_A = _rng.integers(1, 2**63, size=_NUM_PERM, dtype=np.uint64) | np.uint64(1)
+_B = _rng.integers(0, 2**63, size=_NUM_PERM, dtype=np.uint64)
+_EMPTY = np.iinfo(np.uint64).max
+
+
+def normalize_url(url):
+    """Canonical form of a result URL, or None for sources that are not web pages."""
+    if not isinstance(url, str) or not url.startswith(("http://", "https://")):
+        return None
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    path = parts.path.rstrip("/") or "/"
+    query = urlencode(
+        sorted(
+            (k, v) for k, v in parse_qsl(parts.query) if not _TRACKING_PARAMS.match(k)
+        )
+    )
+    # http and https, fragments and tracking parameters all lead to the same page
+    return f"{host}{path}?{query}" if query else f"{host}{path}"
+
+
+def _shingles(text, k=3):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < k:
+        words = [" ".join(words)] if words else []
+        k = 1
+    grams = {" ".join(words[i : i + k]) for i in range(len(words) - k + 1)}
+    return np.fromiter(
+        (zlib.crc32(gram.encode("utf-8")) for gram in grams),
+        dtype=np.uint64,
+        count=len(grams),
+    )
+
+
+def minhash_signatures(texts, k=3):
+    """MinHash signature of each text's word k-shingles, as an (n, 64) uint64 array."""
+    signatures = np.full((len(texts), _NUM_PERM), _EMPTY, dtype=np.uint64)
+    shingles = [_shingles(text, k) for text in texts]
+    sizes = np.array([len(s) for s in shingles])
+    if sizes.sum() == 0:
+        return signatures
+    hashes = np.concatenate(shingles)
+    # (shingles, permutations); uint64 arithmetic wraps, the top 32 bits are the hash
+    permuted = (hashes[:, None] * _A[None, :] + _B[None, :]) >> np.uint64(32)
+    # the shingles of each text are contiguous, reduce every run to its minimum
+    nonempty = np.flatnonzero(sizes)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])[nonempty]
+    signatures[nonempty] = np.minimum.reduceat(permuted, starts, axis=0)
+    return signatures
+
+
+def _candidate_pairs(signatures, group_ids):
+    """(first, other) index pairs of snippets of the same group that share an LSH band of their signatures.
+
+    Each snippet in a bucket is paired with the bucket's first snippet only, which
+    keeps the number of pairs linear when many snippets are alike. Buckets are
+    kept per group, so that first snippet is never one another group owns.
+    """
+    pairs = []
+    bands = signatures.reshape(len(signatures), _BANDS, _ROWS)
+    groups = group_ids.astype(np.uint64)[:, None]
+    for band in range(_BANDS):
+        _, buckets = np.unique(
+            np.hstack([groups, bands[:, band, :]]), axis=0, return_inverse=True
+        )
+        buckets = buckets.reshape(-1)
+        order = np.argsort(buckets, kind="stable")
+        sorted_buckets = buckets[order]
+        is_first = np.concatenate([[True], sorted_buckets[1:] != sorted_buckets[:-1]])
+        first = order[is_first][np.cumsum(is_first) - 1]
+        pairs.append(np.stack([first[~is_first], order[~is_first]], axis=1))
+    return (
+        np.unique(np.concatenate(pairs), axis=0)
+        if pairs
+        else np.empty((0, 2), dtype=int)
+    )
+
+
+def duplicate_of(texts, urls, threshold=0.7, groups=None):
+    """For every snippet, the index of an earlier snippet it duplicates, or -1.
+
+    Args:
+        texts: Snippet texts.
+        urls: Source URL of each snippet; snippets of the same page are compared even
+            if LSH does not pair them. Non-web sources never match by URL.
+        threshold: Estimated Jaccard similarity from which texts count as duplicates.
+        groups: Optional group of each snippet; snippets only match within their group.
+    """
+    n = len(texts)
+    group_ids = np.unique(
+        np.array(list(groups) if groups is not None else [0] * n, dtype=str),
+        return_inverse=True,
+    )[1].reshape(-1)
+    signatures = minhash_signatures(texts)
+
+    pairs = (
+        _candidate_pairs(signatures, group_ids) if n else np.empty((0, 2), dtype=int)
+    )
+    pairs = pairs[signatures[pairs[:, 0], 0] != _EMPTY]
+    # share of agreeing signature entries estimates the Jaccard similarity; in chunks to bound memory
+    similar = [
+        chunk[
+            (signatures[chunk[:, 0]] == signatures[chunk[:, 1]]).mean(axis=1)
+            >= threshold
+        ]
+        for chunk in (
+            pairs[start : start + 100000] for start in range(0, len(pairs), 100000)
+        )
+    ]
+
+    first_seen = {}
+    same_page = []
+    for i, url in enumerate(urls):
+        url = normalize_url(url)
+        if url is None:
+            continue
+        key = (group_ids[i], url)
+        if key in first_seen:
+            same_page.append((first_seen[key], i))
+        else:
+            first_seen[key] = i
+    # a matching URL alone is not enough, the page may have yielded a different passage
+    for first, other in same_page:
+        if (
+            texts[first].strip() == texts[other].strip()
+            or (signatures[first] == signatures[other]).mean() >= threshold
+        ):
+            similar.append(np.array([[first, other]]))
+
+    edges = np.concatenate(similar) if similar else np.empty((0, 2), dtype=int)
+    graph = coo_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    # the earliest snippet of each group of duplicates is the one kept
+    first = np.full(labels.max() + 1 if n else 0, n)
+    np.minimum.at(first, labels, np.arange(n))
+    keeper = first[labels]
+    return np.where(keeper == np.arange(n), -1, keeper)
+
+
+def dedup_evidence(evidences, threshold=0.7):
+    """Drop near-duplicate snippets from each claim's evidence list.
+
+    Signatures are computed once for the snippets of all claims together, but
+    a snippet is only ever dropped in favour of an earlier one of the same
+    claim, so no claim loses evidence another claim happens to share.
+
+    Args:
+        evidences: One list of {'content', 'source'} snippets per claim, as the
+            search tools return them.
+
+    Returns:
+        The lists with duplicates removed, order otherwise kept.
+    """
+    flat = [
+        (claim, snippet)
+        for claim, snippets in enumerate(evidences)
+        for snippet in snippets
+    ]
+    if not flat:
+        return evidences
+    duplicates = duplicate_of(
+        [snippet.get("content", "") for _, snippet in flat],
+        [snippet.get("source") for _, snippet in flat],
+        threshold,
+        groups=[claim for claim, _ in flat],
+    )
+    deduped = [[] for _ in evidences]
+    for i, (claim, snippet) in enumerate(flat):
+        if duplicates[i] == -1:
+            deduped[claim].append(snippet)
+    return deduped
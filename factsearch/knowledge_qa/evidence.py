@@ -0,0 +1,110 @@
+"""Choosing the search snippets that go into a verification prompt.
+
+The search tools return every snippet of every query, placeholders and repeats
+included. EvidencePacker ranks the snippets by TF-IDF cosine similarity to the
+claim, drops placeholders and near-duplicates, and keeps the best ones that fit
+in a token budget, so verification prompts stay short without losing the
+evidence that matters. The full lists are still kept for display.
+"""
+import json
+
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from factsearch.knowledge_qa.query_utils import NO_RESULT
+from factsearch.utils.concurrency import estimate_tokens
+
+# snippets the search tools put in place of results
+PLACEHOLDERS = {NO_RESULT["content"], "Search failed", "Unexpected result format"}
+
+# evidence tokens per claim by model name prefix; small local models get less so
+# packed prompts still fit their context
+EVIDENCE_BUDGETS = {
+    "gpt-5": 1500,
+    "gpt-4": 1200,
+    "gpt-3.5": 800,
+    "qwen3:1.7b": 400,
+    "qwen3:8b": 800,
+}
+
+
+def default_evidence_budget(model_name):
+    for prefix in sorted(EVIDENCE_BUDGETS, key=len, reverse=True):
+        if model_name.startswith(prefix):
+            return EVIDENCE_BUDGETS[prefix]
+    return 800
+
+
+def _text(snippet):
+    return snippet.get("content", "") if isinstance(snippet, dict) else str(snippet)
+
+
+class EvidencePacker:
+    """Ranks, deduplicates and trims the evidence of one claim.
+
+    Args:
+        budget: Default evidence tokens per claim, see default_evidence_budget.
+        max_similarity: Cosine similarity above which a snippet counts as a
+            near-duplicate of a better-ranked one and is dropped.
+    """
+
+    def __init__(self, budget=800, max_similarity=0.8):
+        self.budget = budget
+        self.max_similarity = max_similarity
+
+    def _scores(self, claim, snippets):
+        """(similarity of each snippet to the claim, snippet x snippet similarity matrix)."""
+        vectorizer = TfidfVectorizer(
+            stop_words="english", sublinear_tf=True, ngram_range=(1, 2)
+        )
+        try:
+            matrix = vectorizer.fit_transform([claim] + snippets)
+        except ValueError:
+            # nothing but stop words; keep the search order
+            return [1.0] * len(snippets), None
+        # rows are L2 normalised, so dot products are cosine similarities
+        similarity = (matrix @ matrix.T).toarray()
+        return similarity[0, 1:], similarity[1:, 1:]
+
+    def pack(self, claim, evidence, budget=None):
+        """The snippets of evidence to show the model for claim, best first.
+
+        Args:
+            claim: Text of the claim.
+            evidence: Snippets as strings or {'content', 'source'} dicts.
+            budget: Evidence tokens allowed, defaults to self.budget.
+
+        Returns:
+            List of snippet strings; the no-result placeholder if none is left.
+        """
+        budget = budget or self.budget
+        snippets = []
+        for snippet in evidence if isinstance(evidence, (list, tuple)) else [evidence]:
+            text = " ".join(_text(snippet).split())
+            if text and text not in PLACEHOLDERS and text not in snippets:
+                snippets.append(text)
+        if not snippets:
+            return [NO_RESULT["content"]]
+
+        relevance, similarity = self._scores(claim, snippets)
+        order = sorted(range(len(snippets)), key=lambda i: -relevance[i])
+        chosen = []
+        used = 0
+        for i in order:
+            if similarity is not None and any(
+                similarity[i, j] > self.max_similarity for j in chosen
+            ):
+                continue
+            tokens = estimate_tokens(snippets[i])
+            if used + tokens > budget:
+                if chosen:
+                    continue
+                # the best snippet alone is too long, keep its beginning
+                snippets[i] = snippets[i][: budget * 4]
+                tokens = budget
+            chosen.append(i)
+            used += tokens
+        return [snippets[i] for i in chosen]
+
+    def format(self, claim, evidence, budget=None):
+        """pack() as the JSON list that goes into the prompt."""
+        return json.dumps(self.pack(claim, evidence, budget), ensure_ascii=False)
@@ -1,223 +1,746 @@
+import asyncio
 import json
-import yaml
+import logging
 import os
-import time
-import math
 import pdb
-from typing import List, Dict
+import time
+from collections import Counter
+from typing import Dict, List
+
+import yaml
+
+from factsearch.knowledge_qa.evidence import EvidencePacker, default_evidence_budget
+from factsearch.knowledge_qa.tool import local_search, web_search
+from factsearch.utils import metrics, schemas
+from factsearch.utils.base.pipeline import default_pack_size, make_chat, pipeline
+from factsearch.utils.batch_backend import BulkRunner
+from factsearch.utils.concurrency import estimate_tokens
+
+logger = logging.getLogger(__name__)
 
-from factsearch.knowledge_qa.tool import web_search
-from factsearch.knowledge_qa.tool import local_search
-from factsearch.utils.base.pipeline import pipeline
 
 class knowledge_qa_pipeline(pipeline):
-    def __init__(self, foundation_model, snippet_cnt, search_type, data_link=None, Embed_link=None):
-        super().__init__('knowledge_qa', foundation_model)
-        if(search_type == 'online'):
-            self.tool = web_search(snippet_cnt = snippet_cnt)
-        elif(search_type == 'local'):
-            self.tool = local_search(snippet_cnt = snippet_cnt, data_link=data_link, embedding_link=Embed_link)
-        with open(os.path.join(self.prompts_path, "claim_extraction.yaml"), 'r') as file:
+    def __init__(
+        self,
+        foundation_model,
+        snippet_cnt,
+        search_type,
+        data_link=None,
+        Embed_link=None,
+        pack_size=None,
+        cascade_model=None,
+        cascade_threshold=0.8,
+    ):
+        super().__init__("knowledge_qa", foundation_model, pack_size)
+        # cascade verification: cascade_model (e.g. a small local model) verifies every claim first and
+        # only verdicts below cascade_threshold confidence, or unparseable ones, go to the foundation model
+        self.cascade_chat = make_chat(cascade_model) if cascade_model else None
+        self.cascade_pack_size = (
+            default_pack_size(cascade_model) if cascade_model else None
+        )
+        self.cascade_threshold = cascade_threshold
+        self.cascade_decided = 0
+        self.cascade_escalated = 0
+        # ranks and trims the snippets that go into verification prompts, within each model's budget
+        self.evidence_packer = EvidencePacker(
+            budget=default_evidence_budget(foundation_model)
+        )
+        if search_type == "online":
+            self.tool = web_search(snippet_cnt=snippet_cnt)
+        elif search_type == "local":
+            self.tool = local_search(
+                snippet_cnt=snippet_cnt, data_link=data_link, embedding_link=Embed_link
+            )
+        # claims per call of the search tool, so queries are deduplicated across claims and responses
+        self.search_batch_size = 8
+        # workers per stage of _stream_claims, and the size of the queues between them.
+        # Enough workers to reach each backend limiter's ceiling; the limiters decide the rest.
+        self.stage_workers = {
+            "claim_extraction": self.chat.limiter.max_limit,
+            "query_generation": self.chat.limiter.max_limit,
+            "search": max(2, self.tool.limiter.max_limit // 4),
+            "verification": self.chat.limiter.max_limit,
+        }
+        self.stage_queue_size = 8
+        # how long a packed LLM stage waits for more claims before sending what it has
+        self.stage_linger = 0.25
+        with open(
+            os.path.join(self.prompts_path, "claim_extraction.yaml"), "r"
+        ) as file:
             data = yaml.load(file, Loader=yaml.FullLoader)
-        self.claim_prompt = data['knowledge_qa']
+        self.claim_prompt = data["knowledge_qa"]
 
-        with open(os.path.join(self.prompts_path, 'query_generation.yaml'), 'r') as file:
+        with open(
+            os.path.join(self.prompts_path, "query_generation.yaml"), "r"
+        ) as file:
             data = yaml.load(file, Loader=yaml.FullLoader)
-        self.query_prompt = data['knowledge_qa']
+        self.query_prompt = data["knowledge_qa"]
+        self.packed_query_prompt = data["knowledge_qa_packed"]
 
-        with open(os.path.join(self.prompts_path, 'agreement_verification.yaml'), 'r') as file:
+        with open(
+            os.path.join(self.prompts_path, "agreement_verification.yaml"), "r"
+        ) as file:
             data = yaml.load(file, Loader=yaml.FullLoader)
-        self.verification_prompt = data['knowledge_qa']
-    
+        self.verification_prompt = data["knowledge_qa"]
+        self.packed_verification_prompt = data["knowledge_qa_packed"]
+        self.confidence_prompt = data["knowledge_qa_confidence"]
+
+        # packed verification sends the longest prompts; load local models with a context
+        # that fits them, so Ollama does not reload the model in the middle of a run
+        self._warm_up(
+            self.chat,
+            self._packed_verification_tokens(
+                self.pack_size, default_evidence_budget(foundation_model)
+            ),
+        )
+        if self.cascade_chat is not None:
+            self._warm_up(
+                self.cascade_chat,
+                self._packed_verification_tokens(
+                    self.cascade_pack_size, default_evidence_budget(cascade_model)
+                ),
+            )
+
+    def _packed_verification_tokens(self, pack_size, budget, claim_tokens=100):
+        """Rough size of a full packed verification prompt: the instructions plus pack_size claims with budget evidence tokens each."""
+        instructions = (
+            self.packed_verification_prompt["system"]
+            + self.packed_verification_prompt["user"]
+            + self.confidence_prompt["user"]
+        )
+        return estimate_tokens(instructions) + pack_size * (budget + claim_tokens)
+
     async def _claim_extraction(self, responses):
         messages_list = [
             [
-                {"role": "system", "content": self.claim_prompt['system']},
-                {"role": "user", "content": self.claim_prompt['user'].format(input=response)},
+                {"role": "system", "content": self.claim_prompt["system"]},
+                {
+                    "role": "user",
+                    "content": self.claim_prompt["user"].format(input=response),
+                },
             ]
             for response in responses
         ]
-        results = await self.chat.async_run(messages_list, List)
-        print(f"DEBUG: claim extraction returned: {results}")
+        with metrics.stage("claim_extraction"):
+            results = await self.chat.async_run(
+                messages_list, List, schemas.KNOWLEDGE_QA_CLAIMS
+            )
+        logger.debug("claim extraction returned: %s", results)
         if None in results:
-            print(f"WARNING: Some claim extractions failed")
+            logger.warning("some claim extractions failed")
         return results
-    
+
+    def _claim_text(self, claim):
+        return claim["claim"] if "claim" in claim else ""
+
+    def _query_messages(self, claim):
+        return [
+            {"role": "system", "content": self.query_prompt["system"]},
+            {
+                "role": "user",
+                "content": self.query_prompt["user"].format(
+                    input=self._claim_text(claim)
+                ),
+            },
+        ]
+
+    def _verification_messages(self, claim, evidence, suffix="", budget=None):
+        evidence = self.evidence_packer.format(claim["claim"], evidence, budget)
+        return [
+            {"role": "system", "content": self.verification_prompt["system"]},
+            {
+                "role": "user",
+                "content": self.verification_prompt["user"].format(
+                    claim=claim["claim"], evidence=evidence
+                )
+                + suffix,
+            },
+        ]
+
     async def _query_generation(self, claims):
         if claims == None:
-            return ['None']
-        messages_list = [
-            [
-                {"role": "system", "content": self.query_prompt['system']},
-                {"role": "user", "content": self.query_prompt['user'].format(input=claim['claim'] if 'claim' in claim else '')},
+            return ["None"]
+
+        def single_messages(claim):
+            return self._query_messages(claim)
+
+        def packed_messages(claims):
+            numbered = "\n".join(
+                f"[{i}] claim: {self._claim_text(claim)}"
+                for i, claim in enumerate(claims)
+            )
+            return [
+                {"role": "system", "content": self.packed_query_prompt["system"]},
+                {
+                    "role": "user",
+                    "content": self.packed_query_prompt["user"].format(claims=numbered),
+                },
             ]
-            for claim in claims
-        ]
-        return await self.chat.async_run(messages_list, List)
 
-    async def _verification(self, claims, evidences):
-        messages_list = [
-            [
-                {"role": "system", "content": self.verification_prompt['system']},
-                {"role": "user", "content": self.verification_prompt['user'].format(claim=claim['claim'], evidence=str(evidence))},
+        def unpack(entry):
+            queries = entry.get("queries")
+            return queries if isinstance(queries, list) and queries else None
+
+        with metrics.stage("query_generation"):
+            return await self._run_packed(
+                claims,
+                single_messages,
+                packed_messages,
+                List,
+                unpack,
+                schemas.QUERIES,
+                schemas.PACKED_QUERIES,
+            )
+
+    async def _verify_with(self, chat, items, pack_size=None, with_confidence=False):
+        # the confidence instruction goes after the response format it extends
+        suffix = "\n" + self.confidence_prompt["user"] if with_confidence else ""
+        budget = default_evidence_budget(chat.config["model_name"])
+
+        def single_messages(item):
+            claim, evidence = item
+            return self._verification_messages(claim, evidence, suffix, budget)
+
+        def packed_messages(items):
+            numbered = "\n".join(
+                f"[{i}]\n[text]: {claim['claim']}\n[evidences]: {self.evidence_packer.format(claim['claim'], evidence, budget)}"
+                for i, (claim, evidence) in enumerate(items)
+            )
+            return [
+                {
+                    "role": "system",
+                    "content": self.packed_verification_prompt["system"],
+                },
+                {
+                    "role": "user",
+                    "content": self.packed_verification_prompt["user"].format(
+                        claims=numbered
+                    )
+                    + suffix,
+                },
             ]
-            for claim, evidence in zip(claims, evidences)
-        ]
-        return await self.chat.async_run(messages_list, dict)
-    
+
+        def unpack(entry):
+            return entry if isinstance(entry.get("factuality"), bool) else None
+
+        if with_confidence:
+            schema, packed_schema = (
+                schemas.CONFIDENT_VERDICT,
+                schemas.PACKED_CONFIDENT_VERDICTS,
+            )
+        else:
+            schema, packed_schema = schemas.VERDICT, schemas.PACKED_VERDICTS
+        with metrics.stage("verification"):
+            return await self._run_packed(
+                items,
+                single_messages,
+                packed_messages,
+                dict,
+                unpack,
+                schema,
+                packed_schema,
+                chat,
+                pack_size,
+            )
+
+    def _confidence(self, verdict):
+        confidence = verdict.get("confidence") if verdict is not None else None
+        if isinstance(confidence, bool) or not isinstance(confidence, (int, float)):
+            return None
+        return float(confidence)
+
+    async def _verification(self, claims, evidences):
+        items = list(zip(claims, evidences))
+        if self.cascade_chat is None:
+            return await self._verify_with(self.chat, items)
+
+        verdicts = await self._verify_with(
+            self.cascade_chat, items, self.cascade_pack_size, with_confidence=True
+        )
+        uncertain = []
+        for i, verdict in enumerate(verdicts):
+            confidence = self._confidence(verdict)
+            if confidence is None or confidence < self.cascade_threshold:
+                uncertain.append(i)
+            else:
+                verdict.update({"tier": "cascade", "confidence": confidence})
+        self.cascade_decided += len(items) - len(uncertain)
+        self.cascade_escalated += len(uncertain)
+
+        if uncertain:
+            escalated = await self._verify_with(
+                self.chat, [items[i] for i in uncertain]
+            )
+            for i, verdict in zip(uncertain, escalated):
+                confidence = self._confidence(verdicts[i])
+                if verdict is not None:
+                    verdict.update(
+                        {"tier": "foundation", "cascade_confidence": confidence}
+                    )
+                    verdicts[i] = verdict
+                elif verdicts[i] is not None:
+                    # the foundation model failed too, a low-confidence verdict beats none
+                    verdicts[i].update({"tier": "cascade", "confidence": confidence})
+        return verdicts
+
+    async def _stream_claims(self, responses, window):
+        """Yield (index, state) for each response once every one of its claims is verified.
+
+        One stage pipeline serves all responses: claim extraction -> query
+        generation -> search -> verification, joined by bounded queues. Claims of
+        up to window responses are in it at once, so packed requests and search
+        batches mix claims of different responses, and LLM calls and searches
+        overlap across all of them. state holds the response's 'claims',
+        'queries', 'evidences', 'sources', 'verifications' and its share of the
+        calls in 'usage'.
+        """
+        states = {}
+        finished = asyncio.Queue()
+        admission = asyncio.Semaphore(window)
+        # results of queries already searched in this stream, so later claims asking again reuse them
+        search_memo = {}
+
+        def _finish(i):
+            admission.release()
+            finished.put_nowait((i, states.pop(i)))
+
+        async def _feed():
+            for i, response in enumerate(responses):
+                await admission.acquire()
+                states[i] = {"response": response, "usage": metrics.UsageRecorder()}
+                yield i
+
+        def _shared(indices):
+            # a call made for claims of several responses is split between them by claim count
+            return metrics.recording(
+                metrics.SharedRecorder(
+                    (states[i]["usage"], count) for i, count in Counter(indices).items()
+                )
+            )
+
+        def _failing_stream(handler):
+            # an error ends the stream instead of leaving its responses unfinished
+            async def _handler(batch):
+                try:
+                    return await handler(batch)
+                except Exception as e:
+                    finished.put_nowait(e)
+                    return []
+
+            return _handler
+
+        async def _extract(indices):
+            with _shared(indices):
+                claims_in_responses = await self._claim_extraction(
+                    [states[i]["response"] for i in indices]
+                )
+            items = []
+            for i, claims in zip(indices, claims_in_responses):
+                claims = claims if isinstance(claims, list) else None
+                state = states[i]
+                state["claims"] = claims
+                for key in ("queries", "evidences", "sources", "verifications"):
+                    state[key] = [None] * len(claims or [])
+                state["remaining"] = len(claims or [])
+                if not claims:
+                    _finish(i)
+                items += [(i, k, claim) for k, claim in enumerate(claims or [])]
+            return items
+
+        async def _generate_queries(items):
+            with _shared([i for i, k, claim in items]):
+                queries = await self._query_generation([claim for i, k, claim in items])
+            for (i, k, claim), queries_for_claim in zip(items, queries):
+                states[i]["queries"][k] = queries_for_claim
+            return items
+
+        async def _search(items):
+            with _shared([i for i, k, claim in items]), metrics.stage("search"):
+                search_outputs = await self.tool.run(
+                    [states[i]["queries"][k] for i, k, claim in items], search_memo
+                )
+            for (i, k, claim), search_outputs_for_claim in zip(items, search_outputs):
+                states[i]["evidences"][k] = [
+                    output["content"] for output in search_outputs_for_claim
+                ]
+                states[i]["sources"][k] = [
+                    output["source"] for output in search_outputs_for_claim
+                ]
+            return items
+
+        async def _verify(items):
+            with _shared([i for i, k, claim in items]):
+                verifications = await self._verification(
+                    [claim for i, k, claim in items],
+                    [states[i]["evidences"][k] for i, k, claim in items],
+                )
+            for (i, k, claim), verification in zip(items, verifications):
+                state = states[i]
+                state["verifications"][k] = verification
+                state["remaining"] -= 1
+                if state["remaining"] == 0:
+                    _finish(i)
+            return []
+
+        # LLM stages take up to pack_size claims at a time so they can share one packed request
+        stages = asyncio.ensure_future(
+            self._run_stages(
+                _feed(),
+                [
+                    (
+                        _failing_stream(_extract),
+                        self.stage_workers["claim_extraction"],
+                        1,
+                    ),
+                    (
+                        _failing_stream(_generate_queries),
+                        self.stage_workers["query_generation"],
+                        self.pack_size,
+                    ),
+                    (
+                        _failing_stream(_search),
+                        self.stage_workers["search"],
+                        self.search_batch_size,
+                    ),
+                    (
+                        _failing_stream(_verify),
+                        self.stage_workers["verification"],
+                        self.pack_size,
+                    ),
+                ],
+                queue_size=self.stage_queue_size,
+                linger=self.stage_linger,
+            )
+        )
+        # every response is finished by the time the stages are done
+        stages.add_done_callback(lambda _: finished.put_nowait(None))
+        try:
+            while True:
+                item = await finished.get()
+                if item is None:
+                    stages.result()
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stages.cancel()
+
     async def run_with_tool_live(self, responses):
-        claims_in_responses = await self._claim_extraction(responses)
-        queries_in_responses = []
-        evidences_in_responses = []
-        sources_in_responses = []
-        verifications_in_responses = []
-        for claims_in_response in claims_in_responses:
-            queries = await self._query_generation(claims_in_response)
-            queries_in_responses.append(queries)
-            search_outputs_for_claims = await self.tool.run(queries)
-            evidences = [[output['content'] for output in search_outputs_for_claim] for search_outputs_for_claim in search_outputs_for_claims]
-            evidences_in_responses.append(evidences)
-            sources = [[output['source'] for output in search_outputs_for_claim] for search_outputs_for_claim in search_outputs_for_claims]
-            sources_in_responses.append(sources)
-            verifications = await self._verification(claims_in_response, evidences)
-            verifications_in_responses.append(verifications)
-
-        return claims_in_responses, queries_in_responses, evidences_in_responses, sources_in_responses, verifications_in_responses
-    
-    async def run_with_tool_live_without_claim_extraction(self, claims):
+        claims_in_responses = [None] * len(responses)
+        (
+            queries_in_responses,
+            evidences_in_responses,
+            sources_in_responses,
+            verifications_in_responses,
+        ) = ([[] for _ in responses] for _ in range(4))
+        async for i, state in self._stream_claims(responses, max(1, len(responses))):
+            claims_in_responses[i] = state["claims"]
+            queries_in_responses[i] = state["queries"]
+            evidences_in_responses[i] = state["evidences"]
+            sources_in_responses[i] = state["sources"]
+            verifications_in_responses[i] = state["verifications"]
+        return (
+            claims_in_responses,
+            queries_in_responses,
+            evidences_in_responses,
+            sources_in_responses,
+            verifications_in_responses,
+        )
+
+    async def run_with_tool_live_without_claim_extraction(
+        self, claims, search_memo=None
+    ):
         queries = await self._query_generation(claims)
-        evidences = await self.tool.run(queries)
+        with metrics.stage("search"):
+            evidences = await self.tool.run(queries, search_memo)
 
         final_response = await self._verification(claims, evidences)
         for i in range(len(final_response)):
             if final_response[i] != None:
-                final_response[i]['queries'] = queries[i]
-                final_response[i]['evidences'] = evidences[i]
+                final_response[i]["queries"] = queries[i]
+                final_response[i]["evidences"] = evidences[i]
 
         return final_response
-    
+
+    def _build_sample(
+        self,
+        prompt,
+        response,
+        claims_in_response,
+        queries_in_response,
+        evidences_in_response,
+        sources_in_response,
+        verifications_in_response,
+    ):
+        if claims_in_response != None:
+            for k, claim in enumerate(claims_in_response):
+                if verifications_in_response[k] != None:
+                    if claim != None:
+                        verifications_in_response[k].update({"claim": claim["claim"]})
+                    else:
+                        verifications_in_response[k].update({"claim": "None"})
+
+        evidences_with_source = []
+        for evidence, source in zip(evidences_in_response, sources_in_response):
+            evidences_with_source.append({"evidence": evidence, "source": source})
+        return {
+            "prompt": prompt,
+            "response": response,
+            "category": "kbqa",
+            "claims": claims_in_response,
+            "queries": queries_in_response,
+            # 'evidences': evidences_in_response,
+            # 'sources': sources_in_response,
+            "evidences": evidences_with_source,
+            "claim_level_factuality": verifications_in_response,
+            "response_level_factuality": all(
+                [
+                    verification["factuality"] if verification != None else True
+                    for verification in verifications_in_response
+                ]
+            ),
+        }
+
+    async def stream_with_tool_api_call(self, prompts, responses, max_concurrency=None):
+        """Yield (index, sample) for each response as soon as it has been verified.
+
+        The window of responses in the stage pipeline defaults to the chat
+        limiter's ceiling; the limiter itself decides how many requests are
+        actually in flight.
+        """
+        async for index, state in self._stream_claims(
+            responses, max_concurrency or self.chat.limiter.max_limit
+        ):
+            sample = self._build_sample(
+                prompts[index],
+                responses[index],
+                state["claims"],
+                state["queries"],
+                state["evidences"],
+                state["sources"],
+                state["verifications"],
+            )
+            sample["usage"] = state["usage"].summary()
+            yield index, sample
+
     async def run_with_tool_api_call(self, prompts, responses):
-        batch_size = 5
-        num_batches = math.ceil(len(prompts) / batch_size)
-
-        self.sample_list = [{"prompt": prompt, "response": response, "category": 'kbqa'} for prompt, response in zip(prompts, responses)]
-
-        for i in range(num_batches):
-            print(i)
-            batch_start = i * batch_size
-            batch_end = min((i + 1) * batch_size, len(responses))
-
-            claims_in_responses, queries_in_responses, evidences_in_responses, sources_in_responses, verifications_in_responses = await self.run_with_tool_live(responses[batch_start:batch_end])
-
-            for j, (claims_in_response, queries_in_response, evidences_in_response, sources_in_response, verifications_in_response) in enumerate(zip(claims_in_responses, queries_in_responses, evidences_in_responses, sources_in_responses, verifications_in_responses)):
-                index = batch_start + j
-                
-                if claims_in_response != None:
-                    for k, claim in enumerate(claims_in_response):
-                        if verifications_in_response[k] != None:
-                            if claim != None:
-                                verifications_in_response[k].update({'claim': claim['claim']})
-                            else:
-                                verifications_in_response[k].update({'claim': 'None'})
-
-                evidences_with_source = []
-                for evidence, source in zip(evidences_in_response, sources_in_response):
-                    evidences_with_source.append({'evidence': evidence, 'source': source})
-                self.sample_list[index].update({
-                    'claims': claims_in_response,
-                    'queries': queries_in_response,
-                    # 'evidences': evidences_in_response,
-                    # 'sources': sources_in_response,
-                    'evidences': evidences_with_source,
-                    'claim_level_factuality': verifications_in_response,
-                    'response_level_factuality': all([verification['factuality'] if verification != None else True for verification in verifications_in_response])
-                })
-
-        return self.sample_list
-    
-    async def run_with_tool_dataset(self, annotated_dataset_path: str, with_tool_classified_dataset_path: str, rerun: bool = False, rerun_indices: list = []):
-        data_path = with_tool_classified_dataset_path if rerun else annotated_dataset_path
-        with open(data_path, 'r') as f:
+        sample_list = [None for _ in range(len(prompts))]
+        async for index, sample in self.stream_with_tool_api_call(prompts, responses):
+            sample_list[index] = sample
+        return sample_list
+
+    async def run_with_tool_dataset(
+        self,
+        annotated_dataset_path: str,
+        with_tool_classified_dataset_path: str,
+        rerun: bool = False,
+        rerun_indices: list = [],
+    ):
+        data_path = (
+            with_tool_classified_dataset_path if rerun else annotated_dataset_path
+        )
+        with open(data_path, "r") as f:
             data = [json.loads(line) for line in f]
-        self.sample_list = data if rerun else [claim for sample in data for claim in sample['claims']]
-        rerun_elements = self.sample_list if not rerun else [self.sample_list[i] for i in rerun_indices]
+        self.sample_list = (
+            data if rerun else [claim for sample in data for claim in sample["claims"]]
+        )
+        rerun_elements = (
+            self.sample_list
+            if not rerun
+            else [self.sample_list[i] for i in rerun_indices]
+        )
 
-        batch_size = 4
-        num_batches = math.ceil(len(rerun_elements) / batch_size) # 5
-        
-        for i in range(num_batches):
-            print(i)
-            batch_start = i * batch_size
-            batch_end = min((i + 1) * batch_size, len(rerun_elements))
+        # chunks are sized from the backend limiter, so they grow while the backend keeps up
+        search_memo = {}
+        batch_start = 0
+        while batch_start < len(rerun_elements):
+            batch_end = min(batch_start + self.chat.limiter.limit, len(rerun_elements))
 
-            responses = await self.run_with_tool_live_without_claim_extraction(rerun_elements[batch_start:batch_end])
+            responses = await self.run_with_tool_live_without_claim_extraction(
+                rerun_elements[batch_start:batch_end], search_memo
+            )
 
             for j, response in enumerate(responses):
-                index = batch_start + j if rerun == False else rerun_indices[batch_start + j]
+                index = (
+                    batch_start + j
+                    if rerun == False
+                    else rerun_indices[batch_start + j]
+                )
                 if response is None:
-                    self.sample_list[index].update({
-                        'with_tool_classification': 'None',
-                        'with_tool_reasoning': 'None',
-                        'queries': 'None',
-                        'evidences': 'None'
-                    })
+                    self.sample_list[index].update(
+                        {
+                            "with_tool_classification": "None",
+                            "with_tool_reasoning": "None",
+                            "queries": "None",
+                            "evidences": "None",
+                        }
+                    )
                 else:
-                    self.sample_list[index].update({
-                        'with_tool_classification': response.get('factuality', 'None'),
-                        'with_tool_reasoning': response.get('reasoning', 'None'),
-                        'queries': response.get('queries', 'None'),
-                        'evidences': response.get('evidences', 'None')
-                    })
-        
+                    self.sample_list[index].update(
+                        {
+                            "with_tool_classification": response.get(
+                                "factuality", "None"
+                            ),
+                            "with_tool_reasoning": response.get("reasoning", "None"),
+                            "queries": response.get("queries", "None"),
+                            "evidences": response.get("evidences", "None"),
+                        }
+                    )
+
             # save everything after each batch to prevent data loss
-            with open(with_tool_classified_dataset_path, 'w') as f:
+            with open(with_tool_classified_dataset_path, "w") as f:
                 for item in self.sample_list:
                     json_str = json.dumps(item)
-                    f.write(json_str + '\n')
+                    f.write(json_str + "\n")
+
+            batch_start = batch_end
+
+    async def run_with_tool_dataset_bulk(
+        self,
+        annotated_dataset_path: str,
+        with_tool_classified_dataset_path: str,
+        work_dir: str,
+        backend=None,
+        poll_interval: float = 30,
+        search_chunk: int = 64,
+    ):
+        """run_with_tool_dataset, with each LLM stage sent as one batch, see factsearch.utils.batch_backend.
+
+        Query generation and verification go through the batch backend, searches
+        run in chunks of search_chunk claims in between. Every finished stage is
+        kept in work_dir, so running again with the same work_dir resumes.
+        Verification uses the foundation model only, without the cascade.
+        """
+        with open(annotated_dataset_path, "r") as f:
+            data = [json.loads(line) for line in f]
+        self.sample_list = [claim for sample in data for claim in sample["claims"]]
+        ids = [str(i) for i in range(len(self.sample_list))]
+
+        runner = BulkRunner(self.chat, work_dir, backend, poll_interval)
+        queries = await runner.run_stage(
+            "query_generation",
+            {
+                key: self._query_messages(claim)
+                for key, claim in zip(ids, self.sample_list)
+            },
+            List,
+            schemas.QUERIES,
+        )
+
+        evidences = runner.load("search")
+        if evidences is None:
+            evidences = {}
+            search_memo = {}
+            with metrics.stage("search"):
+                for start in range(0, len(ids), search_chunk):
+                    chunk = ids[start : start + search_chunk]
+                    outputs = await self.tool.run(
+                        [queries[key] for key in chunk], search_memo
+                    )
+                    evidences.update(zip(chunk, outputs))
+            runner.save("search", evidences)
+
+        verifications = await runner.run_stage(
+            "verification",
+            {
+                key: self._verification_messages(claim, evidences[key])
+                for key, claim in zip(ids, self.sample_list)
+            },
+            dict,
+            schemas.VERDICT,
+        )
+
+        for key, sample in zip(ids, self.sample_list):
+            response = verifications.get(key)
+            sample.update(
+                {
+                    "with_tool_classification": response.get("factuality", "None")
+                    if response is not None
+                    else "None",
+                    "with_tool_reasoning": response.get("reasoning", "None")
+                    if response is not None
+                    else "None",
+                    "queries": queries.get(key) if response is not None else "None",
+                    "evidences": evidences.get(key) if response is not None else "None",
+                }
+            )
+
+        with open(with_tool_classified_dataset_path, "w") as f:
+            for item in self.sample_list:
+                f.write(json.dumps(item) + "\n")
+
+    def _self_check_messages(self, fewshot, item):
+        user_prompt_key = "user_3_shot_CoT" if fewshot else "user_zero_shot_CoT"
+        return [
+            {"role": "system", "content": self.self_check_prompt["system"]},
+            {
+                "role": "user",
+                "content": self.self_check_prompt[user_prompt_key].format(
+                    claim=item["claim"]
+                ),
+            },
+        ]
 
     async def run_self_check_live(self, fewshot, batch):
-        user_prompt_key = 'user_3_shot_CoT' if fewshot else 'user_zero_shot_CoT'
         messages_list = [
-            [
-                {"role": "system", "content": self.self_check_prompt['system']},
-                {"role": "user", "content": self.self_check_prompt[user_prompt_key].format(claim=response['claim'])},
-            ]
-            for response in batch
+            self._self_check_messages(fewshot, response) for response in batch
         ]
-        return await self.chat.async_run(messages_list, Dict)
+        with metrics.stage("self_check"):
+            return await self.chat.async_run(messages_list, Dict, schemas.SELF_CHECK)
 
-    async def run_self_check_dataset(self, annotated_dataset_path: str, self_check_classified_dataset_path: str, fewshot: bool = False, rerun: bool = False, rerun_indices: list = []):
-        data_path = annotated_dataset_path if not rerun else self_check_classified_dataset_path
-        with open(data_path, 'r') as f:
+    async def run_self_check_dataset(
+        self,
+        annotated_dataset_path: str,
+        self_check_classified_dataset_path: str,
+        fewshot: bool = False,
+        rerun: bool = False,
+        rerun_indices: list = [],
+    ):
+        data_path = (
+            annotated_dataset_path if not rerun else self_check_classified_dataset_path
+        )
+        with open(data_path, "r") as f:
             data = [json.loads(line) for line in f]
-        self.sample_list = data if rerun else [claim for sample in data for claim in sample['claims']]
-        rerun_elements = self.sample_list if not rerun else [self.sample_list[i] for i in rerun_indices]
+        self.sample_list = (
+            data if rerun else [claim for sample in data for claim in sample["claims"]]
+        )
+        rerun_elements = (
+            self.sample_list
+            if not rerun
+            else [self.sample_list[i] for i in rerun_indices]
+        )
 
-        batch_size = 10
-        num_batches = math.ceil(len(rerun_elements) / batch_size)
-
-        for i in range(num_batches):
-            print(i)
-            batch_start = i * batch_size
-            batch_end = min((i + 1) * batch_size, len(rerun_elements))
+        # chunks are sized from the backend limiter, so they grow while the backend keeps up
+        batch_start = 0
+        while batch_start < len(rerun_elements):
+            batch_end = min(batch_start + self.chat.limiter.limit, len(rerun_elements))
             batch = rerun_elements[batch_start:batch_end]
 
             responses = await self.run_self_check_live(fewshot, batch)
             for j, response in enumerate(responses):
                 index = batch_start + j if not rerun else rerun_indices[batch_start + j]
                 if response is None:
-                    self.sample_list[index].update({
-                        'self_check_classification': 'None',
-                        'self_check_reasoning': 'None'
-                    })
+                    self.sample_list[index].update(
+                        {
+                            "self_check_classification": "None",
+                            "self_check_reasoning": "None",
+                        }
+                    )
                 else:
-                    self.sample_list[index].update({
-                        'self_check_classification': response.get('factuality', 'None'),
-                        'self_check_reasoning': response.get('reasoning', 'None')
-                    })
+                    self.sample_list[index].update(
+                        {
+                            "self_check_classification": response.get(
+                                "factuality", "None"
+                            ),
+                            "self_check_reasoning": response.get("reasoning", "None"),
+                        }
+                    )
 
             # save everything after each batch to prevent data loss
-            with open(self_check_classified_dataset_path, 'w') as f:
+            with open(self_check_classified_dataset_path, "w") as f:
                 for item in self.sample_list:
                     json_str = json.dumps(item)
-                    f.write(json_str + '\n')
+                    f.write(json_str + "\n")
+
+            batch_start = batch_end
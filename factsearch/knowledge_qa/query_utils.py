@@ -0,0 +1,51 @@
+"""Helpers shared by the search tools for turning per-claim query lists into searches."""
+
+NO_RESULT = {"content": "No good Search Result was found", "source": "None"}
+
+
+def normalize_query(query):
+    """Canonical form used to spot duplicate queries, or None if there is nothing to search."""
+    if not isinstance(query, str):
+        return None
+    normalized = " ".join(query.lower().split()).strip(" ?!.,;:\"'")
+    if normalized in ("", "none"):
+        return None
+    return normalized
+
+
+def plan_queries(queries):
+    """Deduplicate the queries of a batch of claims.
+
+    Args:
+        queries: One list of queries per claim, e.g. [['query1a', 'query1b'], None].
+
+    Returns:
+        unique_queries: Queries to actually search, one per normalized form.
+        slots: For every claim, the indices into unique_queries it asked for.
+    """
+    unique_queries = []
+    positions = {}
+    slots = []
+    for sublist in queries:
+        claim_slots = []
+        for query in sublist if isinstance(sublist, (list, tuple)) else []:
+            key = normalize_query(query)
+            if key is None:
+                continue
+            if key not in positions:
+                positions[key] = len(unique_queries)
+                unique_queries.append(query.strip())
+            if positions[key] not in claim_slots:
+                claim_slots.append(positions[key])
+        slots.append(claim_slots)
+    return unique_queries, slots
+
+
+def fan_out(slots, results):
+    """Give every claim the concatenated results of the queries it asked for."""
+    return [
+        [snippet for slot in claim_slots for snippet in results[slot]]
+        if claim_slots
+        else [dict(NO_RESULT)]
+        for claim_slots in slots
+    ]
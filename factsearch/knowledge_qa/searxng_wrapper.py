@@ -1,172 +1,435 @@
 import asyncio
-import aiohttp
-import os
 import logging
+import os
+import time
 
+from factsearch.knowledge_qa.query_utils import fan_out, normalize_query, plan_queries
+from factsearch.utils import metrics
+from factsearch.utils.concurrency import (
+    SingleFlight,
+    get_limiter,
+    get_pacer,
+    is_overload_status,
+)
+from factsearch.utils.disk_cache import get_search_cache, make_key
+from factsearch.utils.endpoints import get_endpoint_pool
+from factsearch.utils.health import get_health_monitor
+from factsearch.utils.http_pool import close_sessions, get_session
 
-class SearXNGAPIWrapper:
 
-    def __init__(self, snippet_cnt=10, searxng_url=None):
+def searxng_health_monitor(urls=None):
+    """Shared background health monitor of the SearXNG instances (urls, or the configured ones).
+
+    It probes the same EndpointPool the searches are routed over.
+    """
+    return get_health_monitor(get_endpoint_pool("searxng", "searxng", urls))
+
+
+class SearXNGAPIWrapper:
+    def __init__(
+        self,
+        snippet_cnt=10,
+        searxng_url=None,
+        engines="brave, qwant,mojeek",
+        cache=None,
+        bypass_cache=False,
+        negative_ttl=None,
+        rate=None,
+        burst=None,
+        searxng_urls=None,
+        hedge_percentile=None,
+    ):
         self.k = snippet_cnt
-        self.gl = "us" 
+        self.gl = "us"
         self.hl = "en"
+        self.engines = engines
         print("SearXNG called")
-        
-        # get SearXNG url 
-        self.searxng_url = searxng_url or os.environ.get("SEARXNG_URL", "http://localhost:8888")
-        self.searxng_url = self.searxng_url.rstrip('/')
-        
-        # check connection to SearXNG
-        self._test_connection()
-    
-    def _test_connection(self):
-        try:
-            import requests
-            response = requests.get(f"{self.searxng_url}/config", timeout=5)
-            if response.status_code == 200:
-                logging.info(f"SearXNG connection successful at {self.searxng_url}")
-            else:
-                logging.warning(f"SearXNG responded with status {response.status_code}")
-        except Exception as e:
-            logging.error(f"Failed to connect to SearXNG at {self.searxng_url}: {e}")
-            print(f"Warning: Cannot connect to SearXNG at {self.searxng_url}. Make sure it's running.")
-    
-    async def _searxng_search_results(self, session, search_term: str, gl: str, hl: str) -> dict:
+
+        # SearXNG instances, from searxng_urls / searxng_url or SEARXNG_URLS / SEARXNG_URL
+        urls = searxng_urls or ([searxng_url] if searxng_url else None)
+        self.endpoints = get_endpoint_pool("searxng", "searxng", urls)
+        self.searxng_url = self.endpoints.endpoints[0].url
+        # a query still unanswered after this percentile of recent latencies is also sent to another instance
+        self.hedge_percentile = hedge_percentile or float(
+            os.environ.get("SEARXNG_HEDGE_PERCENTILE", 0.9)
+        )
+        # hedge delay until enough latencies were seen
+        self.default_hedge_delay = 2.0
+        self.hedges = 0
+        self.limiter = get_limiter("searxng")
+        # queries per second and burst sent to SearXNG, shared by every wrapper in the process;
+        # the pacer slows down while the upstream engines push back
+        self.pacer = get_pacer(
+            "searxng",
+            rate=rate or float(os.environ.get("SEARXNG_RATE", 2.0)),
+            burst=burst or int(os.environ.get("SEARXNG_BURST", 4)),
+        )
+        # identical queries in flight at the same time share one request
+        self.inflight = SingleFlight()
+        self.queries_requested = 0
+        # queries sent to an instance, and queries answered from the cache instead
+        self.queries_searched = 0
+        self.cache_hits = 0
+        # queries answered from the memo of results already found in the same run, see run()
+        self.memo_hits = 0
+        # search results cached on disk, see get_search_cache; bypass_cache skips lookups but still stores
+        self.cache = cache if cache is not None else get_search_cache()
+        self.bypass_cache = bypass_cache
+        # seconds an empty result stays cached; it is often a suspended engine rather than a real answer
+        self.negative_ttl = (
+            negative_ttl
+            if negative_ttl is not None
+            else float(os.environ.get("FACTSEARCH_SEARCH_CACHE_NEGATIVE_TTL", 3600))
+        )
+        # health of the instances as last probed, reported in stats without probing; the probes run
+        # on the caller's loop as requests go out (see EndpointPool.maybe_check_health), or from
+        # the shared monitor's thread if someone started it, e.g. the app
+        self.health = get_health_monitor(self.endpoints)
+
+    def _cache_key(self, search_term, hl):
+        return make_key(
+            {
+                "backend": "searxng",
+                "query": normalize_query(search_term),
+                "lang": hl,
+                "engines": sorted(
+                    engine.strip()
+                    for engine in self.engines.split(",")
+                    if engine.strip()
+                ),
+            }
+        )
+
+    def _cacheable(self, results):
+        """The part of a SearXNG reply _parse_results reads, to keep cache entries small."""
+        return {
+            "results": [
+                {
+                    key: result[key]
+                    for key in ("url", "title", "content")
+                    if key in result
+                }
+                for result in results.get("results", [])
+            ]
+        }
+
+    async def _searxng_search_results(
+        self, session, search_term: str, gl: str, hl: str
+    ) -> dict:
         """
-        Perform search using SearXNG API
+        Perform search using SearXNG API, or answer from the cache
         """
+        if self.cache is not None:
+            cache_key = self._cache_key(search_term, hl)
+            if not self.bypass_cache:
+                cached = await self.cache.aget(cache_key)
+                if cached is not None:
+                    self.cache_hits += 1
+                    return cached
+
         params = {
-            'q': search_term,
-            'format': 'json',
-            'lang': hl,
-            'categories': 'general',
-            'safesearch': 0,
-            'engines': 'brave, qwant,mojeek'
+            "q": search_term,
+            "format": "json",
+            "lang": hl,
+            "categories": "general",
+            "safesearch": 0,
+            "engines": self.engines,
         }
-        
-        try:
-            async with session.get(
-                f"{self.searxng_url}/search",
-                params=params,
-                timeout=10
-            ) as response:
-                if response.status == 200:
-                    return await response.json()
+
+        queued = time.monotonic()
+        await self.pacer.acquire()
+        self.queries_searched += 1
+        # one limiter slot per query, hedges included, so the limiter sees the latency of the winning reply
+        async with self.limiter.slot() as ticket:
+            overloaded = []
+            results = await self._hedged_search(session, params, queued, overloaded)
+            if results is None:
+                if overloaded:
+                    ticket.overloaded()
                 else:
-                    logging.error(f"SearXNG search failed with status {response.status}")
-                    return {'results': []}
-        except Exception as e:
-            logging.error(f"SearXNG search error for '{search_term}': {e}")
-            return {'results': []}
-    
+                    ticket.failed()
+        if results is None:
+            self.pacer.slow_down()
+            logging.error(
+                f"SearXNG search failed for '{search_term}' on every instance tried"
+            )
+            return {"results": []}
+        if results.get("results") and not self._suspended_engines(results):
+            self.pacer.speed_up()
+        else:
+            self.pacer.slow_down()
+        if self.cache is not None:
+            # failed requests are not cached at all, empty results only briefly
+            await self.cache.aset(
+                cache_key,
+                self._cacheable(results),
+                None if results.get("results") else self.negative_ttl,
+            )
+        return results
+
+    async def _hedged_search(self, session, params, queued, overloaded):
+        """Send a search to the best instance, and to another one when it is slow or fails.
+
+        A request still running after the hedge delay (hedge_percentile of recent
+        latencies) gets a twin on a healthy instance not tried yet, and a failed
+        one is retried there; the first good reply wins and the other request is
+        cancelled. Every instance is tried at most once, so a single instance is
+        never hedged, and hedges wait for the pacer like first attempts do. A
+        reply with no results and suspended engines is only used when no
+        instance does better.
+
+        Returns the SearXNG reply, or None if every attempt failed. Attempts
+        turned away with an overload status are added to overloaded.
+        """
+        # the instance is chosen before the attempt starts, so the next hedge already knows to avoid it
+        tried = [self.endpoints.pick()]
+        pending = {
+            asyncio.ensure_future(
+                self._attempt(session, params, queued, tried[0], overloaded)
+            )
+        }
+        fallback = None
+        try:
+            while pending:
+                hedge_delay = (
+                    self.endpoints.latency_percentile(self.hedge_percentile)
+                    or self.default_hedge_delay
+                )
+                next_endpoint = self._untried_endpoint(tried)
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=hedge_delay if next_endpoint else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    results = task.result()
+                    if results is None:
+                        continue
+                    if results.get("results") or not self._suspended_engines(results):
+                        return results
+                    fallback = fallback or results
+                # routing may have changed while waiting
+                next_endpoint = self._untried_endpoint(tried)
+                if next_endpoint is not None:
+                    if not done:
+                        self.hedges += 1
+                    tried.append(next_endpoint)
+                    pending.add(
+                        asyncio.ensure_future(
+                            self._attempt(
+                                session,
+                                params,
+                                queued,
+                                next_endpoint,
+                                overloaded,
+                                paced=True,
+                            )
+                        )
+                    )
+            return fallback
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _untried_endpoint(self, tried):
+        """Healthy instance not in tried that a hedge or retry should go to, or None."""
+        if not any(
+            endpoint.healthy and endpoint not in tried
+            for endpoint in self.endpoints.endpoints
+        ):
+            return None
+        return self.endpoints.pick(exclude=tried)
+
+    async def _attempt(
+        self, session, params, queued, endpoint, overloaded, paced=False
+    ):
+        """One search on endpoint. Returns the reply or None.
+
+        paced attempts (hedges and retries) wait for the pacer first; the first
+        attempt of a query is paced by the caller.
+        """
+        if paced:
+            await self.pacer.acquire()
+        async with self.endpoints.use(endpoint=endpoint):
+            try:
+                start = time.monotonic()
+                async with session.get(
+                    f"{endpoint.url}/search", params=params, timeout=10
+                ) as response:
+                    if response.status == 200:
+                        results = await response.json()
+                        elapsed = time.monotonic() - start
+                        metrics.record_call(
+                            "searxng", wall_time=elapsed, queue_time=start - queued
+                        )
+                        self.endpoints.record_queue_times(endpoint, start - queued)
+                        if self._suspended_engines(results):
+                            # engines of this instance are suspended, send the next queries elsewhere
+                            self.endpoints.report_failure(endpoint)
+                        else:
+                            self.endpoints.report_success(endpoint, elapsed)
+                        return results
+                    if is_overload_status(response.status):
+                        overloaded.append(endpoint)
+                self.endpoints.report_failure(endpoint)
+                logging.error(
+                    f"SearXNG search on {endpoint.url} failed with status {response.status}"
+                )
+            except asyncio.TimeoutError:
+                # a slow instance is an overload signal, the limiter backs off
+                self.endpoints.report_failure(endpoint)
+                overloaded.append(endpoint)
+                logging.error(
+                    f"SearXNG search on {endpoint.url} timed out for '{params['q']}'"
+                )
+            except asyncio.CancelledError:
+                # lost to a hedge; it took at least this long, which steers routing away from a slow instance
+                self.endpoints.report_latency(endpoint, time.monotonic() - start)
+                raise
+            except Exception as e:
+                self.endpoints.report_failure(endpoint)
+                logging.error(
+                    f"SearXNG search error on {endpoint.url} for '{params['q']}': {e}"
+                )
+        return None
+
+    def _suspended_engines(self, results):
+        """Engines SearXNG reports as unresponsive for this query, e.g. suspended after a CAPTCHA or a 429."""
+        return [
+            entry[0] if isinstance(entry, (list, tuple)) else entry
+            for entry in results.get("unresponsive_engines", [])
+        ]
+
     def _parse_results(self, results):
         """
         Expected output format:
         [{"content": str, "source": str}, ...]
         """
         snippets = []
-        
-        searxng_results = results.get('results', [])
-        
+
+        searxng_results = results.get("results", [])
+
         if not searxng_results:
             return [{"content": "No good Search Result was found", "source": "None"}]
-        
+
         # Process each result
-        for result in searxng_results[:self.k]:
-            content = result.get('content', result.get('title', ''))
-            source = result.get('url', 'None')
+        for result in searxng_results[: self.k]:
+            content = result.get("content", result.get("title", ""))
+            source = result.get("url", "None")
             print(source)
-            
+
             if content:
                 element = {
-                    "content": content.replace('\n', ' ').strip(),
-                    "source": source
+                    "content": content.replace("\n", " ").strip(),
+                    "source": source,
                 }
                 snippets.append(element)
-        
+
         # Default message if nothing found
         if len(snippets) == 0:
             return [{"content": "No good Search Result was found", "source": "None"}]
-        
+
         # Limiting to k/2 snippets to match GoogleSerperAPIWrapper which this file replaces
-        snippets = snippets[:int(self.k / 2)]
-        
+        snippets = snippets[: int(self.k / 2)]
+
         return snippets
-    
-    async def parallel_searches(self, search_queries, gl, hl):
-        """ Executes searches to SearXNG in parallel batches with a pause in between to avoid blocking"""
-        async with aiohttp.ClientSession() as session:
-            results = []
-            pause = 2.0 #between batches of queries - added to avoid rate limiting
-            batch_size = 3  
-
-            for i in range(0, len(search_queries), batch_size):
-                batch = search_queries[i:i + batch_size]
-                tasks = [
-                    self._searxng_search_results(session, query, gl, hl)
-                    for query in batch
-                ]
-                batch_results = await asyncio.gather(*tasks, return_exceptions=True)
-                results.extend(batch_results)
-                if i + batch_size < len(search_queries):
-                    await asyncio.sleep(pause)  
-            return results
-    
-    async def run(self, queries):
+
+    async def _search(self, session, search_term, gl, hl, memo=None):
+        key = (normalize_query(search_term), gl, hl)
+        if memo is not None and key in memo:
+            self.memo_hits += 1
+            return memo[key]
+
+        async def _request():
+            return await self._searxng_search_results(session, search_term, gl, hl)
+
+        results = await self.inflight.do(key, _request)
+        # empty results may be a suspended engine, a later claim may try again
+        if memo is not None and results.get("results"):
+            memo[key] = results
+        return results
+
+    def stats(self):
+        """Queries asked for, searched on SearXNG, answered from the cache, and the cache's hit rate."""
+        return {
+            "queries_requested": self.queries_requested,
+            "queries_searched": self.queries_searched,
+            "cache_hits": self.cache_hits,
+            "memo_hits": self.memo_hits,
+            "cache": self.cache.stats() if self.cache is not None else None,
+            "pacer": self.pacer.stats(),
+            "hedges": self.hedges,
+            "instances": self.endpoints.stats(),
+            "health": self.health.status(),
+        }
+
+    async def parallel_searches(self, search_queries, gl, hl, memo=None):
+        """Executes searches to SearXNG in parallel, the shared limiter decides how many are in flight"""
+        # pooled session kept open across run() calls, it serves every instance
+        session = get_session(self.searxng_url)
+        tasks = [self._search(session, query, gl, hl, memo) for query in search_queries]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def run(self, queries, memo=None):
         """
         Main run method
         Args:
             queries: List of query pairs, e.g. [['query1a', 'query1b'], ['query2a', 'query2b']]
-        
+            memo: Optional dict kept by the caller for one run; queries found in an
+                earlier call with the same memo are not searched again.
+
         Returns:
-            List of snippet lists, matching GoogleSerperAPIWrapper format
+            List of snippet lists, one per query pair, matching GoogleSerperAPIWrapper format
         """
-        # Flatten queries
-        flattened_queries = []
-        for sublist in queries:
-            if sublist is None:
-                sublist = ['None', 'None']
-            for item in sublist:
-                flattened_queries.append(item)
-        
+        # Deduplicate queries across claims, missing queries are not searched at all
+        unique_queries, slots = plan_queries(queries)
+        self.queries_requested += sum(
+            len(sublist) for sublist in queries if isinstance(sublist, (list, tuple))
+        )
+
         # Perform searches
-        results = await self.parallel_searches(flattened_queries, gl=self.gl, hl=self.hl)
-        
+        results = await self.parallel_searches(
+            unique_queries, gl=self.gl, hl=self.hl, memo=memo
+        )
+
         # Process results
         snippets_list = []
         for i, result in enumerate(results):
             if isinstance(result, Exception):
-                print(f"[Warning] Search query '{flattened_queries[i]}' failed with error: {result}")
+                logging.warning(
+                    f"Search query '{unique_queries[i]}' failed with error: {result}"
+                )
                 snippets_list.append([{"content": "Search failed", "source": "None"}])
             elif isinstance(result, dict):
                 snippets_list.append(self._parse_results(result))
             else:
-                print(f"[Warning] Unexpected result type: {type(result)} — skipping.")
-                snippets_list.append([{"content": "Unexpected result format", "source": "None"}])
-        
-        # Split results in5o pairs
-        snippets_split = [
-            snippets_list[i] + snippets_list[i+1] 
-            for i in range(0, len(snippets_list), 2)
-        ]
-        
-        return snippets_split
+                logging.warning(f"Unexpected result type: {type(result)}, skipping")
+                snippets_list.append(
+                    [{"content": "Unexpected result format", "source": "None"}]
+                )
+
+        # Hand every claim the results of its own queries
+        return fan_out(slots, snippets_list)
 
 
 if __name__ == "__main__":
+
     async def test_searxng():
         search = SearXNGAPIWrapper(snippet_cnt=10)
-        
-        # Test with single query pair 
-        test_queries = [["What is the capital of the United States?", "US capital city"]]
+
+        # Test with single query pair
+        test_queries = [
+            ["What is the capital of the United States?", "US capital city"]
+        ]
         results = await search.run(test_queries)
-        
+
         print("Test Results:")
         for i, result_group in enumerate(results):
             print(f"Query group {i}:")
             for j, result in enumerate(result_group):
                 print(f"  Result {j}: {result['content'][:100]}...")
                 print(f"  Source: {result['source']}")
-    
+        await close_sessions()
+
     # Run test
-    asyncio.run(test_searxng())
\ No newline at end of file
+    asyncio.run(test_searxng())
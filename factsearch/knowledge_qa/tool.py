@@ -1,93 +1,71 @@
 import asyncio
-import os
-from factsearch.knowledge_qa.searxng_wrapper import SearXNGAPIWrapper
-from factsearch.utils.openai_wrapper import OpenAIEmbed
 import json
-import numpy as np
-import jsonlines
 import pdb
 
-class web_search():
+import numpy as np
+
+from factsearch.knowledge_qa.corpus_registry import corpus_registry
+from factsearch.knowledge_qa.dedup import dedup_evidence
+from factsearch.knowledge_qa.query_utils import fan_out, normalize_query, plan_queries
+from factsearch.knowledge_qa.searxng_wrapper import SearXNGAPIWrapper
+from factsearch.utils.concurrency import SingleFlight
+from factsearch.utils.openai_wrapper import OpenAIEmbed
+
+
+class web_search:
     def __init__(self, snippet_cnt):
         """
         Initialize search with SearXNG only.
-        
+
         Args:
             snippet_cnt: Number of snippets to return
         """
         self.snippet_cnt = snippet_cnt
         print("Using SearXNG for web search")
         self.serper = SearXNGAPIWrapper(snippet_cnt=snippet_cnt)
+        self.limiter = self.serper.limiter
 
-    async def run(self, queries):
-        return await self.serper.run(queries)
+    async def run(self, queries, memo=None):
+        # the queries of a claim often find the same pages, keep one snippet of each
+        return dedup_evidence(await self.serper.run(queries, memo))
 
-class local_search():
+
+class local_search:
     def __init__(self, snippet_cnt, data_link, embedding_link=None):
         self.snippet_cnt = snippet_cnt
         self.data_link = data_link
         self.embedding_link = embedding_link
         self.openai_embed = OpenAIEmbed()
-        self.data = None
-        self.embedding = None
-        asyncio.run(self.init_async())
-        
-    
-    async def init_async(self):
-        print("init local search")
-        self.load_data_by_link()
-        if self.embedding_link is None:
-            await self.calculate_embedding()
-        else:
-            self.load_embedding_by_link()
-        print("loaded data and embedding")
-
-    def add_suffix_to_json_filename(self, filename):
-        base_name, extension = os.path.splitext(filename)
-        return base_name + '_embed' + extension
+        self.limiter = self.openai_embed.limiter
+        self.inflight = SingleFlight()
+        # the corpus is fetched from the shared registry on every run rather than kept
+        # here, so building a local_search is cheap and works inside a running event loop,
+        # and the registry can evict the corpus or reload it once it changes on disk
 
-    def load_data_by_link(self):
-        #load data from json link
-        self.data = []
-        #self.data = json.load(open(self.data_link, 'r'))
-        with jsonlines.open(self.data_link) as reader:
-            for obj in reader:
-                self.data.append(obj['text'])
-
-    def load_embedding_by_link(self):
-        self.embedding = []
-        #self.embedding = json.load(open(self.embedding_link, 'r'))
-        with jsonlines.open(self.embedding_link) as reader:
-            for obj in reader:
-                self.embedding.append(obj)
-    
-    def save_embeddings(self):
-        #json.dump(self.embedding, open(self.add_suffix_to_json_filename(self.data_link), 'w'))
-        with jsonlines.open(self.add_suffix_to_json_filename(self.data_link), mode='w') as writer:
-            writer.write_all(self.embedding)
-
-    async def calculate_embedding(self):
-        result = await self.openai_embed.process_batch(self.data,retry=3)
-        self.embedding = [emb["data"][0]["embedding"] for emb in result]
-        self.save_embeddings()
-
-    async def search(self, query):
+    async def search(self, query, corpus):
         result = await self.openai_embed.create_embedding(query)
         query_embed = result["data"][0]["embedding"]
-        dot_product = np.dot(self.embedding, query_embed)
+        dot_product = np.dot(corpus.embedding, query_embed)
         sorted_indices = np.argsort(dot_product)[::-1]
-        top_k_indices = sorted_indices[:self.snippet_cnt]
-        return [{"content":self.data[i],"source":"local"} for i in top_k_indices]
+        top_k_indices = sorted_indices[: self.snippet_cnt]
+        return [{"content": corpus.data[i], "source": "local"} for i in top_k_indices]
+
+    async def _search(self, query, corpus, memo):
+        key = (normalize_query(query), id(corpus))
+        if memo is not None and key in memo:
+            return memo[key]
+        snippets = await self.inflight.do(key, lambda: self.search(query, corpus))
+        if memo is not None:
+            memo[key] = snippets
+        return snippets
 
-    
-    async def run(self, queries):
-        flattened_queries = []
-        for sublist in queries:
-            if sublist is None:
-                sublist = ['None', 'None']
-            for item in sublist:
-                flattened_queries.append(item)
-        
-        snippets = await asyncio.gather(*[self.search(query) for query in flattened_queries])
-        snippets_split = [snippets[i] + snippets[i+1] for i in range(0, len(snippets), 2)]
-        return snippets_split
\ No newline at end of file
+    async def run(self, queries, memo=None):
+        """Snippets for each claim's queries; memo, a dict kept for one run, skips queries searched before."""
+        corpus = await corpus_registry.get(
+            self.data_link, self.embedding_link, self.openai_embed
+        )
+        unique_queries, slots = plan_queries(queries)
+        snippets = await asyncio.gather(
+            *[self._search(query, corpus, memo) for query in unique_queries]
+        )
+        return dedup_evidence(fan_out(slots, snippets))
@@ -1,72 +1,140 @@
-import time
 import json
-import math
 import os
-import yaml
+import time
 from typing import Dict, List
 
+import yaml
+
 from factsearch.scientific.tool import google_scholar
+from factsearch.utils import metrics, schemas
 from factsearch.utils.base.pipeline import pipeline
+from factsearch.utils.concurrency import estimate_tokens
+
 
 class scientific_pipeline(pipeline):
-    def __init__(self, foundation_model):
-        super().__init__('scientific', foundation_model)
+    def __init__(self, foundation_model, pack_size=None):
+        super().__init__("scientific", foundation_model, pack_size)
 
         self.tool = google_scholar()
 
-        with open(os.path.join(self.prompts_path, "claim_extraction.yaml"), 'r') as file:
+        with open(
+            os.path.join(self.prompts_path, "claim_extraction.yaml"), "r"
+        ) as file:
             data = yaml.load(file, Loader=yaml.FullLoader)
-        self.claim_prompt = data['scientific']
+        self.claim_prompt = data["scientific"]
 
-        with open(os.path.join(self.prompts_path, 'agreement_verification.yaml'), 'r') as file:
+        with open(
+            os.path.join(self.prompts_path, "agreement_verification.yaml"), "r"
+        ) as file:
             data = yaml.load(file, Loader=yaml.FullLoader)
-        self.verification_prompt = data['scientific']
+        self.verification_prompt = data["scientific"]
+        self.packed_verification_prompt = data["scientific_packed"]
+
+        # the packed author checks are the longest prompts, a few dozen tokens per pair
+        instructions = (
+            self.packed_verification_prompt["system"]
+            + self.packed_verification_prompt["user"]
+        )
+        self._warm_up(self.chat, estimate_tokens(instructions) + self.pack_size * 50)
 
     async def _claim_extraction(self, responses):
         messages_list = [
             [
-                {"role": "system", "content": self.claim_prompt['system']},
-                {"role": "user", "content": self.claim_prompt['user'].format(input=response)},
+                {"role": "system", "content": self.claim_prompt["system"]},
+                {
+                    "role": "user",
+                    "content": self.claim_prompt["user"].format(input=response),
+                },
             ]
             for response in responses
         ]
-        return await self.chat.async_run(messages_list, List)
-    
+        with metrics.stage("claim_extraction"):
+            return await self.chat.async_run(
+                messages_list, List, schemas.SCIENTIFIC_CLAIMS
+            )
+
     async def _check_authors(self, authors):
-        messages_list = [
-            [
-                {"role": "system", "content": self.verification_prompt['system']},
-                {"role": "user", "content": self.verification_prompt['user'].format(string1=claim_author, list2=real_author)},
+        def single_messages(pair):
+            claim_author, real_author = pair
+            return [
+                {"role": "system", "content": self.verification_prompt["system"]},
+                {
+                    "role": "user",
+                    "content": self.verification_prompt["user"].format(
+                        string1=claim_author, list2=real_author
+                    ),
+                },
             ]
-            for claim_author, real_author in authors
-        ]
 
-        return await self.chat.async_run(messages_list, Dict)
+        def packed_messages(pairs):
+            numbered = "\n".join(
+                f"[{i}]\n[string1]: {claim_author}\n[list1]: {real_author}"
+                for i, (claim_author, real_author) in enumerate(pairs)
+            )
+            return [
+                {
+                    "role": "system",
+                    "content": self.packed_verification_prompt["system"],
+                },
+                {
+                    "role": "user",
+                    "content": self.packed_verification_prompt["user"].format(
+                        pairs=numbered
+                    ),
+                },
+            ]
+
+        def unpack(entry):
+            return entry if isinstance(entry.get("factuality"), bool) else None
+
+        with metrics.stage("verification"):
+            return await self._run_packed(
+                list(authors),
+                single_messages,
+                packed_messages,
+                Dict,
+                unpack,
+                schemas.AUTHOR_CHECK,
+                schemas.PACKED_AUTHOR_CHECKS,
+            )
 
     async def _verification(self, claims, responses):
-        authors = [(claim['paper_author(s)'], response['author']) for claim, response in zip(claims, responses)]
+        authors = [
+            (claim["paper_author(s)"], response["author"])
+            for claim, response in zip(claims, responses)
+        ]
         check_authors_results = await self._check_authors(authors)
         final_responses = []
         for i, (claim, response) in enumerate(zip(claims, responses)):
             final_response = {
-                'generated_paper_title': claim['paper_title'],
-                'generated_paper_author(s)': claim['paper_author(s)'],
-                'generated_paper_pub_year': claim['paper_pub_year'],
-                'actual_paper_title': response['title'],
-                'actual_paper_author(s)': response['author'],
-                'actual_paper_pub_year': response['pub_year'],
+                "generated_paper_title": claim["paper_title"],
+                "generated_paper_author(s)": claim["paper_author(s)"],
+                "generated_paper_pub_year": claim["paper_pub_year"],
+                "actual_paper_title": response["title"],
+                "actual_paper_author(s)": response["author"],
+                "actual_paper_pub_year": response["pub_year"],
             }
 
             errors = []
-            if final_response['generated_paper_title'].lower() != final_response['actual_paper_title'].lower() and final_response['generated_paper_title'].lower() not in final_response['actual_paper_title'].lower() and final_response['actual_paper_title'].lower() not in final_response['generated_paper_title'].lower() :
-                errors.append('wrong_paper_title')
-            if check_authors_results[i]['factuality'] == False:
-                errors.append('wrong_paper_author(s)')
-            if final_response['generated_paper_pub_year'] != final_response['actual_paper_pub_year']:
-                errors.append('wrong_paper_pub_year')
+            if (
+                final_response["generated_paper_title"].lower()
+                != final_response["actual_paper_title"].lower()
+                and final_response["generated_paper_title"].lower()
+                not in final_response["actual_paper_title"].lower()
+                and final_response["actual_paper_title"].lower()
+                not in final_response["generated_paper_title"].lower()
+            ):
+                errors.append("wrong_paper_title")
+            if check_authors_results[i]["factuality"] == False:
+                errors.append("wrong_paper_author(s)")
+            if (
+                final_response["generated_paper_pub_year"]
+                != final_response["actual_paper_pub_year"]
+            ):
+                errors.append("wrong_paper_pub_year")
 
-            final_response['error'] = errors
-            final_response['factuality'] = len(errors) == 0
+            final_response["error"] = errors
+            final_response["factuality"] = len(errors) == 0
 
             final_responses.append(final_response)
 
@@ -78,127 +146,195 @@ class scientific_pipeline(pipeline):
         evidences_in_responses = []
         verifications_in_responses = []
         for claims_in_response in claims_in_responses:
-            queries = [claim['paper_title'] for claim in claims_in_response]
+            queries = [claim["paper_title"] for claim in claims_in_response]
             queries_in_responses.append(queries)
-            evidences = [self.tool.run(paper_title) for paper_title in queries]
+            with metrics.stage("search"):
+                evidences = [self.tool.run(paper_title) for paper_title in queries]
             evidences_in_responses.append(evidences)
             verifications = await self._verification(claims_in_response, evidences)
             verifications_in_responses.append(verifications)
 
-        return claims_in_responses, queries_in_responses, evidences_in_responses, verifications_in_responses
-        
+        return (
+            claims_in_responses,
+            queries_in_responses,
+            evidences_in_responses,
+            verifications_in_responses,
+        )
+
     async def run_with_tool_live_without_claim_extraction(self, claims):
         # claims = [{"paper_title": "A Survey of Modern Authorship Attribution Methods", "paper_author(s)": "Stamatatos, Efstathios", "paper_pub_year": "2013"}, {"paper_title": "BERT", "paper_author(s)": "John Smith", "paper_pub_year": "2020"}]
-        papers_titles = [claim['paper_title'] for claim in claims]
-        responses = [self.tool.run(paper_title) for paper_title in papers_titles]
+        papers_titles = [claim["paper_title"] for claim in claims]
+        with metrics.stage("search"):
+            responses = [self.tool.run(paper_title) for paper_title in papers_titles]
         final_response = await self._verification(claims, responses)
         return final_response
 
-    async def run_with_tool_api_call(self, prompts, responses):
-        batch_size = 5
-        num_batches = math.ceil(len(prompts) / batch_size)
-
-        self.sample_list = [{"prompt": prompt, "response": response, "category": 'scientific'} for prompt, response in zip(prompts, responses)]
-
-        for i in range(num_batches):
-            print(i)
-            batch_start = i * batch_size
-            batch_end = min((i + 1) * batch_size, len(responses))
+    async def _run_sample(self, prompt, response):
+        with metrics.recording(metrics.UsageRecorder()) as usage:
+            (
+                claims_in_responses,
+                queries_in_responses,
+                evidences_in_responses,
+                verifications_in_responses,
+            ) = await self.run_with_tool_live([response])
+        verifications_in_response = verifications_in_responses[0]
+        return {
+            "prompt": prompt,
+            "response": response,
+            "category": "scientific",
+            "claims": claims_in_responses[0],
+            "queries": queries_in_responses[0],
+            "evidences": evidences_in_responses[0],
+            "claim_level_factuality": verifications_in_response,
+            "response_level_factuality": all(
+                [
+                    verification["factuality"] if verification != None else True
+                    for verification in verifications_in_response
+                ]
+            ),
+            "usage": usage.summary(),
+        }
 
-            claims_in_responses, queries_in_responses, evidences_in_responses, verifications_in_responses = await self.run_with_tool_live(responses[batch_start:batch_end])
+    async def stream_with_tool_api_call(self, prompts, responses, max_concurrency=None):
+        """Yield (index, sample) for each response as soon as it has been verified.
 
-            for j, (claims_in_response, queries_in_response, evidences_in_response, verifications_in_response) in enumerate(zip(claims_in_responses, queries_in_responses, evidences_in_responses, verifications_in_responses)):
-                index = batch_start + j
+        The window defaults to the chat limiter's ceiling; the limiter itself
+        decides how many requests are actually in flight.
+        """
+        async for index, sample in self._stream_samples(
+            list(zip(prompts, responses)),
+            self._run_sample,
+            max_concurrency or self.chat.limiter.max_limit,
+        ):
+            yield index, sample
 
-                self.sample_list[index].update({
-                    'claims': claims_in_response,
-                    'queries': queries_in_response,
-                    'evidences': evidences_in_response,
-                    'claim_level_factuality': verifications_in_response,
-                    'response_level_factuality': all([verification['factuality'] if verification != None else True for verification in verifications_in_response])
-                })
-        return self.sample_list
+    async def run_with_tool_api_call(self, prompts, responses):
+        sample_list = [None for _ in range(len(prompts))]
+        async for index, sample in self.stream_with_tool_api_call(prompts, responses):
+            sample_list[index] = sample
+        return sample_list
 
-    async def run_with_tool_dataset(self, annotated_dataset_path: str, with_tool_classified_dataset_path: str, rerun: bool = False, rerun_indices: list = []):
-        # Example of a line: 
+    async def run_with_tool_dataset(
+        self,
+        annotated_dataset_path: str,
+        with_tool_classified_dataset_path: str,
+        rerun: bool = False,
+        rerun_indices: list = [],
+    ):
+        # Example of a line:
         # {"paper_title": "A Survey of Modern Authorship Attribution Methods", "paper_author(s)": "Stamatatos, Efstathios", "paper_pub_year": "2013", "label": True / False}
         if rerun == False:
-            with open(annotated_dataset_path, 'r') as f:
+            with open(annotated_dataset_path, "r") as f:
                 data = [json.loads(line) for line in f]
-            self.sample_list = [claim for sample in data for claim in sample['claims']]
+            self.sample_list = [claim for sample in data for claim in sample["claims"]]
             rerun_elements = self.sample_list
         else:
-            with open(with_tool_classified_dataset_path, 'r') as f:
+            with open(with_tool_classified_dataset_path, "r") as f:
                 data = [json.loads(line) for line in f]
             self.sample_list = data
             rerun_elements = [self.sample_list[i] for i in rerun_indices]
 
-        batch_size = 5
-        num_batches = math.ceil(len(rerun_elements) / batch_size) # 5
-
-        for i in range(num_batches):
-            print(i)
-            batch_start = i * batch_size
-            batch_end = (i + 1) * batch_size if (i + 1) * batch_size < len(rerun_elements) else len(rerun_elements)
+        # chunks are sized from the backend limiter, so they grow while the backend keeps up
+        batch_start = 0
+        while batch_start < len(rerun_elements):
+            batch_end = min(batch_start + self.chat.limiter.limit, len(rerun_elements))
 
-            responses = await self.run_with_tool_live_without_claim_extraction(rerun_elements[batch_start:batch_end])
+            responses = await self.run_with_tool_live_without_claim_extraction(
+                rerun_elements[batch_start:batch_end]
+            )
             for j, response in enumerate(responses):
-                index = batch_start + j if rerun == False else rerun_indices[batch_start + j]
+                index = (
+                    batch_start + j
+                    if rerun == False
+                    else rerun_indices[batch_start + j]
+                )
                 if response == None:
-                    self.sample_list[index]['with_tool_classification'] = 'None'
-                    self.sample_list[index]['error'] = 'None'
+                    self.sample_list[index]["with_tool_classification"] = "None"
+                    self.sample_list[index]["error"] = "None"
                 else:
-                    self.sample_list[index]['with_tool_classification'] = response.get('factuality', 'None')
-                    self.sample_list[index]['error'] = response.get('error', 'None')
-        
+                    self.sample_list[index]["with_tool_classification"] = response.get(
+                        "factuality", "None"
+                    )
+                    self.sample_list[index]["error"] = response.get("error", "None")
+
             # save everything after each batch to prevent data loss
-            with open(with_tool_classified_dataset_path, 'w') as f:
+            with open(with_tool_classified_dataset_path, "w") as f:
                 for item in self.sample_list:
                     json_str = json.dumps(item)
-                    f.write(json_str + '\n')
+                    f.write(json_str + "\n")
+
+            batch_start = batch_end
+
+    def _self_check_messages(self, fewshot, item):
+        user_prompt_key = "user_3_shot_CoT" if fewshot else "user_zero_shot_CoT"
+        return [
+            {"role": "system", "content": self.self_check_prompt["system"]},
+            {
+                "role": "user",
+                "content": self.self_check_prompt[user_prompt_key].format(
+                    scientific_literature=item
+                ),
+            },
+        ]
 
     async def run_self_check_live(self, fewshot, batch):
-        user_prompt_key = 'user_3_shot_CoT' if fewshot else 'user_zero_shot_CoT'
         messages_list = [
-            [
-                {"role": "system", "content": self.self_check_prompt['system']},
-                {"role": "user", "content": self.self_check_prompt[user_prompt_key].format(scientific_literature=response)}
-            ]
-            for response in batch
+            self._self_check_messages(fewshot, response) for response in batch
         ]
-        return await self.chat.async_run(messages_list, Dict)
+        with metrics.stage("self_check"):
+            return await self.chat.async_run(messages_list, Dict, schemas.SELF_CHECK)
 
-    async def run_self_check_dataset(self, annotated_dataset_path: str, self_check_classified_dataset_path: str, fewshot: bool = False, rerun: bool = False, rerun_indices: list = []):
-        # Example of a line: 
+    async def run_self_check_dataset(
+        self,
+        annotated_dataset_path: str,
+        self_check_classified_dataset_path: str,
+        fewshot: bool = False,
+        rerun: bool = False,
+        rerun_indices: list = [],
+    ):
+        # Example of a line:
         # {"paper_title": "A Survey of Modern Authorship Attribution Methods", "paper_author(s)": "Stamatatos, Efstathios", "paper_pub_year": "2013", "annotation": True / False}
-        data_path = annotated_dataset_path if not rerun else self_check_classified_dataset_path
-        with open(data_path, 'r') as f:
+        data_path = (
+            annotated_dataset_path if not rerun else self_check_classified_dataset_path
+        )
+        with open(data_path, "r") as f:
             data = [json.loads(line) for line in f]
-        self.sample_list = data if rerun else [claim for sample in data for claim in sample['claims']]
-        rerun_elements = self.sample_list if not rerun else [self.sample_list[i] for i in rerun_indices]
-
-        batch_size = 5
-        num_batches = math.ceil(len(rerun_elements) / batch_size)
+        self.sample_list = (
+            data if rerun else [claim for sample in data for claim in sample["claims"]]
+        )
+        rerun_elements = (
+            self.sample_list
+            if not rerun
+            else [self.sample_list[i] for i in rerun_indices]
+        )
 
-        for i in range(num_batches):
-            print(i)
-            batch_start = i * batch_size
-            batch_end = (i + 1) * batch_size
+        # chunks are sized from the backend limiter, so they grow while the backend keeps up
+        batch_start = 0
+        while batch_start < len(rerun_elements):
+            batch_end = min(batch_start + self.chat.limiter.limit, len(rerun_elements))
             batch = rerun_elements[batch_start:batch_end]
-            batch = [{k:v for k,v in d.items() if k != "label"} for d in batch]
+            batch = [{k: v for k, v in d.items() if k != "label"} for d in batch]
 
             responses = await self.run_self_check_live(fewshot, batch)
             for j, response in enumerate(responses):
-                index = batch_start + j if rerun == False else rerun_indices[batch_start + j]
+                index = (
+                    batch_start + j
+                    if rerun == False
+                    else rerun_indices[batch_start + j]
+                )
                 if response == None:
-                    self.sample_list[index]['self_check_classification'] = 'None'
-                    self.sample_list[index]['self_check_reasoning'] = 'None'
+                    self.sample_list[index]["self_check_classification"] = "None"
+                    self.sample_list[index]["self_check_reasoning"] = "None"
                 else:
-                    self.sample_list[index]['self_check_classification'] = response.get('factuality', 'None')
-                    self.sample_list[index]['self_check_reasoning'] = response.get('reasoning', 'None')
-        
+                    self.sample_list[index]["self_check_classification"] = response.get(
+                        "factuality", "None"
+                    )
+                    self.sample_list[index]["self_check_reasoning"] = response.get(
+                        "reasoning", "None"
+                    )
+
             # save everything after each batch to prevent data loss
-            with open(self_check_classified_dataset_path, 'w') as f:
+            with open(self_check_classified_dataset_path, "w") as f:
                 for item in self.sample_list:
                     json_str = json.dumps(item)
-                    f.write(json_str + '\n')
\ No newline at end of file
+                    f.write(json_str + "\n")
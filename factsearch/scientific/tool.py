@@ -1,28 +1,43 @@
-import yaml
-
-from scholarly import scholarly
-from scholarly import ProxyGenerator
 import os
+import time
+
+import yaml
+from scholarly import ProxyGenerator, scholarly
 
 from factsearch.env_config import factool_env_config
+from factsearch.utils import metrics
 
 # env
 # scraper_api_key = factool_env_config.scraper_api_key
 
-class google_scholar():
+
+class google_scholar:
     def __init__(self):
         pg = ProxyGenerator()
         scraper_api_key = os.environ.get("SCRAPER_API_KEY", None)
-        assert scraper_api_key is not None, "Please set the SCRAPER_API_KEY environment variable."
-        assert scraper_api_key != '', "Please set the SCRAPER_API_KEY environment variable."
+        assert (
+            scraper_api_key is not None
+        ), "Please set the SCRAPER_API_KEY environment variable."
+        assert (
+            scraper_api_key != ""
+        ), "Please set the SCRAPER_API_KEY environment variable."
         success = pg.ScraperAPI(scraper_api_key)
         scholarly.use_proxy(pg)
 
     def run(self, query):
+        start = time.monotonic()
         try:
             results = scholarly.search_pubs(query)
             paper_info = next(results)
-            paper_info_subset = {key: paper_info['bib'][key] for key in ['title', 'author', 'pub_year']}
+            paper_info_subset = {
+                key: paper_info["bib"][key] for key in ["title", "author", "pub_year"]
+            }
             return paper_info_subset
         except StopIteration:
-            return {'title': "no match!", "author": "no match!", "pub_year": "no match!"}
+            return {
+                "title": "no match!",
+                "author": "no match!",
+                "pub_year": "no match!",
+            }
+        finally:
+            metrics.record_call("google_scholar", wall_time=time.monotonic() - start)
@@ -0,0 +1,205 @@
+"""Run Factool over a large JSONL dataset with several worker processes.
+
+A single process spends most of a large job on parsing, prompt formatting and
+result assembly, so it pegs one core. Here the input is split into contiguous
+shards, each handled by its own process with its own event loop and pipelines,
+and the shard outputs are concatenated back in input order.
+
+Usage:
+    python -m factsearch.sharded_runner --model qwen3:8b --input in.jsonl --output out.jsonl --workers 4
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from factsearch.factool import Factool, FactualityTally
+from factsearch.utils.concurrency import get_limiter, set_rate_share
+from factsearch.utils.endpoints import set_parallel_share
+
+# in-flight requests allowed per backend across all workers together
+DEFAULT_RATE_BUDGET = {
+    "openai": 64,
+    "ollama": 16,
+    "searxng": 16,
+    "embeddings": 64,
+}
+
+
+def _count_lines(path):
+    with open(path, "r") as f:
+        return sum(1 for line in f if line.strip())
+
+
+def _shard_ranges(num_samples, num_shards):
+    if num_samples <= 0:
+        return []
+    shard_size = max(1, math.ceil(num_samples / num_shards))
+    return [
+        (start, min(start + shard_size, num_samples))
+        for start in range(0, num_samples, shard_size)
+    ]
+
+
+def _read_range(path, start, end):
+    samples = []
+    with open(path, "r") as f:
+        index = 0
+        for line in f:
+            if not line.strip():
+                continue
+            if index >= end:
+                break
+            if index >= start:
+                samples.append(json.loads(line))
+            index += 1
+    return samples
+
+
+def _split_budget(budget, num_workers):
+    return {name: max(1, limit // num_workers) for name, limit in budget.items()}
+
+
+def _run_shard(
+    foundation_model,
+    input_path,
+    start,
+    end,
+    shard_path,
+    budget,
+    rate_share,
+    max_concurrency,
+    cascade_model,
+):
+    """Worker entry point: verify samples [start, end) and write them to shard_path in order."""
+    # the workers share one API key, so each gets its part of the per-minute limits
+    set_rate_share(rate_share)
+    # and the same servers, so each gets its part of every server's parallel slots
+    set_parallel_share(rate_share)
+    for name, limit in budget.items():
+        limiter = get_limiter(name)
+        limiter.configure(max_limit=limit, initial_limit=min(limiter.limit, limit))
+
+    inputs = _read_range(input_path, start, end)
+    factool = Factool(foundation_model, max_concurrency, cascade_model)
+    outputs = [None for _ in range(len(inputs))]
+    tally = FactualityTally()
+    for item in factool.iter_stream(inputs):
+        outputs[item["index"]] = item["result"]
+        tally.add(item["result"])
+
+    with open(shard_path, "w") as f:
+        for output in outputs:
+            f.write(json.dumps(output) + "\n")
+    return tally
+
+
+def run_sharded(
+    foundation_model,
+    input_path,
+    output_path,
+    num_workers=None,
+    rate_budget=None,
+    max_concurrency=4,
+    cascade_model=None,
+):
+    """Verify every sample of input_path across num_workers processes.
+
+    Args:
+        foundation_model: Model name passed to Factool in every worker.
+        input_path: JSONL file with one Factool input per line.
+        output_path: Where the merged JSONL of detailed results is written.
+        num_workers: Most worker processes to start, defaults to the CPU count.
+        rate_budget: Max in-flight requests per backend for the whole job; each
+            worker that runs gets an equal share. Defaults to DEFAULT_RATE_BUDGET. Per-minute
+            API rate limits and the parallel slots of each inference server
+            (OLLAMA_NUM_PARALLEL / VLLM_MAX_NUM_SEQS) are split between the
+            workers the same way.
+        max_concurrency: Batches each worker runs at once, see Factool.run.
+        cascade_model: Small model that verifies claims before the foundation
+            model, see knowledge_qa_pipeline.
+
+    Returns:
+        The global average claim/response level factuality, as Factool.run
+        returns them, plus 'output_path'.
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    num_samples = _count_lines(input_path)
+    ranges = _shard_ranges(num_samples, num_workers)
+    # fewer samples than workers, or uneven shard sizes, leave some workers unused;
+    # the budget is shared by the shards that actually run
+    num_workers = min(num_workers, len(ranges))
+
+    tally = FactualityTally()
+    if not ranges:
+        # nothing to verify, no point starting workers
+        open(output_path, "w").close()
+        results = tally.summary()
+        results["output_path"] = output_path
+        return results
+
+    budget = _split_budget({**DEFAULT_RATE_BUDGET, **(rate_budget or {})}, num_workers)
+    with tempfile.TemporaryDirectory(
+        dir=os.path.dirname(os.path.abspath(output_path))
+    ) as shard_dir:
+        shard_paths = [
+            os.path.join(shard_dir, f"shard_{i}.jsonl") for i in range(len(ranges))
+        ]
+        with ProcessPoolExecutor(
+            max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _run_shard,
+                    foundation_model,
+                    input_path,
+                    start,
+                    end,
+                    shard_path,
+                    budget,
+                    1 / num_workers,
+                    max_concurrency,
+                    cascade_model,
+                )
+                for (start, end), shard_path in zip(ranges, shard_paths)
+            ]
+            for future in futures:
+                tally.merge(future.result())
+
+        # shards are contiguous ranges, so concatenating them restores input order
+        with open(output_path, "w") as out:
+            for shard_path in shard_paths:
+                with open(shard_path, "r") as f:
+                    for line in f:
+                        out.write(line)
+
+    results = tally.summary()
+    results["output_path"] = output_path
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run Factool over a JSONL dataset with several processes."
+    )
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--input", required=True)
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--max-concurrency", type=int, default=4)
+    parser.add_argument("--cascade-model", default=None)
+    args = parser.parse_args()
+
+    print(
+        run_sharded(
+            args.model,
+            args.input,
+            args.output,
+            args.workers,
+            max_concurrency=args.max_concurrency,
+            cascade_model=args.cascade_model,
+        )
+    )
@@ -1,20 +1,304 @@
-import yaml
-from factsearch.utils.openai_wrapper import OpenAIChat
-from factsearch.utils.ollama_wrapper import OllamaChat
+import asyncio
+import itertools
+import json
 import os
 import pathlib
+from abc import ABC, abstractmethod
+from typing import Dict, List
+
+import yaml
+
+from factsearch.utils import schemas
+from factsearch.utils.batch_backend import BulkRunner
+from factsearch.utils.ollama_wrapper import OllamaChat
+from factsearch.utils.openai_wrapper import OpenAIChat
+
+# how many claims are packed into one request, by model name prefix; models with
+# small context windows get fewer so the packed prompt and answer still fit
+PACK_SIZES = {
+    "gpt-5": 10,
+    "gpt-4": 8,
+    "gpt-3.5": 4,
+    "qwen3:1.7b": 3,
+    "qwen3:8b": 5,
+}
 
-class pipeline():
-    def __init__(self, domain, foundation_model):
-        if 'gpt' in foundation_model:
-            self.company = 'openai'
-            self.chat = OpenAIChat(model_name=foundation_model)
-        else:
-            self.company = 'ollama'
-            self.chat = OllamaChat(model_name=foundation_model)
-
-        self.prompts_path = os.path.join(os.path.dirname(pathlib.Path(__file__)), "../prompts/")
-        
-        with open(os.path.join(self.prompts_path, "self_check.yaml"), 'r') as file:
+
+def default_pack_size(foundation_model):
+    for prefix, pack_size in PACK_SIZES.items():
+        if foundation_model.startswith(prefix):
+            return pack_size
+    return 4
+
+
+def make_chat(model_name):
+    """OpenAIChat for GPT models, OllamaChat for everything else."""
+    if "gpt" in model_name:
+        return OpenAIChat(model_name=model_name)
+    return OllamaChat(model_name=model_name)
+
+
+class pipeline(ABC):
+    def __init__(self, domain, foundation_model, pack_size=None):
+        # claims per packed request, 1 sends one request per claim
+        self.pack_size = pack_size or default_pack_size(foundation_model)
+        self.company = "openai" if "gpt" in foundation_model else "ollama"
+        self.chat = make_chat(foundation_model)
+
+        self.prompts_path = os.path.join(
+            os.path.dirname(pathlib.Path(__file__)), "../prompts/"
+        )
+
+        with open(os.path.join(self.prompts_path, "self_check.yaml"), "r") as file:
             data = yaml.load(file, Loader=yaml.FullLoader)
-        self.self_check_prompt = data[domain]
\ No newline at end of file
+        self.self_check_prompt = data[domain]
+
+    def _warm_up(self, chat, prompt_tokens):
+        """Start loading a local model in the background, with the context its largest prompts of about prompt_tokens need.
+
+        Every server is loaded once per process, so building more pipelines for the
+        same model does not load it again.
+        """
+        if isinstance(chat, OllamaChat):
+            chat.start_warm_up(prompt_tokens)
+
+    async def _stream_samples(self, items, worker, max_concurrency):
+        """Yield (index, result) pairs as soon as each item is processed.
+
+        Keeps at most max_concurrency calls to worker in flight, starting the next
+        item whenever one finishes rather than waiting for a whole batch.
+        """
+        iterator = enumerate(items)
+        pending = {}
+        try:
+            for index, item in itertools.islice(iterator, max_concurrency):
+                pending[asyncio.ensure_future(worker(*item))] = index
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    index = pending.pop(task)
+                    for next_index, next_item in itertools.islice(iterator, 1):
+                        pending[asyncio.ensure_future(worker(*next_item))] = next_index
+                    yield index, task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _run_stages(self, items, stages, queue_size=16, linger=0.05):
+        """Push items through a chain of stages joined by bounded queues.
+
+        stages is a list of (handler, num_workers) or (handler, num_workers, batch_size)
+        tuples. A handler receives the item produced by the previous stage and returns
+        the item for the next one, so an item moves on as soon as its own work is done
+        instead of waiting for the rest of its batch, and different stages overlap.
+        Stages given a batch_size get a list of up to batch_size items, waiting at most
+        linger seconds for more to arrive, and return a list of results, which may hold
+        more or fewer items than the batch. items may be an async iterable, so a
+        caller can keep feeding a long-lived pipeline while it runs.
+        """
+        queues = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+        # set once nothing more will be put on the queue of the same index
+        exhausted = [asyncio.Event() for _ in stages]
+        errors = []
+
+        async def _collect(inbox, batch_size, closed):
+            batch = [await inbox.get()]
+            deadline = asyncio.get_running_loop().time() + linger
+            while len(batch) < batch_size:
+                if not inbox.empty():
+                    batch.append(inbox.get_nowait())
+                    continue
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0 or closed.is_set():
+                    break
+                # wait for the next item, the end of the upstream stage or the deadline, whichever comes first
+                getter = asyncio.ensure_future(inbox.get())
+                closing = asyncio.ensure_future(closed.wait())
+                try:
+                    await asyncio.wait(
+                        {getter, closing},
+                        timeout=remaining,
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                finally:
+                    getter.cancel()
+                    closing.cancel()
+                # a get cancelled before it finished leaves its item in the queue
+                if getter.done() and not getter.cancelled():
+                    batch.append(getter.result())
+            return batch
+
+        async def _worker(handler, inbox, outbox, batch_size, closed):
+            while True:
+                if batch_size is not None:
+                    batch = await _collect(inbox, batch_size, closed)
+                else:
+                    batch = [await inbox.get()]
+                try:
+                    results = (
+                        await handler(batch)
+                        if batch_size is not None
+                        else [await handler(batch[0])]
+                    )
+                    if outbox is not None:
+                        for result in results:
+                            await outbox.put(result)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    for _ in batch:
+                        inbox.task_done()
+
+        workers = []
+        for n, stage in enumerate(stages):
+            handler, num_workers = stage[0], stage[1]
+            batch_size = stage[2] if len(stage) > 2 else None
+            outbox = queues[n + 1] if n + 1 < len(queues) else None
+            workers += [
+                asyncio.ensure_future(
+                    _worker(handler, queues[n], outbox, batch_size, exhausted[n])
+                )
+                for _ in range(num_workers)
+            ]
+        try:
+            if hasattr(items, "__aiter__"):
+                async for item in items:
+                    await queues[0].put(item)
+            else:
+                for item in items:
+                    await queues[0].put(item)
+            # a stage's results are all queued once its inbox is joined, so the stages finish in order
+            for queue, closed in zip(queues, exhausted):
+                closed.set()
+                await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+        if errors:
+            raise errors[0]
+
+    async def _run_packed(
+        self,
+        items,
+        single_messages,
+        packed_messages,
+        expected_type,
+        unpack,
+        schema=None,
+        packed_schema=None,
+        chat=None,
+        pack_size=None,
+    ):
+        """Send items pack_size at a time in one request each.
+
+        Args:
+            items: Inputs to process, e.g. claims with their evidence.
+            single_messages: item -> messages for a request about that item alone.
+            packed_messages: list of items -> messages for one request about all of
+                them, the items numbered from 0 in the prompt.
+            expected_type: Type a single-item reply must parse to.
+            unpack: entry of a packed reply -> the result for its item, or None if
+                the entry is malformed.
+            schema: JSON schema of a single-item reply.
+            packed_schema: JSON schema of a packed reply, see schemas.packed.
+            chat: Chat to send the requests to, defaults to self.chat.
+            pack_size: Items per packed request, defaults to self.pack_size.
+
+        Returns:
+            One result per item. Items that are missing or malformed in a packed
+            reply fall back to single-item requests.
+        """
+        chat = chat or self.chat
+        pack_size = pack_size or self.pack_size
+        results = [None for _ in range(len(items))]
+        groups = [
+            list(range(start, min(start + pack_size, len(items))))
+            for start in range(0, len(items), pack_size)
+        ]
+        groups = [group for group in groups if len(group) > 1]
+        if groups:
+            replies = await chat.async_run(
+                [packed_messages([items[i] for i in group]) for group in groups],
+                List,
+                packed_schema,
+            )
+            for group, reply in zip(groups, replies):
+                for entry in reply or []:
+                    if (
+                        not isinstance(entry, dict)
+                        or not isinstance(entry.get("index"), int)
+                        or not 0 <= entry["index"] < len(group)
+                    ):
+                        continue
+                    item_index = group[entry["index"]]
+                    if results[item_index] is None:
+                        results[item_index] = unpack(
+                            {
+                                key: value
+                                for key, value in entry.items()
+                                if key != "index"
+                            }
+                        )
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            fallback = await chat.async_run(
+                [single_messages(items[i]) for i in missing], expected_type, schema
+            )
+            for i, result in zip(missing, fallback):
+                results[i] = result
+        return results
+
+    @abstractmethod
+    def _self_check_messages(self, fewshot, item):
+        """Messages asking the model to judge dataset item without search, see run_self_check_live."""
+
+    async def run_self_check_dataset_bulk(
+        self,
+        annotated_dataset_path: str,
+        self_check_classified_dataset_path: str,
+        work_dir: str,
+        fewshot: bool = False,
+        backend=None,
+        poll_interval: float = 30,
+    ):
+        """run_self_check_dataset, with every claim sent in one batch, see factsearch.utils.batch_backend.
+
+        Run it again with the same work_dir to resume an interrupted run.
+        """
+        with open(annotated_dataset_path, "r") as f:
+            data = [json.loads(line) for line in f]
+        self.sample_list = [claim for sample in data for claim in sample["claims"]]
+
+        runner = BulkRunner(self.chat, work_dir, backend, poll_interval)
+        responses = await runner.run_stage(
+            "self_check",
+            # the annotation must not leak into the prompt
+            {
+                str(i): self._self_check_messages(
+                    fewshot, {k: v for k, v in item.items() if k != "label"}
+                )
+                for i, item in enumerate(self.sample_list)
+            },
+            Dict,
+            schemas.SELF_CHECK,
+        )
+        for i, item in enumerate(self.sample_list):
+            response = responses.get(str(i))
+            item.update(
+                {
+                    "self_check_classification": response.get("factuality", "None")
+                    if response is not None
+                    else "None",
+                    "self_check_reasoning": response.get("reasoning", "None")
+                    if response is not None
+                    else "None",
+                }
+            )
+
+        with open(self_check_classified_dataset_path, "w") as f:
+            for item in self.sample_list:
+                f.write(json.dumps(item) + "\n")
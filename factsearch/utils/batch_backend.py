@@ -0,0 +1,380 @@
+"""Offline bulk submission of LLM requests, for dataset runs where throughput and cost matter more than latency.
+
+BulkRunner writes every prompt of a stage to a JSONL request file in the shape of
+the OpenAI Batch API, hands it to a batch backend, polls until the batch is done
+and reads the replies back by custom id. Each stage keeps its files in its own
+directory under the work directory, so an interrupted run picks up where it
+stopped: finished stages are read from disk and a submitted batch is polled
+again instead of being sent twice.
+
+Backends:
+    OpenAIBatchBackend: the OpenAI Batch API (/files and /batches), over plain HTTP
+        since the pinned openai client predates it.
+    LocalBatchBackend: processes the request file with an ordinary chat object and
+        writes the output file the Batch API would, for local models and testing.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+import aiohttp
+
+from factsearch.utils import metrics
+from factsearch.utils.http_pool import get_session
+from factsearch.utils.ollama_wrapper import OllamaChat
+from factsearch.utils.openai_wrapper import OpenAIChat
+from factsearch.utils.utils_json import parse_json_output
+
+# batch states after which nothing changes any more; expired batches still have partial output
+TERMINAL_STATES = ("completed", "failed", "expired", "cancelled")
+
+
+def _read_jsonl(path):
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _write_jsonl(path, rows):
+    """Write rows to path atomically, so a crash never leaves half a file behind."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+    os.replace(tmp_path, path)
+
+
+def _content(line):
+    """Reply text of one output line, or None for a failed request."""
+    response = line.get("response") or {}
+    if response.get("status_code") != 200:
+        return None
+    choices = response.get("body", {}).get("choices") or [{}]
+    return choices[0].get("message", {}).get("content")
+
+
+class OpenAIBatchBackend:
+    """OpenAI Batch API: upload the request file, create a batch, download its output.
+
+    Args:
+        api_key: Defaults to OPENAI_API_KEY.
+        api_base: Defaults to OPENAI_API_BASE or the public API.
+        completion_window: How long OpenAI may take, only '24h' is accepted today.
+    """
+
+    def __init__(self, api_key=None, api_base=None, completion_window="24h"):
+        self.api_key = api_key or os.environ.get("OPENAI_API_KEY")
+        assert self.api_key, "Please set the OPENAI_API_KEY environment variable."
+        self.api_base = (
+            api_base or os.environ.get("OPENAI_API_BASE") or "https://api.openai.com/v1"
+        ).rstrip("/")
+        self.completion_window = completion_window
+
+    def _headers(self):
+        return {"Authorization": f"Bearer {self.api_key}"}
+
+    async def _request(self, method, path, **kwargs):
+        async with get_session(self.api_base).request(
+            method,
+            self.api_base + path,
+            headers=self._headers(),
+            timeout=aiohttp.ClientTimeout(total=300),
+            **kwargs,
+        ) as response:
+            if response.status != 200:
+                raise RuntimeError(
+                    f"OpenAI {method} {path} failed with status {response.status}: {await response.text()}"
+                )
+            if response.content_type == "application/json":
+                return await response.json()
+            return await response.text()
+
+    async def submit(self, request_path):
+        """Upload request_path and start a batch on it; returns the batch id."""
+        form = aiohttp.FormData()
+        form.add_field("purpose", "batch")
+        with open(request_path, "rb") as f:
+            form.add_field("file", f, filename=os.path.basename(request_path))
+            uploaded = await self._request("POST", "/files", data=form)
+        batch = await self._request(
+            "POST",
+            "/batches",
+            json={
+                "input_file_id": uploaded["id"],
+                "endpoint": "/v1/chat/completions",
+                "completion_window": self.completion_window,
+            },
+        )
+        return batch["id"]
+
+    async def status(self, batch_id):
+        """(state, request counts) of the batch, see TERMINAL_STATES."""
+        batch = await self._request("GET", f"/batches/{batch_id}")
+        return batch["status"], batch.get("request_counts", {})
+
+    async def fetch(self, batch_id, output_path):
+        """Write the output lines of a finished batch to output_path, failed requests included."""
+        batch = await self._request("GET", f"/batches/{batch_id}")
+        rows = []
+        for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+            if file_id:
+                text = await self._request("GET", f"/files/{file_id}/content")
+                rows += [json.loads(line) for line in text.splitlines() if line.strip()]
+        _write_jsonl(output_path, rows)
+
+
+class LocalBatchBackend:
+    """Stand-in for the Batch API that runs a request file through a chat object.
+
+    Batches live in directory as <batch id>/input.jsonl and output.jsonl. The
+    output grows chunk by chunk, so a batch interrupted with the process carries
+    on from the last finished chunk when it is polled again.
+
+    Args:
+        chat: OllamaChat or OpenAIChat that sends the requests.
+        directory: Where the batch files are kept.
+        chunk_size: Requests sent at once; the chat's limiters pace them further.
+    """
+
+    def __init__(self, chat, directory, chunk_size=256):
+        self.chat = chat
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self._tasks = {}
+
+    def _path(self, batch_id, name):
+        return os.path.join(self.directory, batch_id, name)
+
+    async def submit(self, request_path):
+        batch_id = f"local_batch_{uuid.uuid4().hex[:12]}"
+        os.makedirs(os.path.join(self.directory, batch_id))
+        _write_jsonl(self._path(batch_id, "input.jsonl"), _read_jsonl(request_path))
+        self._tasks[batch_id] = asyncio.ensure_future(self._process(batch_id))
+        return batch_id
+
+    async def _dispatch(self, messages_list, schema):
+        if isinstance(self.chat, OllamaChat):
+            return await self.chat.dispatch_ollama_requests(
+                messages_list, schema=schema
+            )
+        responses = await self.chat.dispatch_openai_requests(
+            messages_list, schema=schema
+        )
+        return [
+            response["choices"][0]["message"]["content"]
+            if response is not None
+            else None
+            for response in responses
+        ]
+
+    async def _process(self, batch_id):
+        requests = _read_jsonl(self._path(batch_id, "input.jsonl"))
+        output_path = self._path(batch_id, "output.jsonl")
+        rows = _read_jsonl(output_path) if os.path.exists(output_path) else []
+        done = {row["custom_id"] for row in rows}
+        pending = [request for request in requests if request["custom_id"] not in done]
+        for start in range(0, len(pending), self.chunk_size):
+            chunk = pending[start : start + self.chunk_size]
+            # requests of one stage share a schema, but nothing here relies on it
+            by_schema = {}
+            for request in chunk:
+                schema = (
+                    request["body"]
+                    .get("response_format", {})
+                    .get("json_schema", {})
+                    .get("schema")
+                )
+                by_schema.setdefault(json.dumps(schema), []).append(request)
+            for schema, group in by_schema.items():
+                texts = await self._dispatch(
+                    [request["body"]["messages"] for request in group],
+                    json.loads(schema),
+                )
+                for request, text in zip(group, texts):
+                    rows.append(
+                        {
+                            "id": f'{batch_id}_{request["custom_id"]}',
+                            "custom_id": request["custom_id"],
+                            "response": {
+                                "status_code": 200,
+                                "body": {"choices": [{"message": {"content": text}}]},
+                            }
+                            if text is not None
+                            else None,
+                            "error": None
+                            if text is not None
+                            else {"message": "request failed"},
+                        }
+                    )
+            _write_jsonl(output_path, rows)
+
+    async def status(self, batch_id):
+        task = self._tasks.get(batch_id)
+        if task is None:
+            # submitted by an earlier process; pick the work up again
+            task = self._tasks[batch_id] = asyncio.ensure_future(
+                self._process(batch_id)
+            )
+        if not task.done():
+            return "in_progress", {}
+        if task.cancelled():
+            # the rows written so far are kept; asking again resumes the rest
+            del self._tasks[batch_id]
+            return "cancelled", {}
+        if task.exception() is not None:
+            logging.error(f"Local batch {batch_id} failed: {task.exception()}")
+            return "failed", {}
+        return "completed", {}
+
+    async def fetch(self, batch_id, output_path):
+        _write_jsonl(output_path, _read_jsonl(self._path(batch_id, "output.jsonl")))
+
+
+def make_batch_backend(chat, work_dir):
+    """Batch API for OpenAI's hosted models, the local stand-in for everything else."""
+    if isinstance(chat, OpenAIChat) and "gpt" in chat.config["model_name"]:
+        return OpenAIBatchBackend(api_key=chat.api_key)
+    return LocalBatchBackend(chat, os.path.join(work_dir, "local_batches"))
+
+
+class BulkRunner:
+    """Runs LLM stages as batches, stage by stage, with results kept in work_dir.
+
+    Args:
+        chat: Chat whose model and settings the requests use.
+        work_dir: Directory for request, output and result files; reuse it to resume.
+        backend: Batch backend, defaults to make_batch_backend(chat, work_dir).
+        poll_interval: Seconds between status checks of a running batch.
+    """
+
+    def __init__(self, chat, work_dir, backend=None, poll_interval=30):
+        self.chat = chat
+        self.work_dir = work_dir
+        self.backend = backend or make_batch_backend(chat, work_dir)
+        self.poll_interval = poll_interval
+        os.makedirs(work_dir, exist_ok=True)
+
+    def _path(self, stage, name):
+        return os.path.join(self.work_dir, stage, name)
+
+    def load(self, stage):
+        """Results of a finished stage as {custom id: result}, or None if it has not finished."""
+        path = self._path(stage, "results.jsonl")
+        if not os.path.exists(path):
+            return None
+        return {row["custom_id"]: row["result"] for row in _read_jsonl(path)}
+
+    def save(self, stage, results):
+        """Mark stage finished with results, {custom id: result}."""
+        os.makedirs(os.path.join(self.work_dir, stage), exist_ok=True)
+        _write_jsonl(
+            self._path(stage, "results.jsonl"),
+            [{"custom_id": key, "result": value} for key, value in results.items()],
+        )
+
+    def _body(self, messages, schema):
+        if isinstance(self.chat, OpenAIChat):
+            return self.chat._request_body(messages, schema)
+        # Ollama also serves this shape on /v1/chat/completions
+        body = {
+            "model": self.chat.config["model_name"],
+            "messages": messages,
+            "temperature": self.chat.config["temperature"],
+            "max_tokens": self.chat.config["max_tokens"],
+        }
+        if schema is not None:
+            body["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "response", "schema": schema},
+            }
+        return body
+
+    async def run_stage(self, stage, messages_by_id, expected_type, schema=None):
+        """Send every prompt of a stage as one batch and parse the replies.
+
+        Args:
+            stage: Name of the stage, also its directory and its metrics stage.
+            messages_by_id: {custom id: messages}; ids must be strings.
+            expected_type: Type each reply must parse to.
+            schema: JSON schema of a reply.
+
+        Returns:
+            {custom id: parsed reply, or None if the request failed or did not parse}.
+        """
+        # the local backend sends its requests from tasks started in here, they inherit the stage
+        with metrics.stage(stage):
+            return await self._run_stage(stage, messages_by_id, expected_type, schema)
+
+    async def _run_stage(self, stage, messages_by_id, expected_type, schema):
+        results = self.load(stage)
+        if results is not None:
+            logging.info(f"{stage}: already finished, {len(results)} results loaded")
+            return results
+
+        os.makedirs(os.path.join(self.work_dir, stage), exist_ok=True)
+        batch_path = self._path(stage, "batch.json")
+        if os.path.exists(batch_path):
+            with open(batch_path, "r") as f:
+                batch_id = json.load(f)["batch_id"]
+            logging.info(f"{stage}: resuming batch {batch_id}")
+        else:
+            request_path = self._path(stage, "requests.jsonl")
+            _write_jsonl(
+                request_path,
+                [
+                    {
+                        "custom_id": key,
+                        "method": "POST",
+                        "url": "/v1/chat/completions",
+                        "body": self._body(messages, schema),
+                    }
+                    for key, messages in messages_by_id.items()
+                ],
+            )
+            batch_id = await self.backend.submit(request_path)
+            with open(batch_path, "w") as f:
+                json.dump({"batch_id": batch_id, "submitted_at": time.time()}, f)
+            logging.info(
+                f"{stage}: submitted {len(messages_by_id)} requests as batch {batch_id}"
+            )
+
+        while True:
+            state, counts = await self.backend.status(batch_id)
+            if state in TERMINAL_STATES:
+                break
+            logging.info(f"{stage}: batch {batch_id} {state} {counts}")
+            await asyncio.sleep(self.poll_interval)
+        if state == "failed":
+            raise RuntimeError(
+                f"Batch {batch_id} of stage {stage} failed; delete {batch_path} to submit it again"
+            )
+
+        output_path = self._path(stage, "output.jsonl")
+        await self.backend.fetch(batch_id, output_path)
+        results = dict.fromkeys(messages_by_id)
+        for line in _read_jsonl(output_path):
+            if line.get("custom_id") not in results:
+                continue
+            usage = ((line.get("response") or {}).get("body") or {}).get("usage")
+            if usage:
+                # the local backend's requests were already accounted by the chat that sent them
+                metrics.record_call(
+                    "batch",
+                    self.chat.config["model_name"],
+                    prompt_tokens=usage.get("prompt_tokens"),
+                    completion_tokens=usage.get("completion_tokens"),
+                )
+            content = _content(line)
+            results[line["custom_id"]] = (
+                parse_json_output(content, expected_type, schema)
+                if content is not None
+                else None
+            )
+        failed = sum(result is None for result in results.values())
+        logging.info(
+            f"{stage}: batch {batch_id} {state}, {len(results) - failed} results, {failed} failed"
+        )
+        self.save(stage, results)
+        return results
@@ -0,0 +1,578 @@
+"""Shared concurrency control for the backends the pipelines talk to."""
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+
+class AdaptiveLimiter:
+    """AIMD limit on the number of in-flight requests to one backend.
+
+    The limit grows additively while requests come back quickly and cleanly, and
+    is cut multiplicatively on overload signals (429s, 5xx, timeouts) or when
+    latency climbs well above the best latency seen so far. Waiters are plain
+    futures on the running loop, so one limiter can be shared across the
+    asyncio.run calls made by Factool.run.
+    """
+
+    def __init__(
+        self,
+        name,
+        initial_limit=4,
+        min_limit=1,
+        max_limit=64,
+        backoff=0.5,
+        latency_tolerance=2.0,
+        cooldown=1.0,
+    ):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._in_flight = 0
+        self._waiters = deque()
+        self._last_decrease = 0.0
+        self._latency_ewma = None
+        self._latency_floor = None
+        self._successes = 0
+        self._overloads = 0
+        self._errors = 0
+
+    @property
+    def limit(self):
+        return max(self.min_limit, int(self._limit))
+
+    def configure(self, initial_limit=None, min_limit=None, max_limit=None):
+        if min_limit is not None:
+            self.min_limit = min_limit
+        if max_limit is not None:
+            self.max_limit = max_limit
+        if initial_limit is not None:
+            self._limit = float(initial_limit)
+        self._limit = float(max(self.min_limit, min(self._limit, self.max_limit)))
+        self._wake()
+
+    async def acquire(self):
+        while self._in_flight >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    # we were woken but will not take the slot, pass it on
+                    self._wake()
+                raise
+        self._in_flight += 1
+
+    def release(self, latency, outcome="ok"):
+        """Give back a slot and adjust the limit.
+
+        Args:
+            latency: Seconds the request took.
+            outcome: 'ok', 'overload' (429/5xx/timeout), 'error' (anything that
+                says nothing about backend load) or 'cancelled' (given up on
+                before it finished, e.g. a hedge that lost; it is not counted).
+        """
+        self._in_flight -= 1
+        if outcome == "cancelled":
+            pass
+        elif outcome == "overload":
+            self._overloads += 1
+            self._decrease()
+        elif outcome == "ok":
+            self._successes += 1
+            self._observe_latency(latency)
+        else:
+            self._errors += 1
+        self._wake()
+
+    def _observe_latency(self, latency):
+        if self._latency_ewma is None:
+            self._latency_ewma = latency
+            self._latency_floor = latency
+        else:
+            self._latency_ewma = 0.8 * self._latency_ewma + 0.2 * latency
+            # let the floor drift up slowly so one lucky request does not pin it
+            self._latency_floor = min(latency, self._latency_floor * 1.01)
+
+        if (
+            self.latency_tolerance
+            and self._latency_ewma > 0.05
+            and self._latency_ewma > self._latency_floor * self.latency_tolerance
+        ):
+            self._decrease()
+        else:
+            # roughly +1 per round trip of the whole window
+            self._limit = min(self.max_limit, self._limit + 1.0 / max(self._limit, 1.0))
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self._limit = max(float(self.min_limit), self._limit * self.backoff)
+
+    def _wake(self):
+        free = self.limit - self._in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done() and not waiter.get_loop().is_closed():
+                waiter.set_result(None)
+                free -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one slot for the duration of a request.
+
+        Timeouts raised inside the block count as overload, and a cancelled
+        request counts as nothing: its partial latency must not grow the limit.
+        Call ticket.overloaded() for 429/5xx responses and ticket.failed() for
+        other failures that should not grow the limit.
+        """
+        await self.acquire()
+        ticket = _Ticket()
+        start = time.monotonic()
+        try:
+            yield ticket
+        except asyncio.TimeoutError:
+            ticket.overloaded()
+            raise
+        except asyncio.CancelledError:
+            ticket.outcome = "cancelled"
+            raise
+        except Exception:
+            if ticket.outcome == "ok":
+                ticket.failed()
+            raise
+        finally:
+            self.release(time.monotonic() - start, ticket.outcome)
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "in_flight": self._in_flight,
+            "waiting": len(self._waiters),
+            "latency_ewma": self._latency_ewma,
+            "successes": self._successes,
+            "overloads": self._overloads,
+            "errors": self._errors,
+        }
+
+
+class _Ticket:
+    def __init__(self):
+        self.outcome = "ok"
+
+    def overloaded(self):
+        self.outcome = "overload"
+
+    def failed(self):
+        self.outcome = "error"
+
+
+def is_overload_status(status):
+    return status == 429 or status >= 500
+
+
+# defaults per backend; local servers start low, hosted APIs can take more.
+# Chat latency depends mostly on output length, so it is only used as a
+# congestion signal with a wide tolerance (ollama) or not at all (openai).
+_LIMITER_DEFAULTS = {
+    "openai": {"initial_limit": 8, "max_limit": 64, "latency_tolerance": None},
+    "ollama": {"initial_limit": 2, "max_limit": 16, "latency_tolerance": 4.0},
+    "searxng": {"initial_limit": 3, "max_limit": 16, "latency_tolerance": 3.0},
+    "embeddings": {"initial_limit": 8, "max_limit": 64, "latency_tolerance": 3.0},
+}
+
+_limiters = {}
+
+
+def get_limiter(name):
+    """Return the process-wide limiter for a backend, creating it on first use."""
+    if name not in _limiters:
+        _limiters[name] = AdaptiveLimiter(name, **_LIMITER_DEFAULTS.get(name, {}))
+    return _limiters[name]
+
+
+def limiter_stats():
+    """Current limits and load of every backend limiter, for monitoring."""
+    return {name: limiter.stats() for name, limiter in _limiters.items()}
+
+
+class SingleFlight:
+    """Share one in-flight call between concurrent callers asking for the same key.
+
+    The first caller runs the coroutine; callers arriving while it is still
+    running await the same result instead of sending a duplicate request.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        while True:
+            call = self._calls.get(key)
+            if call is None or call.get_loop().is_closed():
+                break
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(call)
+            except asyncio.CancelledError:
+                # the caller that owned the request was cancelled, try again ourselves
+                if call.cancelled():
+                    continue
+                raise
+
+        call = asyncio.get_running_loop().create_future()
+        self._calls[key] = call
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        except Exception as e:
+            call.set_exception(e)
+            call.exception()  # followers re-raise it, do not warn when there are none
+            raise
+        finally:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.set_result(result)
+        return result
+
+
+class TokenBucket:
+    """Budget of capacity units that refills continuously over period seconds.
+
+    The level may go negative when a caller takes more than was estimated; the
+    debt is paid back by the refill before anything else is admitted.
+    """
+
+    def __init__(self, capacity, period=60.0):
+        self.capacity = float(capacity)
+        self.period = period
+        self._level = self.capacity
+        self._updated = time.monotonic()
+
+    @property
+    def rate(self):
+        return self.capacity / self.period
+
+    def _refill(self):
+        now = time.monotonic()
+        self._level = min(
+            self.capacity, self._level + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def wait_time(self, amount):
+        """Seconds until amount units are available (0 if they are now)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self._level) / self.rate)
+
+    def take(self, amount):
+        self._refill()
+        self._level -= amount
+
+    def resize(self, capacity):
+        self._refill()
+        self._level = min(self._level, float(capacity))
+        self.capacity = float(capacity)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute budget for one model.
+
+    Callers are admitted one at a time in arrival order once both buckets hold
+    enough budget, so a burst is spread out at the provider's limit instead of
+    firing at once and collecting 429s. penalize() stops all admissions for the
+    time a 429's Retry-After asks for. Like AdaptiveLimiter, waiters are plain
+    futures, so one instance serves every event loop in the process.
+    """
+
+    def __init__(self, name, rpm=None, tpm=None):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self._blocked_until = 0.0
+        self._waiters = deque()
+        self._admitted = 0
+        self._throttled = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def configure(self, rpm=None, tpm=None):
+        if rpm:
+            if self.requests is None:
+                self.requests = TokenBucket(rpm)
+            self.requests.resize(rpm)
+        if tpm:
+            if self.tokens is None:
+                self.tokens = TokenBucket(tpm)
+            self.tokens.resize(tpm)
+
+    def _delay(self, tokens):
+        delay = self._blocked_until - time.monotonic()
+        if self.requests is not None:
+            delay = max(delay, self.requests.wait_time(1))
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.wait_time(tokens))
+        return delay
+
+    def _wake_head(self):
+        while self._waiters:
+            head = self._waiters[0]
+            if head.get_loop().is_closed():
+                self._waiters.popleft()
+                continue
+            if not head.done():
+                head.set_result(None)
+            return
+
+    async def acquire(self, tokens=1):
+        """Wait until one request of about tokens tokens fits in the budget, then take it."""
+        start = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        if self._waiters[0] is waiter:
+            waiter.set_result(None)
+        try:
+            await waiter
+            while True:
+                delay = self._delay(tokens)
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            self._wake_head()
+
+        waited = time.monotonic() - start
+        self._admitted += 1
+        self._total_wait += waited
+        self._max_wait = max(self._max_wait, waited)
+
+    def settle(self, estimated, actual):
+        """Correct the token bucket once the real usage of a request is known."""
+        if self.tokens is not None and actual is not None:
+            self.tokens.take(actual - estimated)
+
+    def penalize(self, retry_after):
+        """Admit nothing for retry_after seconds, e.g. after a 429."""
+        self._throttled += 1
+        self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+    def stats(self):
+        return {
+            "rpm": self.requests.capacity if self.requests is not None else None,
+            "tpm": self.tokens.capacity if self.tokens is not None else None,
+            "queue_depth": len(self._waiters),
+            "admitted": self._admitted,
+            "throttled": self._throttled,
+            "avg_wait": self._total_wait / self._admitted if self._admitted else 0.0,
+            "max_wait": self._max_wait,
+        }
+
+
+class AdaptivePacer(RateLimiter):
+    """RateLimiter admitting requests at a rate per second that backs off when the upstream struggles.
+
+    Up to burst requests go out at once, after that one every 1/rate seconds.
+    slow_down() cuts the rate (at most once per cooldown) when a reply shows
+    trouble, e.g. suspended engines or empty results, and every clean reply wins
+    back a fraction of the configured rate.
+
+    Args:
+        name: Label used in stats.
+        rate: Requests per second when all is well.
+        burst: Requests admitted back to back after an idle spell.
+        min_rate: Floor of the rate while backing off.
+        backoff: Factor the rate is multiplied with on slow_down().
+        recovery: Fraction of rate added back on every speed_up().
+        cooldown: Seconds after a slow_down() in which further ones are ignored,
+            since the requests already in flight report the same trouble.
+    """
+
+    def __init__(
+        self,
+        name,
+        rate,
+        burst=1,
+        min_rate=0.1,
+        backoff=0.5,
+        recovery=0.05,
+        cooldown=2.0,
+    ):
+        super().__init__(name)
+        self.max_rate = float(rate)
+        self.min_rate = min(min_rate, self.max_rate)
+        self.backoff = backoff
+        self.recovery = recovery
+        self.cooldown = cooldown
+        self.requests = TokenBucket(burst, period=burst / self.max_rate)
+        self._last_slow_down = 0.0
+        self._slow_downs = 0
+
+    @property
+    def rate(self):
+        return self.requests.rate
+
+    def _set_rate(self, rate):
+        self.requests._refill()
+        self.requests.period = self.requests.capacity / max(
+            self.min_rate, min(self.max_rate, rate)
+        )
+
+    def configure(self, rate=None, burst=None):
+        if burst is not None:
+            rate_now = self.rate
+            self.requests.resize(burst)
+            self._set_rate(rate_now)
+        if rate is not None:
+            # keep the current fraction of the old ceiling
+            fraction = self.rate / self.max_rate
+            self.max_rate = float(rate)
+            self.min_rate = min(self.min_rate, self.max_rate)
+            self._set_rate(rate * fraction)
+
+    def slow_down(self):
+        now = time.monotonic()
+        if now - self._last_slow_down < self.cooldown:
+            return
+        self._last_slow_down = now
+        self._slow_downs += 1
+        self._set_rate(self.rate * self.backoff)
+
+    def speed_up(self):
+        if self.rate < self.max_rate:
+            self._set_rate(self.rate + self.recovery * self.max_rate)
+
+    def stats(self):
+        return {
+            "rate": self.rate,
+            "max_rate": self.max_rate,
+            "burst": self.requests.capacity,
+            "slow_downs": self._slow_downs,
+            "queue_depth": len(self._waiters),
+            "admitted": self._admitted,
+            "avg_wait": self._total_wait / self._admitted if self._admitted else 0.0,
+            "max_wait": self._max_wait,
+        }
+
+
+def retry_after_seconds(headers):
+    """Delay a 429 asks for via Retry-After / Retry-After-Ms, or None."""
+    if not headers:
+        return None
+    headers = {key.lower(): value for key, value in dict(headers).items()}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def estimate_tokens(messages, max_tokens=0):
+    """Rough token count of a request the way providers count it against TPM:
+    the prompt (about 4 characters a token) plus the completion budget."""
+    if isinstance(messages, str):
+        chars = len(messages)
+    else:
+        chars = sum(len(str(message.get("content", ""))) for message in messages)
+    return chars // 4 + 1 + max_tokens
+
+
+# requests and tokens per minute by model name prefix, matching the default
+# OpenAI tier; override with FACTSEARCH_RATE_LIMITS, e.g. '{"gpt-5": [500, 500000]}'
+_RATE_LIMIT_DEFAULTS = {
+    "gpt-5": (500, 500000),
+    "gpt-4": (500, 30000),
+    "gpt-3.5": (3500, 200000),
+    "text-embedding": (3000, 1000000),
+}
+
+_rate_limiters = {}
+_rate_share = 1.0
+
+
+def _rate_limits_for(model):
+    limits = {
+        **_RATE_LIMIT_DEFAULTS,
+        **json.loads(os.environ.get("FACTSEARCH_RATE_LIMITS", "{}")),
+    }
+    for prefix in sorted(limits, key=len, reverse=True):
+        if model.startswith(prefix):
+            return limits[prefix]
+    return None
+
+
+def get_rate_limiter(model):
+    """Process-wide RateLimiter for model, or None for models without a known limit (e.g. local servers)."""
+    if model not in _rate_limiters:
+        limits = _rate_limits_for(model)
+        if limits is None:
+            return None
+        rpm, tpm = limits
+        _rate_limiters[model] = RateLimiter(
+            model,
+            rpm=rpm * _rate_share if rpm else None,
+            tpm=tpm * _rate_share if tpm else None,
+        )
+    return _rate_limiters[model]
+
+
+def set_rate_share(share):
+    """Scale every rate limit to share of the provider limit, for processes that split one API key.
+
+    Pacers are scaled too, the processes share the search backends as well.
+    """
+    global _rate_share
+    _rate_share = share
+    for model, limiter in _rate_limiters.items():
+        rpm, tpm = _rate_limits_for(model)
+        limiter.configure(
+            rpm=rpm * share if rpm else None, tpm=tpm * share if tpm else None
+        )
+    for name, pacer in _pacers.items():
+        pacer.configure(rate=_pacers_configured[name] * share)
+
+
+_pacers = {}
+# rate each pacer was created with, before the share is applied
+_pacers_configured = {}
+
+
+def get_pacer(name, rate, burst=1):
+    """Process-wide AdaptivePacer for a backend; rate and burst only apply when it is created."""
+    if name not in _pacers:
+        _pacers_configured[name] = rate
+        _pacers[name] = AdaptivePacer(name, rate * _rate_share, burst)
+    return _pacers[name]
+
+
+def pacer_stats():
+    """Current rate and waits of every pacer, for monitoring."""
+    return {name: pacer.stats() for name, pacer in _pacers.items()}
+
+
+def rate_limiter_stats():
+    """Budget, queue depth and wait times of every rate limiter, for monitoring."""
+    return {name: limiter.stats() for name, limiter in _rate_limiters.items()}
@@ -0,0 +1,203 @@
+"""Small SQLite-backed caches that survive between runs.
+
+SQLite calls block, so code on an event loop uses the a-prefixed methods, which
+run them in the loop's default executor; the batch variants take a whole
+batch of keys in one trip and one transaction.
+"""
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+def make_key(obj):
+    """Content hash of any JSON-serialisable object."""
+    return hashlib.sha256(
+        json.dumps(obj, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+class DiskCache:
+    """Key/value store in SQLite with a per-entry TTL and LRU eviction.
+
+    Values are stored as JSON. get() returns None on a miss, so None itself is
+    never cached. Safe to use from several threads.
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600, max_entries=100000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)"
+        )
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                yield
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _get(self, key, now):
+        # called with _lock held
+        row = self._conn.execute(
+            "SELECT value, expires_at FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        if row[1] < now:
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.misses += 1
+            return None
+        self._conn.execute(
+            "UPDATE entries SET last_access = ? WHERE key = ?", (now, key)
+        )
+        self.hits += 1
+        return json.loads(row[0])
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        """Value of every key, None for misses, looked up in one transaction."""
+        now = time.time()
+        with self._transaction():
+            values = [self._get(key, now) for key in keys]
+        return values
+
+    def set(self, key, value, ttl=None):
+        self.set_many([(key, value)], ttl)
+
+    def set_many(self, items, ttl=None):
+        """Store (key, value) pairs in one transaction, all with the same ttl."""
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        rows = [
+            (key, json.dumps(value, ensure_ascii=False), expires_at, now)
+            for key, value in items
+        ]
+        if not rows:
+            return
+        with self._transaction():
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO entries (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            writes, self._writes = self._writes, self._writes + len(rows)
+            # checking the size on every write is wasted work, do it on the first and every 100th
+            if writes == 0 or writes // 100 != self._writes // 100:
+                self._evict(now)
+
+    async def _in_executor(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(method, *args)
+        )
+
+    async def aget(self, key):
+        """get() without blocking the event loop."""
+        return await self._in_executor(self.get, key)
+
+    async def aget_many(self, keys):
+        """get_many() without blocking the event loop."""
+        return await self._in_executor(self.get_many, keys)
+
+    async def aset(self, key, value, ttl=None):
+        """set() without blocking the event loop."""
+        await self._in_executor(self.set, key, value, ttl)
+
+    async def aset_many(self, items, ttl=None):
+        """set_many() without blocking the event loop."""
+        await self._in_executor(self.set_many, items, ttl)
+
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM entries WHERE expires_at < ?", (now,))
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY last_access ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM entries")
+
+    def stats(self):
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+_llm_cache = None
+
+
+def get_llm_cache():
+    """Process-wide LLM response cache, enabled by setting FACTSEARCH_LLM_CACHE to a file path.
+
+    FACTSEARCH_LLM_CACHE_TTL (seconds) and FACTSEARCH_LLM_CACHE_MAX_ENTRIES tune it.
+    """
+    global _llm_cache
+    path = os.environ.get("FACTSEARCH_LLM_CACHE")
+    if not path:
+        return None
+    if _llm_cache is None or _llm_cache.path != path:
+        _llm_cache = DiskCache(
+            path,
+            ttl=float(os.environ.get("FACTSEARCH_LLM_CACHE_TTL", 30 * 24 * 3600)),
+            max_entries=int(os.environ.get("FACTSEARCH_LLM_CACHE_MAX_ENTRIES", 200000)),
+        )
+    return _llm_cache
+
+
+_search_cache = None
+
+
+def get_search_cache():
+    """Process-wide search result cache, enabled by setting FACTSEARCH_SEARCH_CACHE to a file path.
+
+    FACTSEARCH_SEARCH_CACHE_TTL (seconds) and FACTSEARCH_SEARCH_CACHE_MAX_ENTRIES tune it.
+    """
+    global _search_cache
+    path = os.environ.get("FACTSEARCH_SEARCH_CACHE")
+    if not path:
+        return None
+    if _search_cache is None or _search_cache.path != path:
+        _search_cache = DiskCache(
+            path,
+            ttl=float(os.environ.get("FACTSEARCH_SEARCH_CACHE_TTL", 7 * 24 * 3600)),
+            max_entries=int(
+                os.environ.get("FACTSEARCH_SEARCH_CACHE_MAX_ENTRIES", 100000)
+            ),
+        )
+    return _search_cache
@@ -0,0 +1,360 @@
+"""Pools of interchangeable inference endpoints serving the same model.
+
+Requests go to the healthy endpoint with the fewest outstanding requests. An
+endpoint that keeps failing (connection errors, timeouts, 5xx) is ejected for a
+while, and a retry goes to another replica. Once the ejection runs out the
+endpoint is back on probation: one more failure ejects it again, for longer.
+
+Each endpoint also caps the requests it has in flight at the number the server
+processes in parallel (OLLAMA_NUM_PARALLEL / VLLM_MAX_NUM_SEQS), so extra requests
+wait on the client instead of in the server's queue, where they would run into
+the request timeout. Time spent queued on each side is reported separately.
+
+Endpoints are configured per model with FACTSEARCH_ENDPOINTS, a JSON object of
+model name -> list of base URLs, or per backend with OLLAMA_ENDPOINTS,
+VLLM_ENDPOINTS and SEARXNG_URLS (comma separated base URLs).
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import aiohttp
+
+from factsearch.utils.concurrency import AdaptiveLimiter
+from factsearch.utils.http_pool import get_session
+
+DEFAULT_ENDPOINTS = {
+    "ollama": "http://localhost:11434",
+    "vllm": "http://localhost:8000/v1",
+    "openai": "https://api.openai.com/v1",
+    "searxng": "http://localhost:8888",
+}
+
+# env var with the number of requests a server of the backend runs at once, and its default;
+# hosted APIs are left to the backend limiters
+PARALLELISM = {
+    "ollama": ("OLLAMA_NUM_PARALLEL", 4),
+    "vllm": ("VLLM_MAX_NUM_SEQS", 64),
+}
+
+# path probed by health checks, relative to the endpoint's base URL
+HEALTH_PATHS = {
+    "ollama": "/api/tags",
+    "vllm": "/models",
+    "openai": "/models",
+    "searxng": "/config",
+}
+
+# environment variables listing the endpoints of a backend, the first one set wins
+ENDPOINT_ENV = {
+    "ollama": ("OLLAMA_ENDPOINTS",),
+    "vllm": ("VLLM_ENDPOINTS",),
+    "openai": ("OPENAI_API_BASE",),
+    "searxng": ("SEARXNG_URLS", "SEARXNG_URL"),
+}
+
+
+class Endpoint:
+    def __init__(self, url, max_parallel=None):
+        self.url = url.rstrip("/")
+        self.max_parallel = None
+        self.slots = None
+        self.set_max_parallel(max_parallel)
+        self.outstanding = 0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.latency_ewma = None
+        # recent latencies, for percentiles
+        self.latencies = deque(maxlen=200)
+        self.client_wait = 0.0
+        self.server_queue = 0.0
+        self.server_queue_samples = 0
+
+    def set_max_parallel(self, max_parallel):
+        self.max_parallel = max_parallel
+        if not max_parallel:
+            self.slots = None
+        elif self.slots is None:
+            # fixed-size limiter used as a semaphore that works across event loops
+            self.slots = AdaptiveLimiter(
+                self.url,
+                initial_limit=max_parallel,
+                min_limit=max_parallel,
+                max_limit=max_parallel,
+                latency_tolerance=None,
+            )
+        else:
+            self.slots.configure(
+                initial_limit=max_parallel,
+                min_limit=max_parallel,
+                max_limit=max_parallel,
+            )
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.ejected_until
+
+    def stats(self):
+        return {
+            "outstanding": self.outstanding,
+            "healthy": self.healthy,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "latency_ewma": self.latency_ewma,
+            "max_parallel": self.max_parallel,
+            "in_flight": self.slots.stats()["in_flight"]
+            if self.slots is not None
+            else None,
+            "avg_client_wait": self.client_wait / self.requests
+            if self.requests
+            else 0.0,
+            "avg_server_queue": self.server_queue / self.server_queue_samples
+            if self.server_queue_samples
+            else None,
+        }
+
+
+class EndpointPool:
+    """Least-outstanding-requests routing over the endpoints of one model.
+
+    Args:
+        name: Label used in logs and stats.
+        urls: Base URLs of the replicas.
+        health_path: Path requested by check_health(), relative to each URL.
+        max_failures: Consecutive failures that eject an endpoint.
+        eject_time: Seconds of the first ejection; each further ejection doubles it.
+        health_interval: Minimum seconds between background health checks.
+        max_parallel: Requests each endpoint is sent at once, None for no cap.
+    """
+
+    def __init__(
+        self,
+        name,
+        urls,
+        health_path=None,
+        max_failures=3,
+        eject_time=30.0,
+        health_interval=30.0,
+        max_parallel=None,
+    ):
+        self.name = name
+        self.endpoints = [Endpoint(url, max_parallel) for url in urls]
+        self.health_path = health_path
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.health_interval = health_interval
+        self._last_check = None
+        self._health_task = None
+        # when the last round of health probes finished, None before the first one
+        self.checked_at = None
+        # HealthMonitor probing this pool from a thread, if any; it replaces maybe_check_health
+        self.monitor = None
+        # guards the failure and ejection state, which a HealthMonitor updates from its own thread
+        self._health_lock = threading.Lock()
+
+    def pick(self, exclude=()):
+        """Endpoint to send the next request to, avoiding the ones in exclude if possible."""
+        candidates = [
+            endpoint for endpoint in self.endpoints if endpoint not in exclude
+        ] or self.endpoints
+        healthy = [endpoint for endpoint in candidates if endpoint.healthy]
+        if not healthy:
+            # everything is ejected; try the one that is due back soonest rather than fail outright
+            return min(candidates, key=lambda endpoint: endpoint.ejected_until)
+        return min(
+            healthy,
+            key=lambda endpoint: (endpoint.outstanding, endpoint.latency_ewma or 0.0),
+        )
+
+    @asynccontextmanager
+    async def use(self, exclude=(), endpoint=None):
+        """Hold an outstanding request on endpoint, or on the one chosen by pick().
+
+        Waits for one of the endpoint's parallel slots first; requests waiting
+        for a slot count as outstanding, so routing steers away from a backlog.
+        """
+        self.maybe_check_health()
+        endpoint = endpoint or self.pick(exclude)
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        try:
+            if endpoint.slots is None:
+                yield endpoint
+            else:
+                async with endpoint.slots.slot():
+                    yield endpoint
+        finally:
+            endpoint.outstanding -= 1
+
+    def record_queue_times(self, endpoint, client_wait, server_queue=None):
+        """Account time a request waited for a slot on our side and, when the server reports it, on its side."""
+        endpoint.client_wait += client_wait
+        if server_queue is not None:
+            endpoint.server_queue += server_queue
+            endpoint.server_queue_samples += 1
+
+    def report_success(self, endpoint, latency):
+        with self._health_lock:
+            endpoint.failures = 0
+            endpoint.ejections = 0
+        self.report_latency(endpoint, latency)
+
+    def report_latency(self, endpoint, latency):
+        """Account a latency without judging the request, e.g. a lower bound for one given up on."""
+        endpoint.latencies.append(latency)
+        if endpoint.latency_ewma is None:
+            endpoint.latency_ewma = latency
+        else:
+            endpoint.latency_ewma = 0.8 * endpoint.latency_ewma + 0.2 * latency
+
+    def latency_percentile(self, percentile, min_samples=20):
+        """percentile (0-1) of the recent latencies of all endpoints, None until min_samples were seen."""
+        latencies = sorted(
+            latency for endpoint in self.endpoints for latency in endpoint.latencies
+        )
+        if len(latencies) < min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(percentile * len(latencies)))]
+
+    def report_failure(self, endpoint):
+        with self._health_lock:
+            if not endpoint.healthy:
+                # requests sent before the ejection are still failing, that is no news
+                return
+            endpoint.failures += 1
+            # an endpoint back from ejection gets a single chance
+            if endpoint.failures >= self.max_failures or endpoint.ejections:
+                self._eject(endpoint)
+
+    def _eject(self, endpoint):
+        # called with _health_lock held
+        duration = min(600.0, self.eject_time * 2**endpoint.ejections)
+        endpoint.ejections += 1
+        endpoint.failures = 0
+        endpoint.ejected_until = time.monotonic() + duration
+        if len(self.endpoints) > 1:
+            logging.warning(
+                f"{self.name}: ejecting {endpoint.url} for {duration:.0f} seconds"
+            )
+
+    async def _probe(self, endpoint):
+        try:
+            async with get_session(endpoint.url).get(
+                endpoint.url + self.health_path, timeout=aiohttp.ClientTimeout(total=5)
+            ) as response:
+                # anything but a server error means the server is up, e.g. a 401 without a key
+                return response.status < 500
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def check_health(self):
+        """Probe every endpoint, ejecting the unreachable ones and readmitting the ones that recovered."""
+        self._last_check = time.monotonic()
+        if self.health_path is None:
+            return
+        results = await asyncio.gather(
+            *[self._probe(endpoint) for endpoint in self.endpoints]
+        )
+        with self._health_lock:
+            for endpoint, ok in zip(self.endpoints, results):
+                if ok and not endpoint.healthy:
+                    endpoint.ejected_until = 0.0
+                    logging.info(f"{self.name}: {endpoint.url} is back")
+                elif not ok and endpoint.healthy:
+                    logging.warning(f"{self.name}: cannot connect to {endpoint.url}")
+                    self._eject(endpoint)
+            self.checked_at = time.time()
+
+    def maybe_check_health(self):
+        """Start a background health check on the running loop if the last one is old enough."""
+        if (
+            len(self.endpoints) < 2
+            or self.health_path is None
+            or self.monitor is not None
+        ):
+            return
+        if (
+            self._last_check is not None
+            and time.monotonic() - self._last_check < self.health_interval
+        ):
+            return
+        self._last_check = time.monotonic()
+        self._health_task = asyncio.ensure_future(self.check_health())
+
+    def set_max_parallel(self, max_parallel):
+        for endpoint in self.endpoints:
+            endpoint.set_max_parallel(max_parallel)
+
+    def stats(self):
+        return {endpoint.url: endpoint.stats() for endpoint in self.endpoints}
+
+
+def _split_urls(value):
+    return [url.strip() for url in value.split(",") if url.strip()]
+
+
+def endpoint_urls(backend, model):
+    """Configured base URLs for model on backend ('ollama', 'vllm', 'openai' or 'searxng')."""
+    per_model = json.loads(os.environ.get("FACTSEARCH_ENDPOINTS", "{}"))
+    if model in per_model:
+        urls = per_model[model]
+        return _split_urls(urls) if isinstance(urls, str) else list(urls)
+    for env_name in ENDPOINT_ENV.get(backend, ()):
+        if os.environ.get(env_name):
+            return _split_urls(os.environ[env_name])
+    return [DEFAULT_ENDPOINTS[backend]]
+
+
+def server_parallelism(backend):
+    """Requests one server of backend processes at once, or None when it is not capped."""
+    if backend not in PARALLELISM:
+        return None
+    env_name, default = PARALLELISM[backend]
+    return int(os.environ.get(env_name, default))
+
+
+def _shared_parallelism(backend):
+    parallel = server_parallelism(backend)
+    return max(1, int(parallel * _parallel_share)) if parallel else None
+
+
+_pools = {}
+# part of each server's parallel slots this process may use, see set_parallel_share
+_parallel_share = 1.0
+
+
+def set_parallel_share(share):
+    """Cap every endpoint at share of its server's parallel slots, for processes that use the same servers."""
+    global _parallel_share
+    _parallel_share = share
+    for (backend, _, _), pool in _pools.items():
+        pool.set_max_parallel(_shared_parallelism(backend))
+
+
+def get_endpoint_pool(backend, model, urls=None):
+    """Process-wide pool for model on backend, so every chat object shares the outstanding counts.
+
+    urls, if given, replaces the configured endpoints.
+    """
+    key = (backend, model, tuple(urls) if urls else None)
+    if key not in _pools:
+        _pools[key] = EndpointPool(
+            f"{backend}:{model}",
+            urls or endpoint_urls(backend, model),
+            health_path=HEALTH_PATHS.get(backend),
+            max_parallel=_shared_parallelism(backend),
+        )
+    return _pools[key]
+
+
+def endpoint_stats():
+    """Per-endpoint load and health of every pool, for monitoring."""
+    return {pool.name: pool.stats() for pool in _pools.values()}
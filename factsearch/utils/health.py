@@ -0,0 +1,110 @@
+"""Background health checks of an endpoint pool, whose result can be read without waiting on the network.
+
+The state lives in the EndpointPool itself: a failed probe ejects the endpoint
+and a successful one readmits it, exactly as the pool's own checks do, so
+routing and anyone asking whether the service is up see the same thing.
+"""
+import asyncio
+import logging
+import threading
+
+from factsearch.utils.http_pool import close_sessions
+
+
+class HealthMonitor:
+    """Runs the health checks of pool from a daemon thread every interval seconds.
+
+    For callers without an event loop of their own, such as the Streamlit app;
+    code running on a loop gets the pool's own checks on that loop. Nothing
+    happens until start() (or refresh()) is called, and stop() ends the
+    thread. Reading the state never blocks: healthy is None until the first
+    round of probes has finished. While running, the monitor replaces the
+    pool's own checks on the request path.
+
+    Args:
+        pool: EndpointPool to probe, see EndpointPool.check_health.
+        interval: Seconds between rounds of probes.
+    """
+
+    def __init__(self, pool, interval=30.0):
+        self.pool = pool
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._stopped.clear()
+                self.pool.monitor = self
+                self._thread = threading.Thread(
+                    target=self._loop, name=f"{self.pool.name} health", daemon=True
+                )
+                self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stop the background thread, waiting up to timeout seconds for a round in progress, and hand the checks back to the pool."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._stopped.set()
+            self._wake.set()
+            if self.pool.monitor is self:
+                self.pool.monitor = None
+        thread.join(timeout)
+
+    async def _check(self):
+        try:
+            await self.pool.check_health()
+        finally:
+            # the sessions belong to this round's loop
+            await close_sessions()
+
+    def check(self):
+        """Probe every endpoint now, on the calling thread, and update the pool."""
+        asyncio.run(self._check())
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            try:
+                self.check()
+            except Exception as e:
+                logging.error(f"{self.pool.name}: health check failed: {e}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def refresh(self):
+        """Ask the background thread for a new round of probes right away."""
+        self.start()
+        self._wake.set()
+
+    @property
+    def healthy(self):
+        """True if any endpoint of the pool is healthy, False if none is, None before the first round."""
+        if self.pool.checked_at is None:
+            return None
+        return any(endpoint.healthy for endpoint in self.pool.endpoints)
+
+    def status(self):
+        """Pool state and when it was last probed, without probing."""
+        return {
+            "healthy": self.healthy,
+            "checked_at": self.pool.checked_at,
+            "instances": self.pool.stats(),
+        }
+
+
+_monitors = {}
+_monitors_lock = threading.Lock()
+
+
+def get_health_monitor(pool, interval=30.0):
+    """Process-wide HealthMonitor of pool, so every caller shares one probing thread."""
+    with _monitors_lock:
+        if id(pool) not in _monitors:
+            _monitors[id(pool)] = HealthMonitor(pool, interval)
+        return _monitors[id(pool)]
@@ -0,0 +1,53 @@
+"""Long-lived aiohttp sessions shared by every client talking to the same host.
+
+aiohttp sessions belong to the event loop they were created on, so sessions are
+kept per running loop and per origin (scheme://host:port): every loop gets its
+own, and no client owns one. Whoever owns the loop should await close_sessions()
+before it shuts down.
+
+Every session has the same connection settings. They only cap the connections
+to a host; how many requests run at once is up to the backend limiters and
+endpoint slots, which stay well below CONNECTION_LIMIT.
+"""
+import asyncio
+import weakref
+from urllib.parse import urlsplit
+
+import aiohttp
+
+# max open connections per session, and seconds an idle connection is kept for reuse
+CONNECTION_LIMIT = 100
+KEEPALIVE_TIMEOUT = 60
+
+_sessions = weakref.WeakKeyDictionary()
+
+
+def _origin(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def get_session(url):
+    """Return the pooled session for url's origin on the running loop, creating it if needed.
+
+    Args:
+        url: Any URL on the host, only its origin is used as the key.
+    """
+    loop = asyncio.get_running_loop()
+    sessions = _sessions.setdefault(loop, {})
+    origin = _origin(url)
+    session = sessions.get(origin)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=CONNECTION_LIMIT, keepalive_timeout=KEEPALIVE_TIMEOUT
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        sessions[origin] = session
+    return session
+
+
+async def close_sessions():
+    """Close every pooled session that belongs to the running loop."""
+    sessions = _sessions.pop(asyncio.get_running_loop(), {})
+    for session in sessions.values():
+        await session.close()
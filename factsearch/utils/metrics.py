@@ -0,0 +1,158 @@
+"""Per-stage accounting of LLM and search calls.
+
+The backends call record_call() after every request they complete. The call is
+added to every UsageRecorder active in the current context (see recording()),
+tagged with the pipeline stage set by stage(). Both are context variables, so
+they follow the asyncio tasks a pipeline spawns: a per-run recorder opened by
+Factool and a per-sample recorder opened around each sample see exactly the
+calls made on their behalf, even while many samples run on the same loop.
+"""
+import contextvars
+from collections import defaultdict
+from contextlib import contextmanager
+
+_stage = contextvars.ContextVar("factsearch_stage", default=None)
+_recorders = contextvars.ContextVar("factsearch_recorders", default=())
+
+# USD per million prompt / completion tokens by model name prefix; local models cost nothing
+PRICES = {
+    "gpt-5-nano": (0.05, 0.40),
+    "gpt-5-mini": (0.25, 2.00),
+    "gpt-5": (1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4": (30.00, 60.00),
+    "gpt-3.5": (0.50, 1.50),
+    "text-embedding-ada-002": (0.10, 0.0),
+}
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    """Estimated USD cost of a call, 0.0 for models without a known price."""
+    for prefix in sorted(PRICES, key=len, reverse=True):
+        if model.startswith(prefix):
+            prompt_price, completion_price = PRICES[prefix]
+            return (
+                (prompt_tokens or 0) * prompt_price
+                + (completion_tokens or 0) * completion_price
+            ) / 1e6
+    return 0.0
+
+
+def current_stage():
+    return _stage.get()
+
+
+@contextmanager
+def stage(name):
+    """Tag the calls made inside the block (and the tasks it starts) with stage name."""
+    token = _stage.set(name)
+    try:
+        yield
+    finally:
+        _stage.reset(token)
+
+
+@contextmanager
+def recording(recorder):
+    """Add recorder to the recorders receiving the calls made inside the block."""
+    token = _recorders.set(_recorders.get() + (recorder,))
+    try:
+        yield recorder
+    finally:
+        _recorders.reset(token)
+
+
+def record_call(
+    backend,
+    model=None,
+    wall_time=0.0,
+    queue_time=0.0,
+    prompt_tokens=None,
+    completion_tokens=None,
+):
+    """Account one completed request to every active recorder."""
+    recorders = _recorders.get()
+    if not recorders:
+        return
+    call = {
+        "stage": _stage.get() or "other",
+        "backend": backend,
+        "wall_time": wall_time,
+        "queue_time": queue_time,
+        "prompt_tokens": prompt_tokens or 0,
+        "completion_tokens": completion_tokens or 0,
+        "cost": estimate_cost(model, prompt_tokens, completion_tokens)
+        if model
+        else 0.0,
+    }
+    for recorder in recorders:
+        recorder.add(call)
+
+
+class UsageRecorder:
+    """Totals of calls, time, tokens and cost per stage."""
+
+    _FIELDS = (
+        "calls",
+        "wall_time",
+        "queue_time",
+        "prompt_tokens",
+        "completion_tokens",
+        "cost",
+    )
+
+    def __init__(self):
+        self.stages = defaultdict(lambda: dict.fromkeys(self._FIELDS, 0))
+
+    def add(self, call):
+        totals = self.stages[call["stage"]]
+        # a call shared with other recorders counts as its share, see SharedRecorder
+        totals["calls"] += call.get("share", 1)
+        for field in self._FIELDS[1:]:
+            totals[field] += call[field]
+
+    def merge(self, other):
+        for name, other_totals in other.stages.items():
+            totals = self.stages[name]
+            for field in self._FIELDS:
+                totals[field] += other_totals[field]
+
+    def summary(self):
+        """{'stages': {stage: totals}, 'total': totals}; wall times of concurrent calls add up."""
+        stages = {name: dict(totals) for name, totals in self.stages.items()}
+        total = dict.fromkeys(self._FIELDS, 0)
+        for totals in stages.values():
+            for field in self._FIELDS:
+                total[field] += totals[field]
+        return {"stages": stages, "total": total}
+
+
+class SharedRecorder:
+    """Splits every call between recorders by weight.
+
+    For requests made on behalf of several samples at once, e.g. a packed
+    request for claims of different responses: each sample's recorder gets its
+    share of the call, time, tokens and cost.
+
+    Args:
+        weighted: (recorder, weight) pairs, e.g. the number of claims of each sample.
+    """
+
+    def __init__(self, weighted):
+        self.weighted = list(weighted)
+
+    def add(self, call):
+        total = sum(weight for _, weight in self.weighted)
+        for recorder, weight in self.weighted:
+            share = weight / total
+            recorder.add(
+                {
+                    **call,
+                    **{
+                        field: call[field] * share
+                        for field in UsageRecorder._FIELDS[1:]
+                    },
+                    "share": call.get("share", 1) * share,
+                }
+            )
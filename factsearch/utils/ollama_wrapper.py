@@ -1,115 +1,338 @@
 import asyncio
-import aiohttp
-import ast
+import json
+import logging
 import os
+import threading
+import time
 from typing import List
 
+import aiohttp
+import requests
+
+from factsearch.utils import metrics
+from factsearch.utils.concurrency import (
+    estimate_tokens,
+    get_limiter,
+    is_overload_status,
+)
+from factsearch.utils.disk_cache import get_llm_cache, make_key
+from factsearch.utils.endpoints import get_endpoint_pool
+from factsearch.utils.http_pool import close_sessions, get_session
+from factsearch.utils.utils_json import JsonStreamScanner, parse_json_output
+
+# largest num_ctx sent so far per model. Ollama reloads a model whenever num_ctx
+# changes, so the context only ever grows and every request uses the current size
+_context_sizes = {}
+# (model, endpoint URL) -> num_ctx a warm-up loaded the model with, so each server is warmed up once
+_warmed = {}
+# both are updated from warm-up threads as well as from the event loop
+_context_lock = threading.Lock()
 
-class OllamaChat():
+
+class OllamaChat:
     def __init__(
         self,
-        model_name='qwen3:8b',
+        model_name="qwen3:8b",
         max_tokens=2500,
         temperature=1,
         request_timeout=120,
+        cache=None,
+        bypass_cache=False,
+        stream=True,
+        endpoints=None,
+        keep_alive=None,
+        min_ctx=4096,
+        max_ctx=32768,
     ):
         self.config = {
-            'model_name': model_name,
-            'max_tokens': max_tokens,
-            'temperature': temperature,
-            'request_timeout': request_timeout,
-            'base_url': 'http://localhost:11434/api/chat'
+            "model_name": model_name,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "request_timeout": request_timeout,
+            "chat_path": "/api/chat",
+            # stream replies and hang up as soon as the expected JSON value is complete
+            "stream": stream,
+            # how long Ollama keeps the model loaded after the last request
+            "keep_alive": keep_alive or os.environ.get("OLLAMA_KEEP_ALIVE", "30m"),
+            # num_ctx is sized from the prompts, in powers of two between these bounds
+            "min_ctx": min_ctx,
+            "max_ctx": max_ctx,
         }
+        self.limiter = get_limiter("ollama")
+        # Ollama servers serving this model; endpoints (base URLs) overrides OLLAMA_ENDPOINTS / FACTSEARCH_ENDPOINTS
+        self.endpoints = get_endpoint_pool("ollama", model_name, endpoints)
+        # replies cut short because the JSON answer was already complete
+        self.early_stops = 0
+        # parsed responses cached on disk, see get_llm_cache; bypass_cache skips lookups but still stores
+        self.cache = cache if cache is not None else get_llm_cache()
+        self.bypass_cache = bypass_cache
 
-    def _boolean_fix(self, output):
-        """Convert JSON boolean strings to Python booleans"""
-        return output.replace("true", "True").replace("false", "False")
-    
-    def _strip_thinking(self, output: str) -> str:
-        import re 
-        return re.sub(r'<think>.*?</think>', '', output, flags=re.DOTALL).strip()
+    def _cache_key(self, messages, expected_type, schema=None):
+        return make_key(
+            {
+                "backend": "ollama",
+                "model": self.config["model_name"],
+                "messages": messages,
+                "temperature": self.config["temperature"],
+                "max_tokens": self.config["max_tokens"],
+                "expected_type": str(expected_type),
+                "schema": schema,
+            }
+        )
 
-    def _type_check(self, output, expected_type):
-        try:
-            output_eval = ast.literal_eval(output)
-            if not isinstance(output_eval, expected_type):
-                return None
-            return output_eval
-        except:
-            # Fallback: try to extract just the list/dict portion
+    def _session(self, endpoint):
+        """Pooled session of the running loop, shared with every client of the same server.
+
+        The chat does not own it; the loop's owner closes it with http_pool.close_sessions().
+        """
+        return get_session(endpoint.url)
+
+    def context_size(self, prompt_tokens):
+        """num_ctx for prompts of about prompt_tokens tokens plus the completion budget, rounded up to a power of two.
+
+        The result never drops below what earlier requests used (see _context_sizes),
+        so a batch of short prompts does not make Ollama reload the model.
+        """
+        model = self.config["model_name"]
+        # estimate_tokens counts 4 characters a token, leave some room for text that tokenizes worse
+        need = int((prompt_tokens + self.config["max_tokens"]) * 1.2)
+        size = self.config["min_ctx"]
+        while size < need and size < self.config["max_ctx"]:
+            size *= 2
+        size = min(size, self.config["max_ctx"])
+        if need > size:
+            logging.warning(
+                f"Prompt of about {need} tokens does not fit num_ctx {size} of {model} and may be truncated"
+            )
+        with _context_lock:
+            size = max(size, _context_sizes.get(model, 0))
+            _context_sizes[model] = size
+        return size
+
+    def _context_size(self, messages_list):
+        """num_ctx for a batch, sized for its longest prompt, see context_size."""
+        return self.context_size(
+            max(estimate_tokens(messages) for messages in messages_list)
+        )
+
+    def _claim_warm_up(self, prompt_tokens):
+        """Context size for prompt_tokens, and the endpoints not yet warmed up with it, which are marked as warmed."""
+        num_ctx = self.context_size(prompt_tokens)
+        model = self.config["model_name"]
+        endpoints = []
+        with _context_lock:
+            for endpoint in self.endpoints.endpoints:
+                if _warmed.get((model, endpoint.url), 0) < num_ctx:
+                    _warmed[(model, endpoint.url)] = num_ctx
+                    endpoints.append(endpoint)
+        return num_ctx, endpoints
+
+    def _load(self, num_ctx, endpoints):
+        model = self.config["model_name"]
+        payload = {
+            "model": model,
+            "keep_alive": self.config["keep_alive"],
+            "options": {"num_ctx": num_ctx},
+        }
+        for endpoint in endpoints:
             try:
-                if expected_type == list:
-                    start, end = output.find('['), output.rfind(']')
-                else:
-                    start, end = output.find('{'), output.rfind('}')
-                if start != -1 and end != -1 and start < end:
-                    output_eval = ast.literal_eval(output[start:end+1])
-                    if isinstance(output_eval, expected_type):
-                        return output_eval
-            except:
-                pass
+                # a generate request without a prompt only loads the model
+                requests.post(
+                    endpoint.url + "/api/generate",
+                    json=payload,
+                    timeout=self.config["request_timeout"],
+                )
+            except requests.RequestException as e:
+                logging.warning(f"Could not warm up {model} on {endpoint.url}: {e}")
+                with _context_lock:
+                    # let a later warm-up try again
+                    _warmed.pop((model, endpoint.url), None)
+
+    def warm_up(self, prompt_tokens=0):
+        """Load the model on every endpoint with the context that prompts of about prompt_tokens tokens need.
+
+        Sizing the context for the largest prompt the caller will send keeps Ollama
+        from reloading the model as prompts grow. Endpoints already loaded with that
+        context by an earlier warm-up, from any chat, are skipped.
+        """
+        self._load(*self._claim_warm_up(prompt_tokens))
+
+    def start_warm_up(self, prompt_tokens=0):
+        """Run warm_up() in a background thread and return the thread, or None if there is nothing to load."""
+        num_ctx, endpoints = self._claim_warm_up(prompt_tokens)
+        if not endpoints:
+            return None
+        thread = threading.Thread(
+            target=self._load,
+            args=(num_ctx, endpoints),
+            name=f"warm-up {self.config['model_name']}",
+            daemon=True,
+        )
+        thread.start()
+        return thread
+
+    async def _read_stream(self, response, expected_type, schema=None):
+        """Read an NDJSON chat stream, stopping once a complete value of expected_type (and schema) arrived.
+
+        Closing the response early drops the connection, which makes Ollama stop
+        generating. Returns the reply text with <think> blocks removed, and the
+        final chunk (with Ollama's timings) if the stream ran to the end.
+        """
+        scanner = JsonStreamScanner(expected_type, schema)
+        async for line in response.content:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            if "error" in data:
+                raise RuntimeError(data["error"])
+            if scanner.feed(data.get("message", {}).get("content", "")):
+                if not data.get("done"):
+                    self.early_stops += 1
+                    response.close()
+                    return scanner.text, None
+                return scanner.text, data
+            if data.get("done"):
+                return scanner.text, data
+        return scanner.text, None
+
+    def _server_queue(self, data, elapsed):
+        """Seconds a request waited inside Ollama: wall time minus the time Ollama spent on it.
+
+        Unknown (None) when the stream was cut short before the final chunk.
+        """
+        if not data or "total_duration" not in data:
             return None
+        return max(0.0, elapsed - data["total_duration"] / 1e9)
 
-    async def _single_request(self, messages, retry=3):
-        """Make a single request to Ollama API with retry logic"""
+    async def _single_request(
+        self, messages, retry=3, schema=None, expected_type=None, num_ctx=None
+    ):
+        """Make a single request to Ollama API with retry logic
+
+        schema, if given, is sent as `format` so Ollama constrains decoding to it.
+        num_ctx is the context size, see _context_size.
+        With streaming on and an expected_type, the generation is cut off as soon as
+        the reply holds a complete value of that type.
+        """
+        stream = self.config["stream"] and expected_type is not None
         modified_messages = []
         for msg in messages:
-            if msg['role'] == 'system':
-                modified_messages.append({
-                    'role': 'system',
-                    'content': msg['content'] + '\n/no_think'
-                })
+            if msg["role"] == "system":
+                modified_messages.append(
+                    {"role": "system", "content": msg["content"] + "\n/no_think"}
+                )
             else:
                 modified_messages.append(msg)
         payload = {
-            'model': self.config['model_name'],
-            'messages': messages,
-            'stream': False,
-            'options': {
-                'temperature': self.config['temperature'],
-                'num_predict': self.config['max_tokens']
-            }
+            "model": self.config["model_name"],
+            "messages": modified_messages,
+            "stream": stream,
+            "keep_alive": self.config["keep_alive"],
+            "options": {
+                "temperature": self.config["temperature"],
+                "num_predict": self.config["max_tokens"],
+                "num_ctx": num_ctx or self._context_size([messages]),
+            },
         }
-        
+        if schema is not None:
+            payload["format"] = schema
+
+        tried = []
         for attempt in range(retry):
-            try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        self.config['base_url'],
-                        json=payload,
-                        timeout=aiohttp.ClientTimeout(total=self.config['request_timeout'])
-                    ) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            return data['message']['content']
-                        else:
-                            print(f'Ollama request failed with status {response.status}')
-                            if attempt < retry - 1:
-                                await asyncio.sleep(1)
-            except asyncio.TimeoutError:
-                print(f'Ollama timeout error (attempt {attempt + 1}/{retry}), waiting...')
-                if attempt < retry - 1:
-                    await asyncio.sleep(1)
-            except Exception as e:
-                print(f'Ollama request error (attempt {attempt + 1}/{retry}): {e}')
-                if attempt < retry - 1:
-                    await asyncio.sleep(1)
-        
+            queued = time.monotonic()
+            # a retry goes to another replica when there is one; waits for one of its parallel slots
+            async with self.endpoints.use(exclude=tried) as endpoint:
+                tried.append(endpoint)
+                try:
+                    async with self.limiter.slot() as ticket:
+                        start = time.monotonic()
+                        async with self._session(endpoint).post(
+                            endpoint.url + self.config["chat_path"],
+                            json=payload,
+                            timeout=aiohttp.ClientTimeout(
+                                total=self.config["request_timeout"]
+                            ),
+                        ) as response:
+                            if response.status == 200:
+                                if stream:
+                                    content, data = await self._read_stream(
+                                        response, expected_type, schema
+                                    )
+                                else:
+                                    data = await response.json()
+                                    content = data["message"]["content"]
+                                elapsed = time.monotonic() - start
+                                self.endpoints.report_success(endpoint, elapsed)
+                                self.endpoints.record_queue_times(
+                                    endpoint,
+                                    start - queued,
+                                    self._server_queue(data, elapsed),
+                                )
+                                # a stream stopped early has no counts, estimate them
+                                metrics.record_call(
+                                    "ollama",
+                                    self.config["model_name"],
+                                    elapsed,
+                                    start - queued,
+                                    (data or {}).get(
+                                        "prompt_eval_count",
+                                        estimate_tokens(modified_messages),
+                                    ),
+                                    (data or {}).get(
+                                        "eval_count", estimate_tokens(content)
+                                    ),
+                                )
+                                return content
+                            if is_overload_status(response.status):
+                                ticket.overloaded()
+                            else:
+                                ticket.failed()
+                    if response.status >= 500:
+                        self.endpoints.report_failure(endpoint)
+                    logging.warning(
+                        f"Ollama request to {endpoint.url} failed with status {response.status}"
+                    )
+                except asyncio.TimeoutError:
+                    self.endpoints.report_failure(endpoint)
+                    logging.warning(
+                        f"Ollama timeout error from {endpoint.url} (attempt {attempt + 1}/{retry})"
+                    )
+                except aiohttp.ClientConnectionError as e:
+                    self.endpoints.report_failure(endpoint)
+                    logging.warning(
+                        f"Ollama connection error to {endpoint.url} (attempt {attempt + 1}/{retry}): {e}"
+                    )
+                except Exception as e:
+                    logging.error(
+                        f"Ollama request error (attempt {attempt + 1}/{retry}): {e}"
+                    )
+            if attempt < retry - 1:
+                await asyncio.sleep(1)
+
         return None
 
-    async def dispatch_ollama_requests(self, messages_list):
-        """Dispatch multiple requests to Ollama in parallel"""
-        tasks = [self._single_request(messages) for messages in messages_list]
+    async def dispatch_ollama_requests(
+        self, messages_list, schema=None, expected_type=None
+    ):
+        """Dispatch multiple requests to Ollama in parallel, all with the same context size"""
+        num_ctx = self._context_size(messages_list) if messages_list else None
+        tasks = [
+            self._single_request(
+                messages, schema=schema, expected_type=expected_type, num_ctx=num_ctx
+            )
+            for messages in messages_list
+        ]
         return await asyncio.gather(*tasks)
 
-    async def async_run(self, messages_list, expected_type):
+    async def async_run(self, messages_list, expected_type, schema=None):
         """
         Main entry point matching OpenAIChat interface.
-        
+
         Args:
             messages_list: List of message lists to send to Ollama
             expected_type: Expected return type (list or dict)
-            
+            schema: Optional JSON schema of the reply, see factsearch.utils.schemas
+
         Returns:
             List of parsed responses matching expected_type
         """
@@ -117,17 +340,29 @@ class OllamaChat():
         responses = [None for _ in range(len(messages_list))]
         messages_list_cur_index = [i for i in range(len(messages_list))]
 
+        if self.cache is not None:
+            cache_keys = [
+                self._cache_key(messages, expected_type, schema)
+                for messages in messages_list
+            ]
+            if not self.bypass_cache:
+                # one lookup for the whole batch, off the event loop
+                responses = await self.cache.aget_many(cache_keys)
+                messages_list_cur_index = [
+                    i for i in messages_list_cur_index if responses[i] is None
+                ]
+
         while retry > 0 and len(messages_list_cur_index) > 0:
-            print(f'{retry} retry left...')
             messages_list_cur = [messages_list[i] for i in messages_list_cur_index]
-            
+
             predictions = await self.dispatch_ollama_requests(
                 messages_list=messages_list_cur,
+                schema=schema,
+                expected_type=expected_type,
             )
 
             preds = [
-                self._type_check(self._boolean_fix(self._strip_thinking(prediction)), expected_type) 
-                if prediction is not None else None 
+                parse_json_output(prediction, expected_type, schema)
                 for prediction in predictions
             ]
 
@@ -136,31 +371,41 @@ class OllamaChat():
                 if pred is not None:
                     responses[messages_list_cur_index[i]] = pred
                     finished_index.append(messages_list_cur_index[i])
-            
+            if self.cache is not None:
+                await self.cache.aset_many(
+                    [(cache_keys[i], responses[i]) for i in finished_index]
+                )
+
             messages_list_cur_index = [
-                i for i in messages_list_cur_index 
-                if i not in finished_index
+                i for i in messages_list_cur_index if i not in finished_index
             ]
-            
+
             retry -= 1
-        
+
         return responses
 
 
 # For testing
 if __name__ == "__main__":
+
     async def test_ollama():
-        chat = OllamaChat(model_name='qwen3:8b')
-        
+        chat = OllamaChat(model_name="qwen3:8b")
+
         # Test list output
         messages_list = [
             [
                 {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": "Return a JSON list with two items: ['apple', 'banana']. Only return the JSON, nothing else."}
+                {
+                    "role": "user",
+                    "content": "Return a JSON list with two items: ['apple', 'banana']. Only return the JSON, nothing else.",
+                },
             ]
         ]
-        
-        results = await chat.async_run(messages_list, list)
+
+        try:
+            results = await chat.async_run(messages_list, list)
+        finally:
+            await close_sessions()
         print(f"Test results: {results}")
-    
-    asyncio.run(test_ollama())
\ No newline at end of file
+
+    asyncio.run(test_ollama())
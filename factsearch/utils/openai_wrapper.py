@@ -2,224 +2,430 @@
 
 from __future__ import annotations
 
-import os
-import yaml
-import openai
-import ast
-import pdb
 import asyncio
-from typing import Any, List
+import logging
 import os
 import pathlib
-import openai
+import pdb
+import random
 import re
+import time
+from typing import Any, List
+
+import openai
+import yaml
+
+from factsearch.utils import metrics
+from factsearch.utils.concurrency import (
+    estimate_tokens,
+    get_limiter,
+    get_rate_limiter,
+    retry_after_seconds,
+)
+from factsearch.utils.disk_cache import get_llm_cache, make_key
+from factsearch.utils.endpoints import get_endpoint_pool
+from factsearch.utils.utils_json import parse_json_output
 
+logger = logging.getLogger(__name__)
 
 # from factsearch.env_config import factool_env_config
 
 # env
 # openai.api_key = factool_env_config.openai_api_key
 
-class OpenAIChat():
+
+class OpenAIChat:
     def __init__(
-            self,
-            model_name='gpt-5',
-            max_tokens=2500,
-            temperature=0,
-            top_p=1,
-            request_timeout=120,
+        self,
+        model_name="gpt-5",
+        max_tokens=2500,
+        temperature=0,
+        top_p=1,
+        request_timeout=120,
+        cache=None,
+        bypass_cache=False,
+        endpoints=None,
     ):
-        if 'gpt' not in model_name:
-            openai.api_base = "http://localhost:8000/v1"
+        if "gpt" not in model_name:
+            # local OpenAI-compatible servers (vLLM) do not check the key, but the client wants one
+            self.api_key = os.environ.get("OPENAI_API_KEY") or "EMPTY"
+            backend = "vllm"
         else:
-            #openai.api_base = "https://api.openai.com/v1"
+            backend = "openai"
             openai.api_key = os.environ.get("OPENAI_API_KEY", None)
-            assert openai.api_key is not None, "Please set the OPENAI_API_KEY environment variable."
-            assert openai.api_key !='', "Please set the OPENAI_API_KEY environment variable."
+            assert (
+                openai.api_key is not None
+            ), "Please set the OPENAI_API_KEY environment variable."
+            assert (
+                openai.api_key != ""
+            ), "Please set the OPENAI_API_KEY environment variable."
+            self.api_key = openai.api_key
 
-        if model_name.startswith('gpt-5') or model_name.startswith('o1'):
+        if model_name.startswith("gpt-5") or model_name.startswith("o1"):
             temperature = 1
 
         self.config = {
-            'model_name': model_name,
-            'max_tokens': max_tokens,
-            'temperature': temperature,
-            'top_p': top_p,
-            'request_timeout': request_timeout,
+            "model_name": model_name,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "request_timeout": request_timeout,
+            # send stage schemas as response_format; a request the server rejects it for is retried without
+            "structured_output": True,
         }
+        self.limiter = get_limiter("openai")
+        # api bases serving this model, passed per request instead of setting the global openai.api_base;
+        # endpoints (base URLs) overrides VLLM_ENDPOINTS / OPENAI_API_BASE / FACTSEARCH_ENDPOINTS
+        self.endpoints = get_endpoint_pool(backend, model_name, endpoints)
+        # requests/tokens per minute budget shared by every OpenAIChat on this model; None for local servers
+        self.rate_limiter = (
+            get_rate_limiter(model_name) if "gpt" in model_name else None
+        )
+        # parsed responses cached on disk, see get_llm_cache; bypass_cache skips lookups but still stores
+        self.cache = cache if cache is not None else get_llm_cache()
+        self.bypass_cache = bypass_cache
+
+    def _cache_key(self, messages, expected_type, schema=None):
+        return make_key(
+            {
+                "backend": "openai",
+                "model": self.config["model_name"],
+                "messages": messages,
+                "temperature": self.config["temperature"],
+                "top_p": self.config["top_p"],
+                "max_tokens": self.config["max_tokens"],
+                "expected_type": str(expected_type),
+                "schema": schema,
+            }
+        )
+
+    def _response_format(self, schema):
+        """Structured output parameter for schema.
+
+        Structured output needs an object at the top level, so list schemas are
+        wrapped in {"items": ...}; parse_json_output unwraps them again.
+        """
+        if schema.get("type") != "object":
+            schema = {
+                "type": "object",
+                "properties": {"items": schema},
+                "required": ["items"],
+            }
+        return {
+            "type": "json_schema",
+            "json_schema": {"name": "response", "schema": schema},
+        }
+
+    def _request_body(self, messages, schema=None):
+        """Chat completion parameters for messages, also the body of a Batch API request."""
+        body = {
+            "model": self.config["model_name"],
+            "messages": messages,
+            "temperature": self.config["temperature"],
+            "top_p": self.config["top_p"],
+        }
+        # GPT-5+ uses max_completion_tokens, older models use max_tokens
+        if self.config["model_name"].startswith("gpt-5") or self.config[
+            "model_name"
+        ].startswith("o1"):
+            body["max_completion_tokens"] = self.config["max_tokens"]
+        else:
+            body["max_tokens"] = self.config["max_tokens"]
+
+        if schema is not None and self.config["structured_output"]:
+            body["response_format"] = self._response_format(schema)
+        return body
 
     def extract_list_from_string(self, input_string):
-        # pattern = r'\[.*\]'  
+        # pattern = r'\[.*\]'
         # result = re.search(pattern, input_string)
         # if result:
         #     return result.group()
         # else:
         #     return None
-        start_index = input_string.find('[')  
-        end_index = input_string.rfind(']') 
+        start_index = input_string.find("[")
+        end_index = input_string.rfind("]")
 
         if start_index != -1 and end_index != -1 and start_index < end_index:
-            return input_string[start_index:end_index + 1]
+            return input_string[start_index : end_index + 1]
         else:
             return None
-        
+
     def extract_dict_from_string(self, input_string):
-        start_index = input_string.find('{')
-        end_index = input_string.rfind('}')
+        start_index = input_string.find("{")
+        end_index = input_string.rfind("}")
 
         if start_index != -1 and end_index != -1 and start_index < end_index:
-            return input_string[start_index:end_index + 1]
+            return input_string[start_index : end_index + 1]
         else:
             return None
-    
-    def _boolean_fix(self, output):
-        return output.replace("true", "True").replace("false", "False")
-
-    def _type_check(self, output, expected_type):
-        try:
-            output_eval = ast.literal_eval(output)
-            if not isinstance(output_eval, expected_type):
-                return None
-            return output_eval
-        except:
-            '''
-            if(expected_type == List):
-                valid_output = self.extract_list_from_string(output)
-                output_eval = ast.literal_eval(valid_output)
-                if not isinstance(output_eval, expected_type):
-                    return None
-                return output_eval
-            elif(expected_type == dict):
-                valid_output = self.extract_dict_from_string(output)
-                output_eval = ast.literal_eval(valid_output)
-                if not isinstance(output_eval, expected_type):
-                    return None
-                return output_eval
-            '''
-            return None
 
     async def dispatch_openai_requests(
         self,
         messages_list,
+        schema=None,
     ) -> list[str]:
         """Dispatches requests to OpenAI API asynchronously.
-        
+
         Args:
             messages_list: List of messages to be sent to OpenAI ChatCompletion API.
+            schema: Optional JSON schema the replies must follow.
         Returns:
             List of responses from OpenAI API.
         """
+
         async def _request_with_retry(messages, retry=3):
-            print(f"=== ENTERED _request_with_retry ===")
-            for _ in range(retry):
+            logger.debug("Entered _request_with_retry")
+            tokens = estimate_tokens(messages, self.config["max_tokens"])
+            tried = []
+            request_schema = schema
+            for attempt in range(retry):
+                # the endpoint this attempt was sent to, None if it failed before one was picked
+                endpoint = None
                 try:
-                    print(f"=== About to call OpenAI API ===")
-                    request_params = {
-                        'model': self.config['model_name'],
-                        'messages': messages,
-                        'temperature': self.config['temperature'],
-                        'top_p': self.config['top_p'],
-                        'request_timeout': self.config['request_timeout'],
-                    }
-                                
-                    # GPT-5+ uses max_completion_tokens, older models use max_tokens
-                    if self.config['model_name'].startswith('gpt-5') or self.config['model_name'].startswith('o1'):
-                        request_params['max_completion_tokens'] = self.config['max_tokens']
-                    else:
-                        request_params['max_tokens'] = self.config['max_tokens']
-                                
-                    response = await openai.ChatCompletion.acreate(**request_params)
-                    print(f"DEBUG: Raw API response: {response}") 
-                    print(f"DEBUG: Content: {response['choices'][0]['message']['content']}")
+                    logger.debug("Calling the OpenAI API")
+                    request_params = self._request_body(messages, request_schema)
+                    request_params["request_timeout"] = self.config["request_timeout"]
+
+                    queued = time.monotonic()
+                    if self.rate_limiter is not None:
+                        await self.rate_limiter.acquire(tokens)
+                    # a retry goes to another replica when there is one; waits for one of its parallel slots
+                    async with self.endpoints.use(exclude=tried) as endpoint:
+                        tried.append(endpoint)
+                        request_params["api_base"] = endpoint.url
+                        request_params["api_key"] = self.api_key
+                        async with self.limiter.slot() as ticket:
+                            start = time.monotonic()
+                            try:
+                                response = await openai.ChatCompletion.acreate(
+                                    **request_params
+                                )
+                            except (
+                                openai.error.RateLimitError,
+                                openai.error.Timeout,
+                                openai.error.ServiceUnavailableError,
+                            ):
+                                ticket.overloaded()
+                                raise
+                        elapsed = time.monotonic() - start
+                        self.endpoints.report_success(endpoint, elapsed)
+                        # OpenAI-compatible servers do not report their own queueing
+                        self.endpoints.record_queue_times(endpoint, start - queued)
+                    usage = response.get("usage", {})
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.settle(tokens, usage.get("total_tokens"))
+                    metrics.record_call(
+                        "openai",
+                        self.config["model_name"],
+                        elapsed,
+                        start - queued,
+                        usage.get("prompt_tokens"),
+                        usage.get("completion_tokens"),
+                    )
+                    logger.debug("Raw API response: %s", response)
                     return response
 
-                except openai.error.RateLimitError:
-                    print('Rate limit error, waiting for 40 second...')
-                    await asyncio.sleep(40)
+                except openai.error.InvalidRequestError as e:
+                    message = str(e)
+                    if "response_format" in request_params and (
+                        "response_format" in message or "json_schema" in message
+                    ):
+                        # older models and some local servers do not support structured output
+                        logger.warning(
+                            "Structured output rejected, retrying without it: %s", e
+                        )
+                        request_schema = None
+                        continue
+                    logger.error("Invalid request: %s", e)
+                    return None
+                except openai.error.RateLimitError as e:
+                    delay = retry_after_seconds(e.headers) or 5 * 2**attempt
+                    logger.warning("Rate limit error, waiting for %s seconds", delay)
+                    if self.rate_limiter is not None:
+                        # hold back every request to this model, not just this one
+                        self.rate_limiter.penalize(delay)
+                    else:
+                        await asyncio.sleep(delay)
                 except openai.error.APIError:
-                    print('API error, waiting for 1 second...')
+                    if endpoint is not None:
+                        self.endpoints.report_failure(endpoint)
+                    logger.warning("API error, waiting for 1 second")
                     await asyncio.sleep(1)
                 except openai.error.Timeout:
-                    print('Timeout error, waiting for 1 second...')
+                    if endpoint is not None:
+                        self.endpoints.report_failure(endpoint)
+                    logger.warning("Timeout error, waiting for 1 second")
                     await asyncio.sleep(1)
                 except openai.error.ServiceUnavailableError:
-                    print('Service unavailable error, waiting for 3 second...')
+                    if endpoint is not None:
+                        self.endpoints.report_failure(endpoint)
+                    logger.warning("Service unavailable error, waiting for 3 seconds")
                     await asyncio.sleep(3)
                 except openai.error.APIConnectionError:
-                    print('API Connection error, waiting for 3 second...')
+                    if endpoint is not None:
+                        self.endpoints.report_failure(endpoint)
+                    logger.warning("API connection error, waiting for 3 seconds")
                     await asyncio.sleep(3)
 
             return None
 
-        async_responses = [
-            _request_with_retry(messages)
-            for messages in messages_list
-        ]
+        async_responses = [_request_with_retry(messages) for messages in messages_list]
 
         return await asyncio.gather(*async_responses)
-    
-    async def async_run(self, messages_list, expected_type):
+
+    async def async_run(self, messages_list, expected_type, schema=None):
         retry = 1
         responses = [None for _ in range(len(messages_list))]
         messages_list_cur_index = [i for i in range(len(messages_list))]
 
+        if self.cache is not None:
+            cache_keys = [
+                self._cache_key(messages, expected_type, schema)
+                for messages in messages_list
+            ]
+            if not self.bypass_cache:
+                # one lookup for the whole batch, off the event loop
+                responses = await self.cache.aget_many(cache_keys)
+                messages_list_cur_index = [
+                    i for i in messages_list_cur_index if responses[i] is None
+                ]
+
         while retry > 0 and len(messages_list_cur_index) > 0:
-            print(f'{retry} retry left...')
             messages_list_cur = [messages_list[i] for i in messages_list_cur_index]
-            
+
             predictions = await self.dispatch_openai_requests(
                 messages_list=messages_list_cur,
+                schema=schema,
             )
 
-            preds = [self._type_check(self._boolean_fix(prediction['choices'][0]['message']['content']), expected_type) if prediction is not None else None for prediction in predictions]
+            preds = [
+                parse_json_output(
+                    prediction["choices"][0]["message"]["content"],
+                    expected_type,
+                    schema,
+                )
+                if prediction is not None
+                else None
+                for prediction in predictions
+            ]
 
             finised_index = []
             for i, pred in enumerate(preds):
                 if pred is not None:
                     responses[messages_list_cur_index[i]] = pred
                     finised_index.append(messages_list_cur_index[i])
-            
-            messages_list_cur_index = [i for i in messages_list_cur_index if i not in finised_index]
-            
+            if self.cache is not None:
+                await self.cache.aset_many(
+                    [(cache_keys[i], responses[i]) for i in finised_index]
+                )
+
+            messages_list_cur_index = [
+                i for i in messages_list_cur_index if i not in finised_index
+            ]
+
             retry -= 1
-        
+
         return responses
 
-class OpenAIEmbed():
-    def __init__():
+
+class OpenAIEmbed:
+    def __init__(self, model_name="text-embedding-ada-002"):
         openai.api_key = os.environ.get("OPENAI_API_KEY", None)
-        assert openai.api_key is not None, "Please set the OPENAI_API_KEY environment variable."
-        assert openai.api_key != '', "Please set the OPENAI_API_KEY environment variable."
+        assert (
+            openai.api_key is not None
+        ), "Please set the OPENAI_API_KEY environment variable."
+        assert (
+            openai.api_key != ""
+        ), "Please set the OPENAI_API_KEY environment variable."
+        self.model_name = model_name
+        self.limiter = get_limiter("embeddings")
+        self.rate_limiter = get_rate_limiter(model_name)
 
-    async def create_embedding(self, text, retry=3):
-        for _ in range(retry):
+    async def create_embedding(self, text, retry=6):
+        """Embed text, retrying with exponential backoff.
+
+        Raises a RuntimeError, from the last error, once all retries failed, so a
+        corpus is never left with missing embeddings. Errors that retrying cannot
+        fix, e.g. an invalid request, are raised right away.
+        """
+        tokens = estimate_tokens(text)
+        error = None
+        for attempt in range(retry):
+            delay = min(60, 2**attempt) * (0.5 + random.random() / 2)
             try:
-                response = await openai.Embedding.acreate(input=text, model="text-embedding-ada-002")
+                queued = time.monotonic()
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.acquire(tokens)
+                async with self.limiter.slot() as ticket:
+                    start = time.monotonic()
+                    try:
+                        response = await openai.Embedding.acreate(
+                            input=text, model=self.model_name
+                        )
+                    except (openai.error.RateLimitError, openai.error.Timeout):
+                        ticket.overloaded()
+                        raise
+                usage = response.get("usage", {})
+                if self.rate_limiter is not None:
+                    self.rate_limiter.settle(tokens, usage.get("total_tokens"))
+                metrics.record_call(
+                    "embeddings",
+                    self.model_name,
+                    time.monotonic() - start,
+                    start - queued,
+                    usage.get("prompt_tokens"),
+                )
                 return response
-            except openai.error.RateLimitError:
-                print('Rate limit error, waiting for 1 second...')
-                await asyncio.sleep(1)
-            except openai.error.APIError:
-                print('API error, waiting for 1 second...')
-                await asyncio.sleep(1)
-            except openai.error.Timeout:
-                print('Timeout error, waiting for 1 second...')
-                await asyncio.sleep(1)
-        return None
-
-    async def process_batch(self, batch, retry=3):
+            except openai.error.RateLimitError as e:
+                error = e
+                delay = retry_after_seconds(e.headers) or delay
+                logger.warning("Rate limit error, waiting for %.1f seconds", delay)
+                if self.rate_limiter is not None:
+                    # the next acquire waits it out, together with every other request
+                    self.rate_limiter.penalize(delay)
+                    continue
+            except (
+                openai.error.APIError,
+                openai.error.Timeout,
+                openai.error.APIConnectionError,
+            ) as e:
+                error = e
+                logger.warning("%s, waiting for %.1f seconds", type(e).__name__, delay)
+            if attempt < retry - 1:
+                await asyncio.sleep(delay)
+        raise RuntimeError(
+            f"Embedding with {self.model_name} failed after {retry} attempts: {error}"
+        ) from error
+
+    async def process_batch(self, batch, retry=6):
+        """Embed every text of batch; if any fails, raise its error once the others have finished."""
         tasks = [self.create_embedding(text, retry=retry) for text in batch]
-        return await asyncio.gather(*tasks)
+        # wait for every request rather than leave the rest running when one fails
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
 
 if __name__ == "__main__":
-    chat = OpenAIChat(model_name='llama-2-7b-chat-hf')
+    chat = OpenAIChat(model_name="llama-2-7b-chat-hf")
 
-    predictions = asyncio.run(chat.async_run(
-        messages_list=[
-            [{"role": "user", "content": "show either 'ab' or '['a']'. Do not do anything else."}],
-        ] * 20,
-        expected_type=List,
-    ))
+    predictions = asyncio.run(
+        chat.async_run(
+            messages_list=[
+                [
+                    {
+                        "role": "user",
+                        "content": "show either 'ab' or '['a']'. Do not do anything else.",
+                    }
+                ],
+            ]
+            * 20,
+            expected_type=List,
+        )
+    )
 
     print(predictions)
     # Usage
@@ -227,4 +433,4 @@ if __name__ == "__main__":
     # batch = ["string1", "string2", "string3", "string4", "string5", "string6", "string7", "string8", "string9", "string10"]  # Your batch of strings
     # embeddings = asyncio.run(embed.process_batch(batch, retry=3))
     # for embedding in embeddings:
-    #     print(embedding["data"][0]["embedding"])
\ No newline at end of file
+    #     print(embedding["data"][0]["embedding"])
@@ -0,0 +1,82 @@
+"""JSON schemas for the structured output of each LLM stage.
+
+They are passed to the chat wrappers' async_run, which hand them to the backend
+(Ollama's `format`, OpenAI's `response_format`) so the reply is valid JSON of the
+right shape. The prompts still describe the format for backends that ignore them.
+"""
+
+
+def _object(properties, required):
+    return {"type": "object", "properties": properties, "required": required}
+
+
+def _list_of(item):
+    return {"type": "array", "items": item}
+
+
+def packed(schema):
+    """Schema of a packed reply: a list of single-item replies tagged with their index."""
+    return _list_of(
+        _object(
+            {"index": {"type": "integer"}, **schema["properties"]},
+            ["index", *schema["required"]],
+        )
+    )
+
+
+KNOWLEDGE_QA_CLAIMS = _list_of(_object({"claim": {"type": "string"}}, ["claim"]))
+
+SCIENTIFIC_CLAIMS = _list_of(
+    _object(
+        {
+            "paper_title": {"type": "string"},
+            "paper_author(s)": {"type": "string"},
+            "paper_pub_year": {"type": "string"},
+        },
+        ["paper_title", "paper_author(s)", "paper_pub_year"],
+    )
+)
+
+QUERIES = {"type": "array", "items": {"type": "string"}, "minItems": 1}
+
+PACKED_QUERIES = packed(_object({"queries": QUERIES}, ["queries"]))
+
+VERDICT = _object(
+    {
+        "reasoning": {"type": "string"},
+        "error": {"type": "string"},
+        "correction": {"type": "string"},
+        "factuality": {"type": "boolean"},
+    },
+    ["reasoning", "error", "correction", "factuality"],
+)
+
+PACKED_VERDICTS = packed(VERDICT)
+
+# verdict of the small model in cascade verification, with its own estimate of being right
+CONFIDENT_VERDICT = _object(
+    {
+        **VERDICT["properties"],
+        "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+    },
+    [*VERDICT["required"], "confidence"],
+)
+
+PACKED_CONFIDENT_VERDICTS = packed(CONFIDENT_VERDICT)
+
+AUTHOR_CHECK = _object(
+    {"reasoning": {"type": "string"}, "factuality": {"type": "boolean"}},
+    ["reasoning", "factuality"],
+)
+
+PACKED_AUTHOR_CHECKS = packed(AUTHOR_CHECK)
+
+# self-check corrections are free text for claims and a dictionary for papers
+SELF_CHECK = _object(
+    {
+        "reasoning": {"type": "string"},
+        "error": {"type": "string"},
+        "factuality": {"type": "boolean"},
+    },
+    ["reasoning", "factuality"],
+)
@@ -1,6 +1,10 @@
+import ast
 import json
+import re
+
 import numpy as np
 
+
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.int64):
@@ -9,4 +13,317 @@ class CustomJSONEncoder(json.JSONEncoder):
             return list(obj)
         elif isinstance(obj, np.ndarray):
             return obj.tolist()
-        return super(CustomJSONEncoder, self).default(obj)
\ No newline at end of file
+        return super(CustomJSONEncoder, self).default(obj)
+
+
+_PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_CLOSERS = {"[": "]", "{": "}"}
+_OPENER = re.compile(r"[\[{]")
+
+
+def _base_type(expected_type):
+    """list for list / typing.List, dict for dict / typing.Dict."""
+    return getattr(expected_type, "__origin__", None) or expected_type
+
+
+def _strip_wrapping(text):
+    text = re.sub(r"<think>.*?</think>", "", text, flags=re.DOTALL)
+    # an unterminated thinking block means the answer never started
+    text = re.sub(r"<think>.*", "", text, flags=re.DOTALL)
+    text = re.sub(r"```(?:json|python)?", "", text)
+    return text.strip()
+
+
+def _scan(text, start):
+    """Return the end of the bracketed value opening at start, plus what is left open if it never closes."""
+    stack = []
+    quote = None
+    i = start
+    while i < len(text):
+        c = text[i]
+        if quote is not None:
+            if c == "\\":
+                i += 2
+                continue
+            if c == quote:
+                quote = None
+        elif c in "\"'":
+            quote = c
+        elif c in _CLOSERS:
+            stack.append(_CLOSERS[c])
+        elif c in "]}":
+            if not stack or stack[-1] != c:
+                return None, None
+            stack.pop()
+            if not stack:
+                return i + 1, None
+        i += 1
+    return None, (quote or "") + "".join(reversed(stack))
+
+
+def _repair(text):
+    """Turn Python-ish or sloppy JSON into strict JSON.
+
+    Rewrites single-quoted strings, True/False/None outside of strings and
+    trailing commas, leaving the contents of strings alone.
+    """
+    out = []
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c in "\"'":
+            j = i + 1
+            body = []
+            while j < n and text[j] != c:
+                if text[j] == "\\" and j + 1 < n:
+                    body.append(text[j : j + 2])
+                    j += 2
+                    continue
+                body.append(text[j])
+                j += 1
+            body = "".join(body)
+            if c == "'":
+                body = body.replace("\\'", "'").replace('"', '\\"')
+            out.append('"' + body + '"')
+            i = j + 1
+        elif c.isalpha() or c == "_":
+            j = i
+            while j < n and (text[j].isalnum() or text[j] == "_"):
+                j += 1
+            word = text[i:j]
+            out.append(_PYTHON_LITERALS.get(word, word))
+            i = j
+        elif c == ",":
+            j = i + 1
+            while j < n and text[j].isspace():
+                j += 1
+            if j >= n or text[j] not in "]}":
+                out.append(c)
+            i += 1
+        else:
+            out.append(c)
+            i += 1
+    return "".join(out)
+
+
+def _loads(candidate):
+    for attempt in (candidate, _repair(candidate)):
+        try:
+            return json.loads(attempt, strict=False)
+        except ValueError:
+            pass
+    try:
+        return ast.literal_eval(candidate)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+
+
+def _conforms(value, schema):
+    """Whether value has the shape schema describes.
+
+    Covers the parts of JSON schema factsearch.utils.schemas uses: types,
+    properties, required, items, minItems, minimum and maximum. A free-text
+    field may be null.
+    """
+    kind = schema.get("type")
+    if kind == "object":
+        if not isinstance(value, dict) or any(
+            key not in value for key in schema.get("required", ())
+        ):
+            return False
+        return all(
+            _conforms(value[key], sub)
+            for key, sub in schema.get("properties", {}).items()
+            if key in value
+        )
+    if kind == "array":
+        if not isinstance(value, list) or len(value) < schema.get("minItems", 0):
+            return False
+        return "items" not in schema or all(
+            _conforms(item, schema["items"]) for item in value
+        )
+    if kind == "string":
+        return value is None or isinstance(value, str)
+    if kind == "boolean":
+        return isinstance(value, bool)
+    if kind in ("integer", "number"):
+        if isinstance(value, bool) or not isinstance(
+            value, int if kind == "integer" else (int, float)
+        ):
+            return False
+        return schema.get("minimum", value) <= value <= schema.get("maximum", value)
+    return True
+
+
+def _matches(value, base_type, schema=None):
+    """value as base_type if it has the expected shape, else None."""
+    # structured output can only return objects at the top level, so lists come wrapped, see _response_format
+    if (
+        base_type is list
+        and isinstance(value, dict)
+        and list(value) == ["items"]
+        and isinstance(value["items"], list)
+    ):
+        value = value["items"]
+    # a dict was asked for but the model returned it inside a list
+    elif (
+        base_type is dict
+        and isinstance(value, list)
+        and len(value) == 1
+        and isinstance(value[0], dict)
+    ):
+        value = value[0]
+    if not isinstance(value, base_type):
+        return None
+    if schema is not None and not _conforms(value, schema):
+        return None
+    return value
+
+
+def _candidates(text, max_candidates):
+    """The bracketed values at the top level of text.
+
+    Brackets nested in a value are never candidates of their own, so a list
+    quoted inside a reasoning string is not mistaken for the answer. An
+    unclosed value, cut off by the end of the generation, comes last with its
+    brackets closed.
+    """
+    pos = 0
+    for _ in range(max_candidates):
+        match = _OPENER.search(text, pos)
+        if match is None:
+            return
+        start = match.start()
+        end, unclosed = _scan(text, start)
+        if end is not None:
+            yield text[start:end]
+            pos = end
+        elif unclosed:
+            yield text[start:] + unclosed
+            return
+        else:
+            # mismatched brackets, e.g. in prose
+            pos = start + 1
+
+
+def parse_json_output(output, expected_type, schema=None, max_candidates=5):
+    """Parse a model reply into expected_type (list or dict), or None if that is impossible.
+
+    Accepts strict JSON, Python literals, replies wrapped in prose, code fences or
+    <think> blocks, single quotes, trailing commas and answers cut off before their
+    closing brackets. Only values at the top level of the reply are considered,
+    and with a schema (see factsearch.utils.schemas) only values of its shape.
+    """
+    if not isinstance(output, str):
+        return None
+    base_type = _base_type(expected_type)
+    text = _strip_wrapping(output)
+
+    try:
+        return _matches(json.loads(text), base_type, schema)
+    except ValueError:
+        pass
+
+    for candidate in _candidates(text, max_candidates):
+        value = _loads(candidate)
+        if value is not None:
+            value = _matches(value, base_type, schema)
+            if value is not None:
+                return value
+    return None
+
+
+class JsonStreamScanner:
+    """Follow a streamed model reply and notice when a complete JSON value has arrived.
+
+    feed() takes the text chunks as they come. <think> blocks are dropped as they
+    stream, even when a tag is split across chunks. Once a bracketed value of the
+    expected type closes and parses, complete is set and result holds it, so the
+    caller can stop the generation instead of waiting for trailing text.
+    """
+
+    _OPEN_TAG = "<think>"
+    _CLOSE_TAG = "</think>"
+
+    def __init__(self, expected_type, schema=None):
+        self.expected_type = expected_type
+        self.schema = schema
+        self.text = ""
+        self.complete = False
+        self.result = None
+        self._pending = ""
+        self._in_think = False
+        self._pos = 0
+        self._start = None
+        self._stack = []
+        self._quote = None
+        self._escaped = False
+
+    def feed(self, chunk):
+        """Add a chunk of the reply; returns True once a complete value has been seen."""
+        if self.complete:
+            return True
+        self.text += self._visible(self._pending + chunk)
+        self._advance()
+        return self.complete
+
+    def _visible(self, chunk):
+        out = []
+        while chunk:
+            tag = self._CLOSE_TAG if self._in_think else self._OPEN_TAG
+            index = chunk.find(tag)
+            if index != -1:
+                if not self._in_think:
+                    out.append(chunk[:index])
+                chunk = chunk[index + len(tag) :]
+                self._in_think = not self._in_think
+                continue
+            # hold back a suffix that may be the start of a tag split across chunks
+            keep = 0
+            for size in range(min(len(tag) - 1, len(chunk)), 0, -1):
+                if tag.startswith(chunk[-size:]):
+                    keep = size
+                    break
+            if not self._in_think:
+                out.append(chunk[: len(chunk) - keep])
+            self._pending = chunk[len(chunk) - keep :]
+            return "".join(out)
+        self._pending = ""
+        return "".join(out)
+
+    def _advance(self):
+        text = self.text
+        while self._pos < len(text):
+            c = text[self._pos]
+            self._pos += 1
+            if self._start is None:
+                if c in _CLOSERS:
+                    self._start = self._pos - 1
+                    self._stack = [_CLOSERS[c]]
+                continue
+            if self._quote is not None:
+                if self._escaped:
+                    self._escaped = False
+                elif c == "\\":
+                    self._escaped = True
+                elif c == self._quote:
+                    self._quote = None
+            elif c in "\"'":
+                self._quote = c
+            elif c in _CLOSERS:
+                self._stack.append(_CLOSERS[c])
+            elif c in "]}":
+                if self._stack and self._stack[-1] == c:
+                    self._stack.pop()
+                if not self._stack:
+                    value = parse_json_output(
+                        text[self._start : self._pos], self.expected_type, self.schema
+                    )
+                    if value is not None:
+                        self.complete = True
+                        self.result = value
+                        return
+                    # not a usable value, e.g. brackets in prose; values nested in it are not answers either
+                    self._start = None
+                    self._quote = None
@@ -0,0 +1,58 @@
+import asyncio
+from typing import Dict
+
+from factsearch.utils.batch_backend import BulkRunner, LocalBatchBackend
+from factsearch.utils.ollama_wrapper import OllamaChat
+
+
+def make_chat(replies):
+    chat = OllamaChat(model_name="qwen3:8b")
+    sent = []
+
+    async def dispatch(messages_list, schema=None, expected_type=None):
+        sent.extend(messages_list)
+        return [replies.get(messages[0]["content"]) for messages in messages_list]
+
+    chat.dispatch_ollama_requests = dispatch
+    return chat, sent
+
+
+def test_local_batches_run_resume_and_report_failures(tmp_path):
+    chat, sent = make_chat({"a": '{"factuality": true}', "b": "no json here"})
+    messages = {
+        "0": [{"role": "user", "content": "a"}],
+        "1": [{"role": "user", "content": "b"}],
+        "2": [{"role": "user", "content": "c"}],
+    }
+
+    runner = BulkRunner(chat, str(tmp_path), poll_interval=0)
+    results = asyncio.run(runner.run_stage("verification", messages, Dict))
+    assert results == {"0": {"factuality": True}, "1": None, "2": None}
+    assert len(sent) == 3
+
+    # a finished stage is read back from disk
+    again = asyncio.run(
+        BulkRunner(chat, str(tmp_path), poll_interval=0).run_stage(
+            "verification", messages, Dict
+        )
+    )
+    assert again == results
+    assert len(sent) == 3
+
+
+def test_cancelled_local_batch_is_reported(tmp_path):
+    chat, _ = make_chat({})
+    backend = LocalBatchBackend(chat, str(tmp_path))
+
+    async def main():
+        async def forever():
+            await asyncio.sleep(10)
+
+        task = backend._tasks["batch"] = asyncio.ensure_future(forever())
+        assert await backend.status("batch") == ("in_progress", {})
+        task.cancel()
+        await asyncio.sleep(0)
+        return await backend.status("batch")
+
+    assert asyncio.run(main()) == ("cancelled", {})
+    assert "batch" not in backend._tasks
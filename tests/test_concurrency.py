@@ -0,0 +1,213 @@
+import asyncio
+import time
+
+import pytest
+
+from factsearch.utils.concurrency import (
+    AdaptiveLimiter,
+    RateLimiter,
+    SingleFlight,
+    TokenBucket,
+    retry_after_seconds,
+)
+
+
+def make_limiter(**kwargs):
+    options = dict(
+        initial_limit=8, min_limit=1, max_limit=16, latency_tolerance=None, cooldown=0.0
+    )
+    options.update(kwargs)
+    return AdaptiveLimiter("test", **options)
+
+
+def test_success_grows_the_limit():
+    limiter = make_limiter()
+
+    async def main():
+        async with limiter.slot():
+            pass
+
+    asyncio.run(main())
+    assert limiter._limit > 8
+    assert limiter.stats()["successes"] == 1
+
+
+def test_timeout_counts_as_overload():
+    limiter = make_limiter()
+
+    async def main():
+        async with limiter.slot():
+            raise asyncio.TimeoutError()
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(main())
+    assert limiter.limit == 4
+    assert limiter.stats()["overloads"] == 1
+    assert limiter.stats()["in_flight"] == 0
+
+
+def test_overloaded_ticket_halves_the_limit():
+    limiter = make_limiter()
+
+    async def main():
+        async with limiter.slot() as ticket:
+            ticket.overloaded()
+
+    asyncio.run(main())
+    assert limiter.limit == 4
+
+
+def test_other_errors_leave_the_limit_alone():
+    limiter = make_limiter()
+
+    async def main():
+        async with limiter.slot():
+            raise ValueError("bad reply")
+
+    with pytest.raises(ValueError):
+        asyncio.run(main())
+    assert limiter.limit == 8
+    assert limiter.stats()["errors"] == 1
+
+
+def test_cancelled_request_is_not_counted():
+    limiter = make_limiter(latency_tolerance=2.0)
+
+    async def hold():
+        async with limiter.slot():
+            await asyncio.sleep(10)
+
+    async def main():
+        task = asyncio.ensure_future(hold())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    stats = limiter.stats()
+    assert limiter._limit == 8
+    assert stats["successes"] == stats["overloads"] == stats["errors"] == 0
+    assert stats["latency_ewma"] is None
+    assert stats["in_flight"] == 0
+
+
+def test_waiters_are_admitted_as_slots_free_up():
+    limiter = make_limiter(initial_limit=2, max_limit=2)
+    peak = 0
+
+    async def request():
+        nonlocal peak
+        async with limiter.slot():
+            peak = max(peak, limiter.stats()["in_flight"])
+            await asyncio.sleep(0.01)
+
+    async def main():
+        await asyncio.gather(*[request() for _ in range(6)])
+
+    asyncio.run(main())
+    assert peak == 2
+    assert limiter.stats()["in_flight"] == 0
+
+
+def test_cancelled_waiter_passes_its_slot_on():
+    limiter = make_limiter(initial_limit=1, max_limit=1)
+
+    async def main():
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        other = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        # free the slot, then cancel the waiter it was handed to
+        limiter.release(0.0, "cancelled")
+        waiter.cancel()
+        await asyncio.wait_for(other, 1)
+
+    asyncio.run(main())
+    assert limiter.stats()["in_flight"] == 1
+
+
+def test_single_flight_shares_one_call():
+    flight = SingleFlight()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def main():
+        return await asyncio.gather(*[flight.do("key", fetch) for _ in range(3)])
+
+    assert asyncio.run(main()) == ["result"] * 3
+    assert calls == 1
+    assert flight.coalesced == 2
+
+
+def test_single_flight_shares_the_error_and_forgets_the_call():
+    flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("search failed")
+
+    async def succeed():
+        return "result"
+
+    async def main():
+        results = await asyncio.gather(
+            flight.do("key", fail), flight.do("key", fail), return_exceptions=True
+        )
+        return results, await flight.do("key", succeed)
+
+    results, retried = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert retried == "result"
+
+
+def test_token_bucket_refills_and_pays_back_debt():
+    bucket = TokenBucket(60, period=60.0)
+    assert bucket.wait_time(60) == 0
+    bucket.take(90)
+    # 30 in debt plus 10 wanted, at one unit a second
+    assert bucket.wait_time(10) == pytest.approx(40, abs=0.1)
+    bucket.resize(120)
+    assert bucket.capacity == 120
+
+
+def test_rate_limiter_spreads_requests_at_the_limit():
+    # 600 requests a minute is one every 0.1 seconds once the burst of 600 is spent
+    limiter = RateLimiter("test", rpm=600)
+    limiter.requests.take(600)
+
+    async def main():
+        start = time.monotonic()
+        await asyncio.gather(*[limiter.acquire() for _ in range(3)])
+        return time.monotonic() - start
+
+    assert asyncio.run(main()) == pytest.approx(0.3, abs=0.15)
+    assert limiter.stats()["admitted"] == 3
+
+
+def test_rate_limiter_settles_tokens_and_obeys_penalties():
+    limiter = RateLimiter("test", tpm=1000)
+
+    async def main():
+        await limiter.acquire(100)
+        limiter.settle(100, 400)
+        limiter.penalize(0.2)
+        start = time.monotonic()
+        await limiter.acquire(1)
+        return time.monotonic() - start
+
+    assert asyncio.run(main()) >= 0.15
+    assert limiter.tokens._level == pytest.approx(599, abs=5)
+    assert limiter.stats()["throttled"] == 1
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds({"Retry-After": "3"}) == 3
+    assert retry_after_seconds({"retry-after-ms": "1500"}) == 1.5
+    assert retry_after_seconds({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}) is None
+    assert retry_after_seconds(None) is None
@@ -0,0 +1,58 @@
+from factsearch.knowledge_qa.dedup import dedup_evidence, duplicate_of, normalize_url
+
+TOWER = "The Eiffel Tower is 330 metres tall and was built in 1889 for the World's Fair in Paris."
+TOWER_REWORDED = "The Eiffel Tower is 330 metres tall and was built in 1889 for the World's Fair held in Paris."
+COMPANY = "Gustave Eiffel's company designed and built the tower between 1887 and 1889 as the entrance arch."
+
+
+def test_normalize_url_drops_scheme_www_fragment_and_tracking():
+    assert normalize_url(
+        "https://www.Example.com/a/?utm_source=x&id=2#top"
+    ) == normalize_url("http://example.com/a?id=2")
+    assert normalize_url("None") is None
+    assert normalize_url(None) is None
+
+
+def test_identical_and_near_identical_texts_are_duplicates():
+    texts = [TOWER, COMPANY, TOWER, TOWER_REWORDED]
+    assert list(duplicate_of(texts, ["a", "b", "c", "d"])) == [-1, -1, 0, 0]
+
+
+def test_same_url_with_different_text_is_kept():
+    urls = ["https://example.com/eiffel?utm_source=feed", "https://example.com/eiffel"]
+    assert list(duplicate_of([TOWER, COMPANY], urls)) == [-1, -1]
+
+
+def test_same_url_with_the_same_text_is_dropped():
+    urls = ["https://example.com/eiffel/", "http://www.example.com/eiffel"]
+    assert list(duplicate_of([TOWER, TOWER], urls)) == [-1, 0]
+
+
+def test_snippets_only_match_within_their_group():
+    assert list(duplicate_of([TOWER, TOWER], ["a", "b"], groups=[0, 1])) == [-1, -1]
+
+
+def test_dedup_evidence_keeps_order_and_each_claims_own_evidence():
+    evidences = [
+        [
+            {"content": TOWER, "source": "https://a.com"},
+            {"content": COMPANY, "source": "https://b.com"},
+        ],
+        [
+            {"content": TOWER_REWORDED, "source": "https://c.com"},
+            {"content": TOWER, "source": "https://d.com"},
+        ],
+        [],
+    ]
+    deduped = dedup_evidence(evidences)
+    assert [snippet["source"] for snippet in deduped[0]] == [
+        "https://a.com",
+        "https://b.com",
+    ]
+    assert [snippet["source"] for snippet in deduped[1]] == ["https://c.com"]
+    assert deduped[2] == []
+
+
+def test_empty_input():
+    assert dedup_evidence([]) == []
+    assert list(duplicate_of([], [])) == []
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from factsearch.utils.disk_cache import DiskCache, make_key
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DiskCache(str(tmp_path / "cache.db"), ttl=60, max_entries=3)
+
+
+def test_make_key_ignores_dict_order():
+    assert make_key({"a": 1, "b": [1, 2]}) == make_key({"b": [1, 2], "a": 1})
+    assert make_key({"a": 1}) != make_key({"a": 2})
+
+
+def test_get_and_set(cache):
+    assert cache.get("missing") is None
+    cache.set("key", {"factuality": True})
+    assert cache.get("key") == {"factuality": True}
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_expired_entries_are_misses(cache):
+    cache.set("key", [1], ttl=-1)
+    assert cache.get("key") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_batches(cache):
+    cache.set_many([("a", 1), ("b", [2])])
+    assert cache.get_many(["a", "x", "b"]) == [1, None, [2]]
+
+
+def test_evicts_the_least_recently_used(cache):
+    cache.set_many([("a", 1), ("b", 2), ("c", 3)])
+    cache.get("a")
+    cache.set_many([("d", 4), ("e", 5)])
+    # the size is checked when the write count passes a multiple of 100, or on the first write
+    cache._writes = 99
+    cache.set("f", 6)
+    assert cache.stats()["entries"] == 3
+    assert cache.get("b") is None
+    assert cache.get("f") == 6
+
+
+def test_async_variants(cache):
+    async def main():
+        await cache.aset_many([("a", 1), ("b", 2)])
+        await cache.aset("c", 3)
+        return await cache.aget_many(["a", "b"]), await cache.aget("c")
+
+    assert asyncio.run(main()) == ([1, 2], 3)
+
+
+def test_a_failed_write_stores_nothing(cache):
+    with pytest.raises(TypeError):
+        cache.set_many([("a", 1), ("b", object())])
+    assert cache.get("a") is None
+    cache.set("c", 3)
+    assert cache.get("c") == 3
+
+
+def test_survives_reopening(tmp_path):
+    path = str(tmp_path / "cache.db")
+    DiskCache(path).set("key", "value")
+    assert DiskCache(path).get("key") == "value"
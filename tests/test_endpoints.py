@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+from factsearch.utils.endpoints import EndpointPool, endpoint_urls
+
+
+def make_pool(**kwargs):
+    return EndpointPool("test", ["http://a:1", "http://b:1/"], **kwargs)
+
+
+def test_picks_the_least_loaded_endpoint():
+    pool = make_pool()
+    first, second = pool.endpoints
+    assert second.url == "http://b:1"
+    first.outstanding = 2
+    assert pool.pick() is second
+    assert pool.pick(exclude=[second]) is first
+
+
+def test_failures_eject_and_a_recovered_endpoint_gets_one_chance():
+    pool = make_pool(max_failures=2, eject_time=30.0)
+    endpoint = pool.endpoints[0]
+    pool.report_failure(endpoint)
+    assert endpoint.healthy
+    pool.report_failure(endpoint)
+    assert not endpoint.healthy
+    assert pool.pick() is pool.endpoints[1]
+
+    # back from ejection: the next failure ejects it again, for longer
+    endpoint.ejected_until = 0.0
+    pool.report_failure(endpoint)
+    assert endpoint.ejected_until - time.monotonic() > 30.0
+
+
+def test_success_resets_the_failures():
+    pool = make_pool(max_failures=2)
+    endpoint = pool.endpoints[0]
+    pool.report_failure(endpoint)
+    pool.report_success(endpoint, 0.5)
+    pool.report_failure(endpoint)
+    assert endpoint.healthy
+    assert endpoint.latency_ewma == 0.5
+
+
+def test_with_everything_ejected_the_one_due_back_first_is_used():
+    pool = make_pool(max_failures=1)
+    for endpoint in pool.endpoints:
+        pool.report_failure(endpoint)
+    pool.endpoints[1].ejected_until = time.monotonic() + 1
+    assert pool.pick() is pool.endpoints[1]
+
+
+def test_use_caps_requests_at_the_server_parallelism():
+    pool = EndpointPool("test", ["http://a:1"], max_parallel=2)
+    endpoint = pool.endpoints[0]
+    peak = 0
+
+    async def request():
+        nonlocal peak
+        async with pool.use() as used:
+            peak = max(peak, used.slots.stats()["in_flight"])
+            await asyncio.sleep(0.01)
+
+    async def main():
+        await asyncio.gather(*[request() for _ in range(5)])
+
+    asyncio.run(main())
+    assert peak == 2
+    assert endpoint.outstanding == 0
+    assert endpoint.requests == 5
+
+
+def test_endpoint_urls_from_the_environment(monkeypatch):
+    monkeypatch.setenv("OLLAMA_ENDPOINTS", "http://a:1, http://b:1,")
+    monkeypatch.setenv("FACTSEARCH_ENDPOINTS", '{"special": ["http://c:1"]}')
+    assert endpoint_urls("ollama", "qwen3:8b") == ["http://a:1", "http://b:1"]
+    assert endpoint_urls("ollama", "special") == ["http://c:1"]
+    monkeypatch.delenv("OLLAMA_ENDPOINTS")
+    assert endpoint_urls("ollama", "qwen3:8b") == ["http://localhost:11434"]
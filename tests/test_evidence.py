@@ -0,0 +1,52 @@
+import json
+
+from factsearch.knowledge_qa.evidence import EvidencePacker, default_evidence_budget
+from factsearch.knowledge_qa.query_utils import NO_RESULT
+
+CLAIM = "The Eiffel Tower was completed in 1889."
+ON_TOPIC = (
+    "The Eiffel Tower was completed in March 1889 for the Exposition Universelle."
+)
+OFF_TOPIC = "Paris has many cafes and a busy metro system used by millions of riders."
+
+
+def test_default_budget_by_model_prefix():
+    assert default_evidence_budget("gpt-4o-mini") == 1200
+    assert default_evidence_budget("qwen3:1.7b") == 400
+    assert default_evidence_budget("llama3") == 800
+
+
+def test_ranks_by_relevance_and_drops_placeholders_and_repeats():
+    evidence = [
+        {"content": OFF_TOPIC, "source": "a"},
+        {"content": "Search failed", "source": "None"},
+        {"content": ON_TOPIC, "source": "b"},
+        {
+            "content": " The Eiffel  Tower was completed in March 1889 for the Exposition Universelle. ",
+            "source": "c",
+        },
+    ]
+    assert EvidencePacker().pack(CLAIM, evidence) == [ON_TOPIC, OFF_TOPIC]
+
+
+def test_drops_near_duplicates_of_a_better_snippet():
+    reworded = "The Eiffel Tower was completed in March 1889 for the Exposition Universelle in Paris."
+    assert EvidencePacker(max_similarity=0.6).pack(CLAIM, [ON_TOPIC, reworded]) == [
+        ON_TOPIC
+    ]
+
+
+def test_keeps_to_the_budget():
+    packer = EvidencePacker(budget=25)
+    assert packer.pack(CLAIM, [ON_TOPIC, OFF_TOPIC]) == [ON_TOPIC]
+    # the best snippet alone is too long: its beginning is kept
+    (trimmed,) = packer.pack(CLAIM, [ON_TOPIC * 10])
+    assert len(trimmed) == 100
+
+
+def test_nothing_left_gives_the_placeholder():
+    packer = EvidencePacker()
+    assert packer.pack(CLAIM, []) == [NO_RESULT["content"]]
+    assert packer.format(CLAIM, [{"content": "Search failed"}]) == json.dumps(
+        [NO_RESULT["content"]]
+    )
@@ -0,0 +1,37 @@
+from factsearch.knowledge_qa.query_utils import (
+    NO_RESULT,
+    fan_out,
+    normalize_query,
+    plan_queries,
+)
+
+
+def test_normalize_query():
+    assert (
+        normalize_query("  Who built the  Eiffel Tower? ")
+        == "who built the eiffel tower"
+    )
+    assert normalize_query("None") is None
+    assert normalize_query("  ") is None
+    assert normalize_query(None) is None
+
+
+def test_plan_queries_searches_each_query_once():
+    queries = [
+        ["Eiffel Tower height", "eiffel tower height?"],
+        None,
+        ["Eiffel tower HEIGHT", "tower architect"],
+        ["none"],
+    ]
+    unique_queries, slots = plan_queries(queries)
+    assert unique_queries == ["Eiffel Tower height", "tower architect"]
+    assert slots == [[0], [], [0, 1], []]
+
+
+def test_fan_out_gives_every_claim_its_results():
+    results = [[{"content": "a"}], [{"content": "b"}]]
+    assert fan_out([[0], [], [0, 1]], results) == [
+        [{"content": "a"}],
+        [NO_RESULT],
+        [{"content": "a"}, {"content": "b"}],
+    ]
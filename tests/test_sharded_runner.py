@@ -0,0 +1,84 @@
+import json
+from concurrent.futures import Future
+
+from factsearch import sharded_runner
+from factsearch.factool import FactualityTally
+
+
+def write_samples(path, count):
+    with open(path, "w") as f:
+        for i in range(count):
+            f.write(json.dumps({"id": i}) + "\n\n")
+
+
+def test_shard_ranges_cover_every_sample_once():
+    assert sharded_runner._shard_ranges(10, 4) == [(0, 3), (3, 6), (6, 9), (9, 10)]
+    assert sharded_runner._shard_ranges(2, 8) == [(0, 1), (1, 2)]
+    assert sharded_runner._shard_ranges(0, 4) == []
+
+
+def test_read_range_skips_blank_lines(tmp_path):
+    path = str(tmp_path / "in.jsonl")
+    write_samples(path, 5)
+    assert sharded_runner._read_range(path, 1, 3) == [{"id": 1}, {"id": 2}]
+
+
+class InlineExecutor:
+    def __init__(self, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+def test_budget_is_split_between_the_shards_that_run(tmp_path, monkeypatch):
+    input_path = str(tmp_path / "in.jsonl")
+    output_path = str(tmp_path / "out.jsonl")
+    write_samples(input_path, 2)
+    calls = []
+
+    def fake_shard(
+        model,
+        path,
+        start,
+        end,
+        shard_path,
+        budget,
+        rate_share,
+        max_concurrency,
+        cascade_model,
+    ):
+        calls.append((budget, rate_share))
+        with open(shard_path, "w") as f:
+            for sample in sharded_runner._read_range(path, start, end):
+                f.write(json.dumps(sample) + "\n")
+        return FactualityTally()
+
+    monkeypatch.setattr(sharded_runner, "ProcessPoolExecutor", InlineExecutor)
+    monkeypatch.setattr(sharded_runner, "_run_shard", fake_shard)
+    sharded_runner.run_sharded(
+        "qwen3:8b", input_path, output_path, num_workers=8, rate_budget={"ollama": 16}
+    )
+
+    assert [rate_share for _, rate_share in calls] == [0.5, 0.5]
+    assert all(budget["ollama"] == 8 for budget, _ in calls)
+    with open(output_path) as f:
+        assert [json.loads(line) for line in f] == [{"id": 0}, {"id": 1}]
+
+
+def test_empty_input_starts_no_workers(tmp_path, monkeypatch):
+    input_path = str(tmp_path / "in.jsonl")
+    open(input_path, "w").close()
+    monkeypatch.setattr(sharded_runner, "ProcessPoolExecutor", None)
+    results = sharded_runner.run_sharded(
+        "qwen3:8b", input_path, str(tmp_path / "out.jsonl"), num_workers=4
+    )
+    assert results["average_claim_level_factuality"] == 0.0
@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+import pytest
+
+from factsearch.utils.base.pipeline import pipeline
+
+
+class stages_only(pipeline):
+    """Just enough of a pipeline to drive _run_stages, without chats or prompts."""
+
+    def __init__(self):
+        pass
+
+    def _self_check_messages(self, fewshot, item):
+        return []
+
+
+def run(items, stages, **kwargs):
+    async def main():
+        await stages_only()._run_stages(items, stages, **kwargs)
+        # every worker is gone once _run_stages returns
+        await asyncio.sleep(0)
+        return [
+            task for task in asyncio.all_tasks() if task is not asyncio.current_task()
+        ]
+
+    return asyncio.run(main())
+
+
+def test_items_pass_every_stage_in_order():
+    events = []
+
+    async def first(item):
+        events.append(("first", item))
+        await asyncio.sleep(0.001 * (5 - item))
+        return item * 10
+
+    async def second(item):
+        events.append(("second", item))
+        return item
+
+    leftover = run(range(5), [(first, 3), (second, 2)])
+    assert leftover == []
+    assert sorted(item for stage, item in events if stage == "second") == [
+        0,
+        10,
+        20,
+        30,
+        40,
+    ]
+    for item in range(5):
+        assert events.index(("first", item)) < events.index(("second", item * 10))
+
+
+def test_batched_stage_may_fan_out_and_in():
+    batches = []
+    seen = []
+
+    async def split(batch):
+        batches.append(list(batch))
+        return [part for item in batch for part in (item, -item)]
+
+    async def keep_positive(batch):
+        return [item for item in batch if item > 0]
+
+    async def collect(item):
+        seen.append(item)
+
+    run(range(1, 8), [(split, 1, 3), (keep_positive, 1, 4), (collect, 1)], linger=0.01)
+    assert all(1 <= len(batch) <= 3 for batch in batches)
+    assert sorted(item for batch in batches for item in batch) == list(range(1, 8))
+    assert sorted(seen) == list(range(1, 8))
+
+
+def test_accepts_an_async_iterable():
+    seen = []
+
+    async def produce():
+        for item in range(4):
+            await asyncio.sleep(0)
+            yield item
+
+    async def collect(item):
+        seen.append(item)
+
+    run(produce(), [(collect, 2)])
+    assert sorted(seen) == [0, 1, 2, 3]
+
+
+def test_linger_ends_once_the_input_is_exhausted():
+    batches = []
+
+    async def collect(batch):
+        batches.append(batch)
+        return []
+
+    start = time.monotonic()
+    run([1, 2, 3], [(collect, 1, 10)], linger=30)
+    assert time.monotonic() - start < 5
+    assert sorted(item for batch in batches for item in batch) == [1, 2, 3]
+
+
+def test_handler_error_is_raised_after_the_rest_finished():
+    seen = []
+
+    async def fail_on_two(item):
+        if item == 2:
+            raise ValueError("bad item")
+        return item
+
+    async def collect(item):
+        seen.append(item)
+
+    with pytest.raises(ValueError):
+        run(range(5), [(fail_on_two, 2), (collect, 1)])
+    assert sorted(seen) == [0, 1, 3, 4]
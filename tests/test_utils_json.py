@@ -0,0 +1,100 @@
+from typing import Dict, List
+
+from factsearch.utils import schemas
+from factsearch.utils.utils_json import JsonStreamScanner, parse_json_output
+
+VERDICT = {"reasoning": "r", "error": "none", "correction": "none", "factuality": True}
+
+
+def test_parses_strict_json():
+    assert parse_json_output('["a", "b"]', List) == ["a", "b"]
+    assert parse_json_output('{"factuality": true}', Dict) == {"factuality": True}
+
+
+def test_strips_fences_think_blocks_and_prose():
+    reply = '<think>maybe ["x"]</think>Here you go:\n```json\n["a", "b"]\n```\nDone.'
+    assert parse_json_output(reply, List) == ["a", "b"]
+
+
+def test_repairs_python_literals_and_trailing_commas():
+    assert parse_json_output("{'factuality': True, 'error': None,}", dict) == {
+        "factuality": True,
+        "error": None,
+    }
+
+
+def test_closes_a_truncated_answer():
+    assert parse_json_output('[{"claim": "a"}, {"claim": "b"', List) == [
+        {"claim": "a"},
+        {"claim": "b"},
+    ]
+
+
+def test_unwraps_only_an_items_object():
+    assert parse_json_output('{"items": ["a"]}', List) == ["a"]
+    assert parse_json_output('{"claims": ["a"]}', List) is None
+    assert parse_json_output('{"items": ["a"], "note": "x"}', List) is None
+
+
+def test_ignores_values_nested_in_another_value():
+    reply = '{"reasoning": "the sources list [1, 2] disagree", "factuality": false}'
+    assert parse_json_output(reply, List) is None
+
+
+def test_takes_the_first_top_level_value_of_the_right_type():
+    assert parse_json_output('{"note": 1} then ["a"]', List) == ["a"]
+
+
+def test_rejects_values_that_do_not_match_the_schema():
+    assert (
+        parse_json_output('{"factuality": "yes"}', Dict, schemas.AUTHOR_CHECK) is None
+    )
+    assert parse_json_output(
+        '{"reasoning": "r", "factuality": true}', Dict, schemas.AUTHOR_CHECK
+    ) == {
+        "reasoning": "r",
+        "factuality": True,
+    }
+
+
+def test_schema_skips_a_candidate_of_the_wrong_shape():
+    reply = '[{"query": "q"}] and then [{"claim": "c"}]'
+    assert parse_json_output(reply, List, schemas.KNOWLEDGE_QA_CLAIMS) == [
+        {"claim": "c"}
+    ]
+
+
+def test_checks_packed_entries_and_bounds():
+    entry = {"index": 0, **VERDICT, "confidence": 1.5}
+    assert (
+        parse_json_output(str([entry]), List, schemas.PACKED_CONFIDENT_VERDICTS) is None
+    )
+    entry["confidence"] = 0.9
+    assert parse_json_output(str([entry]), List, schemas.PACKED_CONFIDENT_VERDICTS) == [
+        entry
+    ]
+
+
+def test_non_string_output_is_none():
+    assert parse_json_output(None, List) is None
+
+
+def test_stream_scanner_completes_on_the_first_matching_value():
+    scanner = JsonStreamScanner(List)
+    chunks = [
+        "<thi",
+        "nk>[1]</think>Sure: ",
+        '{"a": 1} [{"claim":',
+        ' "x"}]',
+        " trailing",
+    ]
+    done = [scanner.feed(chunk) for chunk in chunks]
+    assert done == [False, False, False, True, True]
+    assert scanner.result == [{"claim": "x"}]
+
+
+def test_stream_scanner_respects_the_schema():
+    scanner = JsonStreamScanner(List, schemas.QUERIES)
+    assert not scanner.feed("[1, 2] ")
+    assert scanner.feed('["q"]')
+    assert scanner.result == ["q"]